@@ -75,8 +75,22 @@ app.mount("/", StaticFiles(directory=public_dir, html=True), name="")
 @app.on_event("shutdown")
 def shutdown_event():
     logger.info("shutdown event")
+    from app.controllers.v1.video import task_manager
+
+    # running tasks are finished, the queued ones stay in the queue
+    task_manager.shutdown(
+        wait=True, timeout=config.app.get("shutdown_timeout", 30)
+    )
 
 
 @app.on_event("startup")
 def startup_event():
     logger.info("startup event")
+    from app.controllers.v1.video import task_manager
+
+    task_manager.start()
+    subtitle_provider = config.app.get("subtitle_provider", "").strip().lower()
+    if subtitle_provider == "whisper" or config.whisper.get("preload", False):
+        from app.services import subtitle
+
+        subtitle.preload()
@@ -1,64 +1,172 @@
 import threading
-from typing import Callable, Any, Dict
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from loguru import logger
+
+# priority lanes, a worker always takes the oldest task of the first non empty lane
+PRIORITY_HIGH = "high"
+PRIORITY_NORMAL = "normal"
+PRIORITY_LOW = "low"
+PRIORITIES = [PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW]
 
 
 class TaskManager:
-    def __init__(self, max_concurrent_tasks: int):
-        self.max_concurrent_tasks = max_concurrent_tasks
+    """
+    a fixed pool of `max_concurrent_tasks` worker threads pulling tasks from
+    a queue with priority lanes.
+
+    a task is only counted as running once a worker took it, so a burst of
+    submissions is queued instead of over-admitted, and every free worker
+    drains the queue on its own.
+
+    with start_workers=False, tasks are only enqueued, for a shared queue
+    processed by other nodes.
+    """
+
+    def __init__(self, max_concurrent_tasks: int, start_workers: bool = True):
+        self.max_concurrent_tasks = max(1, max_concurrent_tasks)
+        self.start_workers = start_workers
         self.current_tasks = 0
         self.lock = threading.Lock()
         self.queue = self.create_queue()
+        self._workers: List[threading.Thread] = []
+        self._stopping = threading.Event()
+        self._metrics = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
 
     def create_queue(self):
         raise NotImplementedError()
 
-    def add_task(self, func: Callable, *args: Any, **kwargs: Any):
+    def start(self):
+        if not self.start_workers:
+            return
         with self.lock:
-            if self.current_tasks < self.max_concurrent_tasks:
-                print(f"add task: {func.__name__}, current_tasks: {self.current_tasks}")
-                self.execute_task(func, *args, **kwargs)
-            else:
-                print(
-                    f"enqueue task: {func.__name__}, current_tasks: {self.current_tasks}"
+            if self._workers or self._stopping.is_set():
+                return
+            for i in range(self.max_concurrent_tasks):
+                worker = threading.Thread(
+                    target=self._work, name=f"task-worker-{i}", daemon=True
                 )
-                self.enqueue({"func": func, "args": args, "kwargs": kwargs})
+                worker.start()
+                self._workers.append(worker)
+        logger.info(f"task manager started, workers: {self.max_concurrent_tasks}")
+
+    def add_task(
+        self,
+        func: Callable,
+        *args: Any,
+        priority: str = PRIORITY_NORMAL,
+        **kwargs: Any,
+    ):
+        if self._stopping.is_set():
+            raise RuntimeError("task manager is shutting down")
+        if priority not in PRIORITIES:
+            raise ValueError(f"invalid priority: {priority}, must be one of {PRIORITIES}")
 
-    def execute_task(self, func: Callable, *args: Any, **kwargs: Any):
-        thread = threading.Thread(
-            target=self.run_task, args=(func, *args), kwargs=kwargs
+        self.start()
+        self.enqueue(
+            {
+                "func": func,
+                "args": args,
+                "kwargs": kwargs,
+                "priority": priority,
+                "enqueued_at": time.time(),
+            }
         )
-        thread.start()
+        with self.lock:
+            self._metrics["submitted"] += 1
+            running = self.current_tasks
+        logger.info(
+            f"enqueue task: {func.__name__}, priority: {priority}, "
+            f"running: {running}, queued: {self.queue_size()}"
+        )
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                task_info = self.dequeue(timeout=1)
+            except Exception as e:
+                logger.error(f"failed to dequeue task: {str(e)}")
+                time.sleep(1)
+                continue
+            if task_info is None:
+                continue
+            self.run_task(task_info)
+
+    def run_task(self, task_info: Dict):
+        wait_time = max(0.0, time.time() - task_info.get("enqueued_at", time.time()))
+        with self.lock:
+            self.current_tasks += 1
+            self._metrics["wait_time_total"] += wait_time
+            self._metrics["wait_time_max"] = max(self._metrics["wait_time_max"], wait_time)
 
-    def run_task(self, func: Callable, *args: Any, **kwargs: Any):
+        func = task_info["func"]
+        succeeded = False
         try:
-            with self.lock:
-                self.current_tasks += 1
-            func(*args, **kwargs)  # 在这里调用函数，传递*args和**kwargs
+            func(*task_info.get("args", ()), **task_info.get("kwargs", {}))
+            succeeded = True
+        except Exception as e:
+            logger.exception(f"task failed: {func.__name__}, error: {str(e)}")
         finally:
-            self.task_done()
+            self.task_done(task_info, succeeded)
 
-    def check_queue(self):
-        with self.lock:
-            if (
-                self.current_tasks < self.max_concurrent_tasks
-                and not self.is_queue_empty()
-            ):
-                task_info = self.dequeue()
-                func = task_info["func"]
-                args = task_info.get("args", ())
-                kwargs = task_info.get("kwargs", {})
-                self.execute_task(func, *args, **kwargs)
-
-    def task_done(self):
+    def task_done(self, task_info: Dict, succeeded: bool = True):
         with self.lock:
             self.current_tasks -= 1
-        self.check_queue()
+            self._metrics["completed" if succeeded else "failed"] += 1
+
+    def shutdown(self, wait: bool = True, timeout: Optional[float] = None):
+        """
+        stop taking new tasks, the running tasks are finished and the queued
+        ones are left in the queue
+        """
+        self._stopping.set()
+        with self.lock:
+            running = self.current_tasks
+        logger.info(
+            f"task manager shutting down, running: {running}, queued: {self.queue_size()}"
+        )
+        if wait:
+            deadline = None if timeout is None else time.time() + timeout
+            for worker in self._workers:
+                remaining = None if deadline is None else max(0.0, deadline - time.time())
+                worker.join(remaining)
+
+    def metrics(self) -> Dict:
+        with self.lock:
+            metrics = dict(self._metrics)
+            running = self.current_tasks
+        started = metrics["completed"] + metrics["failed"] + running
+        metrics["wait_time_avg"] = metrics["wait_time_total"] / started if started else 0.0
+        metrics.update(
+            {
+                "workers": self.max_concurrent_tasks,
+                "running": running,
+                "queued": self.queue_sizes(),
+            }
+        )
+        return metrics
+
+    def queue_size(self) -> int:
+        return sum(self.queue_sizes().values())
 
     def enqueue(self, task: Dict):
         raise NotImplementedError()
 
-    def dequeue(self):
+    def dequeue(self, timeout: float = 1) -> Optional[Dict]:
+        """
+        take the next task by priority, or None after `timeout` seconds
+        """
         raise NotImplementedError()
 
-    def is_queue_empty(self):
+    def queue_sizes(self) -> Dict[str, int]:
         raise NotImplementedError()
+
+    def is_queue_empty(self):
+        return self.queue_size() == 0
@@ -1,18 +1,30 @@
-from queue import Queue
-from typing import Dict
+import itertools
+from queue import Empty, PriorityQueue
+from typing import Dict, Optional
 
-from app.controllers.manager.base_manager import TaskManager
+from app.controllers.manager.base_manager import PRIORITIES, TaskManager
 
 
 class InMemoryTaskManager(TaskManager):
     def create_queue(self):
-        return Queue()
+        self._sequence = itertools.count()
+        return PriorityQueue()
 
     def enqueue(self, task: Dict):
-        self.queue.put(task)
+        # the sequence keeps the tasks of a lane in fifo order
+        lane = PRIORITIES.index(task["priority"])
+        self.queue.put((lane, next(self._sequence), task))
 
-    def dequeue(self):
-        return self.queue.get()
+    def dequeue(self, timeout: float = 1) -> Optional[Dict]:
+        try:
+            _, _, task = self.queue.get(timeout=timeout)
+            return task
+        except Empty:
+            return None
 
-    def is_queue_empty(self):
-        return self.queue.empty()
+    def queue_sizes(self) -> Dict[str, int]:
+        sizes = {priority: 0 for priority in PRIORITIES}
+        with self.queue.mutex:
+            for lane, _, _ in self.queue.queue:
+                sizes[PRIORITIES[lane]] += 1
+        return sizes
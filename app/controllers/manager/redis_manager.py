@@ -1,56 +1,284 @@
 import json
-from typing import Dict
+import os
+import socket
+import threading
+import time
+from typing import Dict, Optional
 
 import redis
+from loguru import logger
+from pydantic import BaseModel
 
-from app.controllers.manager.base_manager import TaskManager
-from app.models.schema import VideoParams
+from app.config import config
+from app.controllers.manager.base_manager import (
+    PRIORITIES,
+    PRIORITY_NORMAL,
+    TaskManager,
+)
+from app.models.schema import AudioRequest, SubtitleRequest, VideoParams
 from app.services import task as tm
+from app.utils import utils
 
 FUNC_MAP = {
     "start": tm.start,
     # 'start_test': tm.start_test
 }
 
+PARAMS_TYPES = {
+    "VideoParams": VideoParams,
+    "SubtitleRequest": SubtitleRequest,
+    "AudioRequest": AudioRequest,
+}
+
 
 class RedisTaskManager(TaskManager):
-    def __init__(self, max_concurrent_tasks: int, redis_url: str):
+    """
+    a work queue shared by every node (api or worker.py) using the same redis.
+
+    a worker moves a task from its lane into its own processing list
+    (LMOVE/BLMOVE) and removes it once the task is done. every node refreshes
+    a heartbeat key, when the heartbeat of a node expires, its processing
+    lists are moved back to the front of the lanes by the reaper of another
+    node. tasks requeued more than task_max_attempts times are moved to the
+    dead letter list instead.
+    """
+
+    def __init__(
+        self, max_concurrent_tasks: int, redis_url: str, start_workers: bool = True
+    ):
         self.redis_client = redis.Redis.from_url(redis_url)
-        super().__init__(max_concurrent_tasks)
+        self.node_id = f"{socket.gethostname()}:{os.getpid()}:{utils.get_uuid(True)[:8]}"
+        self.heartbeat_interval = config.app.get("task_heartbeat_interval", 10)
+        self.heartbeat_ttl = self.heartbeat_interval * 3
+        self.max_attempts = config.app.get("task_max_attempts", 3)
+        self._heartbeat_thread = None
+        super().__init__(max_concurrent_tasks, start_workers=start_workers)
 
     def create_queue(self):
         return "task_queue"
 
+    def lane_key(self, priority: str) -> str:
+        # the normal lane keeps the original key, tasks queued before the
+        # lanes existed are still processed
+        if priority == PRIORITY_NORMAL:
+            return self.queue
+        return f"{self.queue}:{priority}"
+
+    def processing_key(self, node_id: str = "", worker_name: str = "") -> str:
+        node_id = node_id or self.node_id
+        worker_name = worker_name or threading.current_thread().name
+        return f"{self.queue}:processing:{node_id}:{worker_name}"
+
+    def heartbeat_key(self, node_id: str = "") -> str:
+        return f"{self.queue}:heartbeat:{node_id or self.node_id}"
+
+    @property
+    def nodes_key(self) -> str:
+        return f"{self.queue}:nodes"
+
+    @property
+    def dead_key(self) -> str:
+        return f"{self.queue}:dead"
+
+    def start(self):
+        if not self.start_workers:
+            return
+        with self.lock:
+            if self._heartbeat_thread or self._stopping.is_set():
+                return
+            # the node has a heartbeat before its workers move a task into
+            # their processing lists, or another node could requeue it
+            try:
+                self._send_heartbeat()
+            except Exception as e:
+                logger.warning(f"failed to send heartbeat: {str(e)}")
+            self._heartbeat_thread = threading.Thread(
+                target=self._heartbeat, name="task-heartbeat", daemon=True
+            )
+            self._heartbeat_thread.start()
+        super().start()
+
+    def shutdown(self, wait: bool = True, timeout: Optional[float] = None):
+        super().shutdown(wait=wait, timeout=timeout)
+        if not self._heartbeat_thread:
+            return
+        try:
+            # the tasks still running (wait timed out) are reaped by another node
+            self.redis_client.delete(self.heartbeat_key())
+            with self.lock:
+                running = self.current_tasks
+            if running == 0:
+                self.redis_client.srem(self.nodes_key, self.node_id)
+        except Exception as e:
+            logger.warning(f"failed to unregister node: {self.node_id} => {str(e)}")
+
+    def _send_heartbeat(self):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.set(self.heartbeat_key(), int(time.time()), ex=self.heartbeat_ttl)
+        pipe.sadd(self.nodes_key, self.node_id)
+        pipe.execute()
+
+    def _heartbeat(self):
+        while not self._stopping.is_set():
+            try:
+                self._send_heartbeat()
+                self.reap()
+            except Exception as e:
+                logger.warning(f"failed to send heartbeat: {str(e)}")
+            self._stopping.wait(self.heartbeat_interval)
+
+    def reap(self) -> int:
+        """
+        requeue the tasks of the nodes whose heartbeat expired
+        """
+        lock_key = f"{self.queue}:reaper"
+        if not self.redis_client.set(lock_key, self.node_id, nx=True, ex=self.heartbeat_ttl):
+            return 0
+
+        requeued = 0
+        try:
+            for node_id in self.redis_client.smembers(self.nodes_key):
+                node_id = node_id.decode("utf-8")
+                if node_id == self.node_id or self.redis_client.exists(
+                    self.heartbeat_key(node_id)
+                ):
+                    continue
+
+                for key in self.redis_client.scan_iter(
+                    match=self.processing_key(node_id, "*")
+                ):
+                    while True:
+                        raw = self.redis_client.lindex(key, 0)
+                        if raw is None:
+                            break
+                        self._requeue(key, raw)
+                        requeued += 1
+                self.redis_client.srem(self.nodes_key, node_id)
+                logger.warning(f"node is dead: {node_id}, requeued its tasks")
+        finally:
+            self._release_lock(lock_key)
+        return requeued
+
+    def _release_lock(self, lock_key: str):
+        # delete the lock only if this node still owns it, it may have
+        # expired and been taken by another node in the meantime
+        with self.redis_client.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(lock_key)
+                if pipe.get(lock_key) != self.node_id.encode("utf-8"):
+                    pipe.unwatch()
+                    return
+                pipe.multi()
+                pipe.delete(lock_key)
+                pipe.execute()
+            except redis.WatchError:
+                # the lock changed between the check and the delete
+                pass
+
+    def _requeue(self, processing_key, raw: bytes):
+        try:
+            task_info = json.loads(raw)
+            task_info["attempts"] = task_info.get("attempts", 0) + 1
+            # the wait is counted from the requeue, the time spent on the
+            # dead node is not a wait in the queue
+            task_info["enqueued_at"] = time.time()
+            target_key = self.lane_key(task_info.get("priority", PRIORITY_NORMAL))
+            if task_info["attempts"] >= self.max_attempts:
+                logger.error(f"task failed {task_info['attempts']} times, moved to {self.dead_key}")
+                target_key = self.dead_key
+            payload = json.dumps(task_info)
+        except Exception:
+            target_key, payload = self.dead_key, raw
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.lrem(processing_key, 1, raw)
+        pipe.lpush(target_key, payload)
+        pipe.execute()
+
     def enqueue(self, task: Dict):
         task_with_serializable_params = task.copy()
+        task_with_serializable_params["kwargs"] = dict(task["kwargs"])
 
-        if "params" in task["kwargs"] and isinstance(
-            task["kwargs"]["params"], VideoParams
-        ):
-            task_with_serializable_params["kwargs"]["params"] = task["kwargs"][
-                "params"
-            ].dict()
+        params = task["kwargs"].get("params")
+        if isinstance(params, BaseModel):
+            params_type = "VideoParams"
+            if type(params).__name__ in PARAMS_TYPES:
+                params_type = type(params).__name__
+            task_with_serializable_params["kwargs"]["params"] = params.model_dump(
+                mode="json"
+            )
+            task_with_serializable_params["params_type"] = params_type
 
         # 将函数对象转换为其名称
         task_with_serializable_params["func"] = task["func"].__name__
-        self.redis_client.rpush(self.queue, json.dumps(task_with_serializable_params))
+        self.redis_client.rpush(
+            self.lane_key(task["priority"]), json.dumps(task_with_serializable_params)
+        )
+
+    def dequeue(self, timeout: float = 1) -> Optional[Dict]:
+        processing_key = self.processing_key()
+        raw = None
+        for priority in PRIORITIES:
+            raw = self.redis_client.lmove(
+                self.lane_key(priority), processing_key, "LEFT", "LEFT"
+            )
+            if raw is not None:
+                break
+        if raw is None:
+            # block on the normal lane, the other lanes are checked again
+            # after the timeout
+            raw = self.redis_client.blmove(
+                self.lane_key(PRIORITY_NORMAL),
+                processing_key,
+                max(1, int(timeout)),
+                "LEFT",
+                "LEFT",
+            )
+        if raw is None:
+            return None
 
-    def dequeue(self):
-        task_json = self.redis_client.lpop(self.queue)
-        if task_json:
-            task_info = json.loads(task_json)
+        try:
+            task_info = json.loads(raw)
             # 将函数名称转换回函数对象
             task_info["func"] = FUNC_MAP[task_info["func"]]
+            task_info.setdefault("priority", PRIORITY_NORMAL)
+            task_info.setdefault("enqueued_at", time.time())
 
             if "params" in task_info["kwargs"] and isinstance(
                 task_info["kwargs"]["params"], dict
             ):
-                task_info["kwargs"]["params"] = VideoParams(
+                params_type = PARAMS_TYPES.get(task_info.get("params_type"), VideoParams)
+                task_info["kwargs"]["params"] = params_type(
                     **task_info["kwargs"]["params"]
                 )
+        except Exception as e:
+            logger.error(f"invalid task, moved to {self.dead_key}: {str(e)}")
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.lrem(processing_key, 1, raw)
+            pipe.rpush(self.dead_key, raw)
+            pipe.execute()
+            return None
+
+        task_info["_raw"] = raw
+        task_info["_processing_key"] = processing_key
+        return task_info
+
+    def task_done(self, task_info: Dict, succeeded: bool = True):
+        try:
+            self.redis_client.lrem(task_info["_processing_key"], 1, task_info["_raw"])
+        except Exception as e:
+            logger.error(f"failed to acknowledge task: {str(e)}")
+        super().task_done(task_info, succeeded)
 
-            return task_info
-        return None
+    def queue_sizes(self) -> Dict[str, int]:
+        pipe = self.redis_client.pipeline(transaction=False)
+        for priority in PRIORITIES:
+            pipe.llen(self.lane_key(priority))
+        return dict(zip(PRIORITIES, pipe.execute()))
 
-    def is_queue_empty(self):
-        return self.redis_client.llen(self.queue) == 0
+    def metrics(self) -> Dict:
+        metrics = super().metrics()
+        metrics["node_id"] = self.node_id
+        metrics["nodes"] = self.redis_client.scard(self.nodes_key)
+        metrics["dead"] = self.redis_client.llen(self.dead_key)
+        return metrics
@@ -1,6 +1,8 @@
 from fastapi import Request
 from app.controllers.v1.base import new_router
 from app.models.schema import (
+    VideoScriptAndTermsRequest,
+    VideoScriptAndTermsResponse,
     VideoScriptResponse,
     VideoScriptRequest,
     VideoTermsResponse,
@@ -19,11 +21,12 @@ router = new_router()
     response_model=VideoScriptResponse,
     summary="Create a script for the video",
 )
-def generate_video_script(request: Request, body: VideoScriptRequest):
-    video_script = llm.generate_script(
+async def generate_video_script(request: Request, body: VideoScriptRequest):
+    video_script = await llm.agenerate_script(
         video_subject=body.video_subject,
         language=body.video_language,
         paragraph_number=body.paragraph_number,
+        use_cache=body.use_llm_cache,
     )
     response = {"video_script": video_script}
     return utils.get_response(200, response)
@@ -34,11 +37,31 @@ def generate_video_script(request: Request, body: VideoScriptRequest):
     response_model=VideoTermsResponse,
     summary="Generate video terms based on the video script",
 )
-def generate_video_terms(request: Request, body: VideoTermsRequest):
-    video_terms = llm.generate_terms(
+async def generate_video_terms(request: Request, body: VideoTermsRequest):
+    video_terms = await llm.agenerate_terms(
         video_subject=body.video_subject,
         video_script=body.video_script,
         amount=body.amount,
+        use_cache=body.use_llm_cache,
     )
     response = {"video_terms": video_terms}
     return utils.get_response(200, response)
+
+
+@router.post(
+    "/scripts-with-terms",
+    response_model=VideoScriptAndTermsResponse,
+    summary="Create a script for the video and its terms in a single llm request",
+)
+async def generate_video_script_and_terms(
+    request: Request, body: VideoScriptAndTermsRequest
+):
+    video_script, video_terms = await llm.agenerate_script_and_terms(
+        video_subject=body.video_subject,
+        language=body.video_language,
+        paragraph_number=body.paragraph_number,
+        amount=body.amount,
+        use_cache=body.use_llm_cache,
+    )
+    response = {"video_script": video_script, "video_terms": video_terms}
+    return utils.get_response(200, response)
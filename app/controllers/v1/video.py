@@ -1,16 +1,30 @@
 import glob
+import json
 import os
-import pathlib
 import shutil
-from typing import Union
-
-from fastapi import BackgroundTasks, Depends, Path, Request, UploadFile
+from typing import List, Optional, Union
+
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    Path,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+)
 from fastapi.params import File
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import StreamingResponse
 from loguru import logger
+from starlette.concurrency import run_in_threadpool
 
 from app.config import config
 from app.controllers import base
+from app.controllers.manager.base_manager import (
+    PRIORITIES,
+    PRIORITY_HIGH,
+    PRIORITY_NORMAL,
+)
 from app.controllers.manager.memory_manager import InMemoryTaskManager
 from app.controllers.manager.redis_manager import RedisTaskManager
 from app.controllers.v1.base import new_router
@@ -20,15 +34,20 @@ from app.models.schema import (
     BgmRetrieveResponse,
     BgmUploadResponse,
     SubtitleRequest,
+    TaskBatchQueryResponse,
+    TaskBatchResponse,
     TaskDeletionResponse,
     TaskQueryRequest,
     TaskQueryResponse,
     TaskResponse,
     TaskVideoRequest,
 )
+from app.models import const
+from app.services import checkpoint, llm, material
 from app.services import state as sm
 from app.services import task as tm
-from app.utils import utils
+from app.utils import file_response, utils
+from app.utils.file_response import RangeFileResponse
 
 # 认证依赖项
 # router = new_router(dependencies=[Depends(base.verify_token)])
@@ -40,42 +59,122 @@ _redis_port = config.app.get("redis_port", 6379)
 _redis_db = config.app.get("redis_db", 0)
 _redis_password = config.app.get("redis_password", None)
 _max_concurrent_tasks = config.app.get("max_concurrent_tasks", 5)
+# with redis, the api can only enqueue the tasks and leave them to worker.py nodes
+_run_task_workers = config.app.get("run_task_workers", True)
+# max number of tasks submitted or queried by a batch request
+_max_batch_size = config.app.get("max_batch_size", 100)
 
 redis_url = f"redis://:{_redis_password}@{_redis_host}:{_redis_port}/{_redis_db}"
 # 根据配置选择合适的任务管理器
 if _enable_redis:
     task_manager = RedisTaskManager(
-        max_concurrent_tasks=_max_concurrent_tasks, redis_url=redis_url
+        max_concurrent_tasks=_max_concurrent_tasks,
+        redis_url=redis_url,
+        start_workers=_run_task_workers,
     )
 else:
     task_manager = InMemoryTaskManager(max_concurrent_tasks=_max_concurrent_tasks)
 
 
+_priority_query = Query(
+    default=None,
+    description="Queue lane of the task: high, normal or low. "
+    "Audio and subtitle tasks default to high, videos to normal",
+)
+
+
 @router.post("/videos", response_model=TaskResponse, summary="Generate a short video")
 def create_video(
-    background_tasks: BackgroundTasks, request: Request, body: TaskVideoRequest
+    background_tasks: BackgroundTasks,
+    request: Request,
+    body: TaskVideoRequest,
+    priority: Optional[str] = _priority_query,
 ):
-    return create_task(request, body, stop_at="video")
+    return create_task(request, body, stop_at="video", priority=priority)
 
 
 @router.post("/subtitle", response_model=TaskResponse, summary="Generate subtitle only")
 def create_subtitle(
-    background_tasks: BackgroundTasks, request: Request, body: SubtitleRequest
+    background_tasks: BackgroundTasks,
+    request: Request,
+    body: SubtitleRequest,
+    priority: Optional[str] = _priority_query,
 ):
-    return create_task(request, body, stop_at="subtitle")
+    return create_task(request, body, stop_at="subtitle", priority=priority)
 
 
 @router.post("/audio", response_model=TaskResponse, summary="Generate audio only")
 def create_audio(
-    background_tasks: BackgroundTasks, request: Request, body: AudioRequest
+    background_tasks: BackgroundTasks,
+    request: Request,
+    body: AudioRequest,
+    priority: Optional[str] = _priority_query,
+):
+    return create_task(request, body, stop_at="audio", priority=priority)
+
+
+@router.post(
+    "/videos:batch",
+    response_model=TaskBatchResponse,
+    summary="Generate many short videos in one request",
+)
+def create_videos(
+    request: Request,
+    body: List[TaskVideoRequest],
+    priority: Optional[str] = _priority_query,
+):
+    request_id = base.get_task_id(request)
+    try:
+        if not body:
+            raise ValueError("no video to generate")
+        if len(body) > _max_batch_size:
+            raise ValueError(f"too many videos: {len(body)}, max: {_max_batch_size}")
+        priority = _task_priority("video", priority)
+    except ValueError as e:
+        raise HttpException(
+            task_id="", status_code=400, message=f"{request_id}: {str(e)}"
+        )
+
+    tasks = []
+    for video in body:
+        task_id = utils.get_uuid()
+        _submit_task(task_id, video, stop_at="video", priority=priority)
+        tasks.append({"task_id": task_id})
+    logger.success(f"{len(tasks)} tasks created: {utils.to_json(tasks)}")
+    return utils.get_response(200, {"tasks": tasks, "request_id": request_id})
+
+
+def _task_priority(stop_at: str, priority: str = None) -> str:
+    if not priority:
+        # short tasks should not wait behind the renders
+        priority = PRIORITY_NORMAL if stop_at == "video" else PRIORITY_HIGH
+    if priority not in PRIORITIES:
+        raise ValueError(f"invalid priority: {priority}, must be one of {PRIORITIES}")
+    return priority
+
+
+def _submit_task(
+    task_id: str,
+    body: Union[TaskVideoRequest, SubtitleRequest, AudioRequest],
+    stop_at: str,
+    priority: str,
 ):
-    return create_task(request, body, stop_at="audio")
+    sm.state.update_task(task_id)
+    if config.app.get("resume_tasks", True):
+        # a retried task keeps its priority
+        checkpoint.Checkpoints(task_id).save_task(
+            body.model_dump(mode="json"), stop_at, type(body).__name__, priority
+        )
+    task_manager.add_task(
+        tm.start, task_id=task_id, params=body, stop_at=stop_at, priority=priority
+    )
 
 
 def create_task(
     request: Request,
     body: Union[TaskVideoRequest, SubtitleRequest, AudioRequest],
     stop_at: str,
+    priority: str = None,
 ):
     task_id = utils.get_uuid()
     request_id = base.get_task_id(request)
@@ -85,8 +184,8 @@ def create_task(
             "request_id": request_id,
             "params": body.model_dump(),
         }
-        sm.state.update_task(task_id)
-        task_manager.add_task(tm.start, task_id=task_id, params=body, stop_at=stop_at)
+        priority = _task_priority(stop_at, priority)
+        _submit_task(task_id, body, stop_at=stop_at, priority=priority)
         logger.success(f"Task created: {utils.to_json(task)}")
         return utils.get_response(200, task)
     except ValueError as e:
@@ -95,51 +194,201 @@ def create_task(
         )
 
 
+@router.get("/queue/metrics", summary="Query the task queue metrics")
+def get_queue_metrics(request: Request):
+    metrics = task_manager.metrics()
+    search_cache = material.get_search_cache()
+    if search_cache:
+        metrics["search_cache"] = search_cache.stats()
+    response_cache = llm.get_response_cache()
+    if response_cache:
+        metrics["llm_cache"] = response_cache.stats()
+    return utils.get_response(200, metrics)
+
+
+def _endpoint(request: Request) -> str:
+    endpoint = config.app.get("endpoint", "")
+    if not endpoint:
+        endpoint = str(request.base_url)
+    return endpoint.rstrip("/")
+
+
+def _task_with_uris(task: dict, endpoint: str) -> dict:
+    """
+    prefix the uris of the videos with the endpoint, the videos of the tasks
+    completed by older versions are still stored as paths
+    """
+
+    def file_to_uri(file):
+        if file.startswith(("http://", "https://")):
+            return file
+        if os.path.isabs(file):
+            file = utils.task_file_uri(file)
+        return f"{endpoint}/{file}"
+
+    task = dict(task)
+    for key in ("videos", "combined_videos"):
+        if key in task:
+            task[key] = [file_to_uri(v) for v in task[key]]
+    return task
+
+
+def _task_etag(task_id: str, version: int) -> str:
+    return f'W/"{task_id}-{version}"'
+
+
+@router.get(
+    "/tasks",
+    response_model=TaskBatchQueryResponse,
+    summary="Query the status of many tasks",
+)
+def get_tasks(
+    request: Request,
+    ids: str = Query(..., description="Comma separated task IDs"),
+):
+    request_id = base.get_task_id(request)
+    task_ids = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if not task_ids or len(task_ids) > _max_batch_size:
+        raise HttpException(
+            task_id="",
+            status_code=400,
+            message=f"{request_id}: between 1 and {_max_batch_size} task ids are required",
+        )
+
+    endpoint = _endpoint(request)
+    tasks = {
+        task_id: _task_with_uris(task, endpoint) if task else None
+        for task_id, task in sm.state.get_tasks(task_ids).items()
+    }
+    return utils.get_response(200, {"tasks": tasks})
+
+
 @router.get(
     "/tasks/{task_id}", response_model=TaskQueryResponse, summary="Query task status"
 )
 def get_task(
     request: Request,
+    response: Response,
     task_id: str = Path(..., description="Task ID"),
     query: TaskQueryRequest = Depends(),
 ):
-    endpoint = config.app.get("endpoint", "")
-    if not endpoint:
-        endpoint = str(request.base_url)
-    endpoint = endpoint.rstrip("/")
-
+    """
+    the response has an etag that changes with each update of the task, a
+    query with `If-None-Match` gets a 304 while the task did not change
+    """
     request_id = base.get_task_id(request)
-    task = sm.state.get_task(task_id)
+    task, version = sm.state.get_versioned_task(task_id)
     if task:
-        task_dir = utils.task_dir()
-
-        def file_to_uri(file):
-            if not file.startswith(endpoint):
-                _uri_path = v.replace(task_dir, "tasks").replace("\\", "/")
-                _uri_path = f"{endpoint}/{_uri_path}"
-            else:
-                _uri_path = file
-            return _uri_path
-
-        if "videos" in task:
-            videos = task["videos"]
-            urls = []
-            for v in videos:
-                urls.append(file_to_uri(v))
-            task["videos"] = urls
-        if "combined_videos" in task:
-            combined_videos = task["combined_videos"]
-            urls = []
-            for v in combined_videos:
-                urls.append(file_to_uri(v))
-            task["combined_videos"] = urls
-        return utils.get_response(200, task)
+        etag = _task_etag(task_id, version)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        response.headers.update(headers)
+        return utils.get_response(200, _task_with_uris(task, _endpoint(request)))
 
     raise HttpException(
         task_id=task_id, status_code=404, message=f"{request_id}: task not found"
     )
 
 
+@router.get(
+    "/tasks/{task_id}/events",
+    summary="Stream the task status with Server-Sent Events",
+)
+async def stream_task_events(
+    request: Request, task_id: str = Path(..., description="Task ID")
+):
+    """
+    the first `state` event is the current status of the task, the next ones
+    carry the fields of each update (state, progress, stage, and the results
+    once the task is complete). the stream ends when the task is complete or
+    failed.
+    """
+    request_id = base.get_task_id(request)
+    if not await run_in_threadpool(sm.state.get_task, task_id):
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+
+    endpoint = _endpoint(request)
+    keepalive = config.app.get("task_events_keepalive", 15)
+
+    def _format(event: dict) -> str:
+        data = json.dumps(_task_with_uris(event, endpoint), ensure_ascii=False, default=str)
+        return f"event: state\ndata: {data}\n\n"
+
+    async def event_stream():
+        events = sm.state.listen(task_id, keepalive)
+        subscribed = False
+        try:
+            async for event in events:
+                if event is None:
+                    if subscribed:
+                        yield ": keepalive\n\n"
+                        continue
+                    # the snapshot is read once subscribed, no update is missed
+                    subscribed = True
+                    event = await run_in_threadpool(sm.state.get_task, task_id)
+                    if not event:
+                        return
+
+                yield _format(event)
+                if event.get("state") in (
+                    const.TASK_STATE_COMPLETE,
+                    const.TASK_STATE_FAILED,
+                ):
+                    return
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post(
+    "/tasks/{task_id}/retry",
+    response_model=TaskResponse,
+    summary="Retry a task, the completed stages are not run again",
+)
+def retry_task(request: Request, task_id: str = Path(..., description="Task ID")):
+    request_id = base.get_task_id(request)
+    task_info = {}
+    if checkpoint.exists(task_id):
+        task_info = checkpoint.Checkpoints(task_id).load_task()
+    if not task_info:
+        raise HttpException(
+            task_id=task_id, status_code=404, message=f"{request_id}: task not found"
+        )
+
+    task = sm.state.get_task(task_id)
+    if task and task.get("state") == const.TASK_STATE_PROCESSING:
+        raise HttpException(
+            task_id=task_id,
+            status_code=400,
+            message=f"{request_id}: task is still processing",
+        )
+
+    request_types = {
+        "SubtitleRequest": SubtitleRequest,
+        "AudioRequest": AudioRequest,
+    }
+    request_type = request_types.get(task_info.get("request_type"), TaskVideoRequest)
+    body = request_type(**task_info.get("params", {}))
+    stop_at = task_info.get("stop_at", "video")
+    priority = _task_priority(stop_at, task_info.get("priority"))
+    sm.state.update_task(task_id)
+    task_manager.add_task(
+        tm.start, task_id=task_id, params=body, stop_at=stop_at, priority=priority
+    )
+    logger.success(f"Task retried: {task_id}, stop_at: {stop_at}, priority: {priority}")
+    return utils.get_response(200, {"task_id": task_id, "request_id": request_id})
+
+
 @router.delete(
     "/tasks/{task_id}",
     response_model=TaskDeletionResponse,
@@ -207,65 +456,38 @@ def upload_bgm_file(request: Request, file: UploadFile = File(...)):
     )
 
 
-@router.get("/stream/{file_path:path}")
-async def stream_video(request: Request, file_path: str):
-    tasks_dir = utils.task_dir()
-    video_path = os.path.join(tasks_dir, file_path)
-    range_header = request.headers.get("Range")
-    video_size = os.path.getsize(video_path)
-    start, end = 0, video_size - 1
-
-    length = video_size
-    if range_header:
-        range_ = range_header.split("bytes=")[1]
-        start, end = [int(part) if part else None for part in range_.split("-")]
-        if start is None:
-            start = video_size - end
-            end = video_size - 1
-        if end is None:
-            end = video_size - 1
-        length = end - start + 1
-
-    def file_iterator(file_path, offset=0, bytes_to_read=None):
-        with open(file_path, "rb") as f:
-            f.seek(offset, os.SEEK_SET)
-            remaining = bytes_to_read or video_size
-            while remaining > 0:
-                bytes_to_read = min(4096, remaining)
-                data = f.read(bytes_to_read)
-                if not data:
-                    break
-                remaining -= len(data)
-                yield data
-
-    response = StreamingResponse(
-        file_iterator(video_path, start, length), media_type="video/mp4"
+def _task_file_response(
+    request: Request, file_path: str, attachment: bool = False
+) -> RangeFileResponse:
+    request_id = base.get_task_id(request)
+    # the path can not leave the tasks directory (../ or symlinks)
+    real_path = file_response.confine_path(utils.task_dir(), file_path)
+    if not real_path:
+        raise HttpException(
+            task_id="", status_code=404, message=f"{request_id}: file not found"
+        )
+    return RangeFileResponse(
+        real_path,
+        request.headers,
+        filename=os.path.basename(real_path),
+        attachment=attachment,
     )
-    response.headers["Content-Range"] = f"bytes {start}-{end}/{video_size}"
-    response.headers["Accept-Ranges"] = "bytes"
-    response.headers["Content-Length"] = str(length)
-    response.status_code = 206  # Partial Content
 
-    return response
+
+@router.get("/stream/{file_path:path}")
+async def stream_video(request: Request, file_path: str):
+    """
+    stream a video of a task, with support for Range, If-Range and ETag
+    """
+    return _task_file_response(request, file_path)
 
 
 @router.get("/download/{file_path:path}")
-async def download_video(_: Request, file_path: str):
+async def download_video(request: Request, file_path: str):
     """
     download video
-    :param _: Request request
+    :param request: Request request
     :param file_path: video file path, eg: /cd1727ed-3473-42a2-a7da-4faafafec72b/final-1.mp4
     :return: video file
     """
-    tasks_dir = utils.task_dir()
-    video_path = os.path.join(tasks_dir, file_path)
-    file_path = pathlib.Path(video_path)
-    filename = file_path.stem
-    extension = file_path.suffix
-    headers = {"Content-Disposition": f"attachment; filename={filename}{extension}"}
-    return FileResponse(
-        path=video_path,
-        headers=headers,
-        filename=f"{filename}{extension}",
-        media_type=f"video/{extension[1:]}",
-    )
+    return _task_file_response(request, file_path, attachment=True)
@@ -17,6 +17,10 @@ PUNCTUATIONS = [
     "...",
 ]
 
+# punctuations ending a sentence, a streamed script is sent to the tts
+# sentence by sentence
+SENTENCE_PUNCTUATIONS = ["?", ".", ";", "!", "…", "？", "。", "；", "！"]
+
 TASK_STATE_FAILED = -1
 TASK_STATE_COMPLETE = 1
 TASK_STATE_PROCESSING = 4
@@ -104,6 +104,7 @@ class VideoParams(BaseModel):
     video_concat_mode: Optional[VideoConcatMode] = VideoConcatMode.random.value
     video_clip_duration: Optional[int] = 5
     video_count: Optional[int] = 1
+    combined_video_enabled: Optional[bool] = False  # 是否保留不含字幕和音频的拼接视频
 
     video_source: Optional[str] = "pexels"
     video_materials: Optional[List[MaterialInfo]] = None  # 用于生成视频的素材
@@ -129,6 +130,7 @@ class VideoParams(BaseModel):
     stroke_width: float = 1.5
     n_threads: Optional[int] = 2
     paragraph_number: Optional[int] = 1
+    use_llm_cache: Optional[bool] = True  # 是否使用缓存的 llm 回复
 
 
 class SubtitleRequest(BaseModel):
@@ -175,6 +177,7 @@ class VideoScriptParams:
     video_subject: Optional[str] = "春天的花海"
     video_language: Optional[str] = ""
     paragraph_number: Optional[int] = 1
+    use_llm_cache: Optional[bool] = True
 
 
 class VideoTermsParams:
@@ -191,6 +194,24 @@ class VideoTermsParams:
         "春天的花海，如诗如画般展现在眼前。万物复苏的季节里，大地披上了一袭绚丽多彩的盛装。金黄的迎春、粉嫩的樱花、洁白的梨花、艳丽的郁金香……"
     )
     amount: Optional[int] = 5
+    use_llm_cache: Optional[bool] = True
+
+
+class VideoScriptAndTermsParams:
+    """
+    {
+      "video_subject": "春天的花海",
+      "video_language": "",
+      "paragraph_number": 1,
+      "amount": 5
+    }
+    """
+
+    video_subject: Optional[str] = "春天的花海"
+    video_language: Optional[str] = ""
+    paragraph_number: Optional[int] = 1
+    amount: Optional[int] = 5
+    use_llm_cache: Optional[bool] = True
 
 
 class BaseResponse(BaseModel):
@@ -215,6 +236,10 @@ class VideoTermsRequest(VideoTermsParams, BaseModel):
     pass
 
 
+class VideoScriptAndTermsRequest(VideoScriptAndTermsParams, BaseModel):
+    pass
+
+
 ######################################################################################################
 ######################################################################################################
 ######################################################################################################
@@ -255,6 +280,48 @@ class TaskQueryResponse(BaseResponse):
         }
 
 
+class TaskBatchResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "tasks": [
+                        {"task_id": "6c85c8cc-a77a-42b9-bc30-947815aa0558"},
+                        {"task_id": "2f1b6a0e-5a1e-4d0c-9d8e-3c2f7f8f3a11"},
+                    ]
+                },
+            },
+        }
+
+
+class TaskBatchQueryResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "tasks": {
+                        "6c85c8cc-a77a-42b9-bc30-947815aa0558": {
+                            "state": 1,
+                            "progress": 100,
+                            "videos": [
+                                "http://127.0.0.1:8080/tasks/6c85c8cc-a77a-42b9-bc30-947815aa0558/final-1.mp4"
+                            ],
+                        },
+                        "2f1b6a0e-5a1e-4d0c-9d8e-3c2f7f8f3a11": {
+                            "state": 4,
+                            "progress": 35,
+                        },
+                        "unknown-task-id": None,
+                    }
+                },
+            },
+        }
+
+
 class TaskDeletionResponse(BaseResponse):
     class Config:
         json_schema_extra = {
@@ -299,6 +366,20 @@ class VideoTermsResponse(BaseResponse):
         }
 
 
+class VideoScriptAndTermsResponse(BaseResponse):
+    class Config:
+        json_schema_extra = {
+            "example": {
+                "status": 200,
+                "message": "success",
+                "data": {
+                    "video_script": "春天的花海，是大自然的一幅美丽画卷。在这个季节里，大地复苏，万物生长，花朵争相绽放，形成了一片五彩斑斓的花海...",
+                    "video_terms": ["spring flowers", "flower field"],
+                },
+            },
+        }
+
+
 class BgmRetrieveResponse(BaseResponse):
     class Config:
         json_schema_extra = {
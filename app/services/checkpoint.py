@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+from app.utils import utils
+
+_CHECKPOINT_FILE = "checkpoints.json"
+
+
+def hash_value(value: Any) -> str:
+    data = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+
+class Checkpoints:
+    """
+    the outputs of the completed stages of a task, stored in the task
+    directory with the hash of the stage inputs (params and outputs of the
+    stages it depends on).
+
+    a stage whose input hash did not change is not run again, so a retried
+    task resumes at the first stage that is missing or invalid.
+    """
+
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        self.checkpoint_file = os.path.join(utils.task_dir(task_id), _CHECKPOINT_FILE)
+        self._lock = threading.Lock()
+        self._data = self._read()
+
+    def _read(self) -> Dict:
+        if not os.path.isfile(self.checkpoint_file):
+            return {"task": {}, "stages": {}}
+        try:
+            with open(self.checkpoint_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            data.setdefault("task", {})
+            data.setdefault("stages", {})
+            return data
+        except Exception as e:
+            logger.warning(f"invalid checkpoint file: {self.checkpoint_file} => {str(e)}")
+            return {"task": {}, "stages": {}}
+
+    def _write(self):
+        temp_file = f"{self.checkpoint_file}.{utils.get_uuid(True)}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False, indent=4, default=str)
+        os.replace(temp_file, self.checkpoint_file)
+
+    def get(self, stage: str, input_hash: str) -> Optional[Any]:
+        """
+        return the stored output of the stage if its inputs did not change
+        """
+        with self._lock:
+            checkpoint = self._data["stages"].get(stage)
+        if not checkpoint or checkpoint.get("input_hash") != input_hash:
+            return None
+        return checkpoint.get("output")
+
+    def save(self, stage: str, input_hash: str, output: Any):
+        with self._lock:
+            self._data["stages"][stage] = {
+                "input_hash": input_hash,
+                "output_hash": hash_value(output),
+                "output": output,
+                "created_at": time.time(),
+            }
+            self._write()
+
+    def save_task(
+        self, params: Dict, stop_at: str, request_type: str = "", priority: str = ""
+    ):
+        """
+        remember how the task was submitted, so that it can be retried. the
+        priority is only known by the api, it is kept when the task is saved
+        again without it
+        """
+        with self._lock:
+            priority = priority or self._data["task"].get("priority", "")
+            self._data["task"] = {
+                "params": params,
+                "stop_at": stop_at,
+                "request_type": request_type,
+                "priority": priority,
+            }
+            self._write()
+
+    def load_task(self) -> Dict:
+        with self._lock:
+            return dict(self._data.get("task") or {})
+
+
+def exists(task_id: str) -> bool:
+    return os.path.isfile(os.path.join(utils.task_dir(), task_id, _CHECKPOINT_FILE))
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import threading
+from typing import List, Tuple
+
+from loguru import logger
+
+from app.config import config
+from app.models.schema import VideoAspect
+from app.services import material_store
+from app.utils import ffmpeg, utils
+from app.utils.cache import LruCache
+
+# every normalized clip has a keyframe each second, so clips cut on whole
+# seconds (video_clip_duration is an int) can be concatenated with stream copy.
+# there are no b-frames, the frames before a cut point would be copied too and
+# break the timestamps of the concatenated video
+_FPS = 30
+_KEYFRAME_INTERVAL = 1
+# part of the name of the normalized clips, bumped when their encoding changes
+# so the clips of the older versions are no longer used
+_VERSION = 2
+
+# md5 of the materials by path, size and mtime
+_hash_cache = LruCache(max_entries=4096)
+# a fixed set of locks shared by the keys, a clip is normalized once even
+# when several tasks use the same material
+_locks = [threading.Lock() for _ in range(64)]
+
+
+def is_enabled() -> bool:
+    return config.app.get("normalize_materials", True)
+
+
+def store_dir() -> str:
+    return utils.storage_dir("normalized_videos", create=True)
+
+
+def file_hash(file_path: str) -> str:
+    stat = os.stat(file_path)
+    cache_key = f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    digest = _hash_cache.get(cache_key)
+    if digest is not None:
+        return digest
+
+    h = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _hash_cache.set(cache_key, digest)
+    return digest
+
+
+def _key_lock(key: str) -> threading.Lock:
+    return _locks[hash(key) % len(_locks)]
+
+
+def is_normalized(video_path: str) -> bool:
+    return os.path.dirname(os.path.abspath(video_path)) == os.path.abspath(store_dir())
+
+
+def normalize_video(
+    video_path: str, video_aspect: VideoAspect = VideoAspect.portrait
+) -> str:
+    """
+    transcode a material once to the target resolution/fps/codec of the aspect
+    and return the path of the normalized clip, later calls hit the store
+    """
+    if is_normalized(video_path):
+        return video_path
+
+    aspect = VideoAspect(video_aspect)
+    video_width, video_height = aspect.to_resolution()
+    key = f"{file_hash(video_path)}-{video_width}x{video_height}-v{_VERSION}"
+    normalized_name = f"{key}.mp4"
+    store = material_store.get_store(
+        store_dir(), max_size_mb=config.app.get("normalized_cache_max_size_mb", 0)
+    )
+
+    with _key_lock(key):
+        normalized_path = store.lookup(normalized_name)
+        if normalized_path:
+            logger.debug(f"normalized clip hit: {video_path} => {normalized_path}")
+            return normalized_path
+
+        normalized_path = store.path(normalized_name)
+        logger.info(f"normalizing video: {video_path} => {normalized_path}")
+        temp_path = store.temp_path(normalized_name)
+        try:
+            ffmpeg.run(
+                [
+                    "-i",
+                    video_path,
+                    "-an",
+                    "-vf",
+                    f"scale={video_width}:{video_height}:force_original_aspect_ratio=decrease,"
+                    f"pad={video_width}:{video_height}:(ow-iw)/2:(oh-ih)/2:color=black,"
+                    f"setsar=1,fps={_FPS},format=yuv420p",
+                    "-c:v",
+                    "libx264",
+                    "-preset",
+                    "veryfast",
+                    "-crf",
+                    "18",
+                    "-bf",
+                    "0",
+                    "-g",
+                    str(_FPS * _KEYFRAME_INTERVAL),
+                    "-keyint_min",
+                    str(_FPS * _KEYFRAME_INTERVAL),
+                    "-sc_threshold",
+                    "0",
+                    "-force_key_frames",
+                    f"expr:gte(t,n_forced*{_KEYFRAME_INTERVAL})",
+                    "-movflags",
+                    "+faststart",
+                    "-f",
+                    "mp4",
+                    temp_path,
+                ]
+            )
+            store.commit(temp_path, normalized_name, source=video_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    return normalized_path
+
+
+def normalize_videos(
+    video_paths: List[str], video_aspect: VideoAspect = VideoAspect.portrait
+) -> List[str]:
+    normalized_paths = []
+    for video_path in video_paths:
+        try:
+            normalized_paths.append(normalize_video(video_path, video_aspect))
+        except Exception as e:
+            logger.warning(f"failed to normalize video: {video_path} => {str(e)}")
+            normalized_paths.append(video_path)
+    return normalized_paths
+
+
+def write_concat_list(clips: List[Tuple[str, float, float]], list_file: str) -> str:
+    """
+    write a concat demuxer list, every clip is (video path, start time, end time).
+    the cut points are moved to the nearest frame, so the frames of the
+    concatenated clips stay evenly spaced
+    """
+    lines = ["ffconcat version 1.0"]
+    for video_path, start_time, end_time in clips:
+        escaped = os.path.abspath(video_path).replace("'", "'\\''")
+        lines.append(f"file '{escaped}'")
+        lines.append(f"inpoint {round(start_time * _FPS) / _FPS:.3f}")
+        lines.append(f"outpoint {round(end_time * _FPS) / _FPS:.3f}")
+    with open(list_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return list_file
+
+
+def concat_clips(clips: List[Tuple[str, float, float]], output_file: str) -> str:
+    """
+    concatenate normalized clips with stream copy, nothing is re-encoded
+    """
+    list_file = f"{output_file}.txt"
+    write_concat_list(clips, list_file)
+    try:
+        ffmpeg.run(
+            [
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                list_file,
+                "-c",
+                "copy",
+                "-an",
+                "-movflags",
+                "+faststart",
+                output_file,
+            ]
+        )
+    finally:
+        if os.path.exists(list_file):
+            os.remove(list_file)
+    return output_file
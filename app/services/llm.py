@@ -1,18 +1,221 @@
+import asyncio
+import hashlib
 import logging
 import re
 import json
-from typing import List
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from loguru import logger
-from openai import OpenAI
-from openai import AzureOpenAI
-from openai.types.chat import ChatCompletion
 
 from app.config import config
+from app.services import llm_gateway
+from app.utils import utils
+from app.utils.cache import LruCache, SqliteCache
 
+# attempts when the answer can not be parsed, the failed requests are
+# retried by the llm_gateway
 _max_retries = 5
+# attempts of the combined script and terms request before the fallback to
+# two requests
+_combined_max_retries = 2
+
+# providers with an openai compatible api, served by the async llm_gateway
+_GATEWAY_PROVIDERS = ("openai", "moonshot", "ollama", "oneapi", "azure", "deepseek")
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[LruCache]:
+    """
+    llm responses are cached in memory and on disk (shared by the api and
+    webui processes), set llm_cache_ttl = 0 to disable it
+    """
+    global _response_cache
+    ttl = config.app.get("llm_cache_ttl", 86400)
+    if not ttl:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = LruCache(
+                max_entries=config.app.get("llm_cache_memory_entries", 256),
+                ttl=ttl,
+                backend=SqliteCache(
+                    "llm",
+                    ttl=ttl,
+                    max_entries=config.app.get("llm_cache_max_entries", 5000),
+                ),
+            )
+        return _response_cache
+
+
+def _response_cache_key(prompt: str) -> str:
+    # the same prompt gets a different answer from another provider or model
+    llm_provider = config.app.get("llm_provider", "openai")
+    model_name = config.app.get(f"{llm_provider}_model_name", "")
+    base_url = config.app.get(f"{llm_provider}_base_url", "")
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return f"{llm_provider}:{model_name}:{base_url}:{prompt_hash}"
+
+
+class _CachedResponse(str):
+    """
+    a response read from the cache, it is not written again so that it still
+    expires after llm_cache_ttl
+    """
+
+
+def _get_cached_response(prompt: str) -> Optional[str]:
+    cache = get_response_cache()
+    if not cache:
+        return None
+    cache_key = _response_cache_key(prompt)
+    response = cache.get(cache_key)
+    if response is None:
+        return None
+    logger.debug(f"llm cache hit: {cache_key}")
+    return _CachedResponse(response)
+
+
+def _set_cached_response(prompt: str, response: str):
+    """
+    only the responses accepted by the caller are cached, an invalid
+    response is requested again on retry
+    """
+    cache = get_response_cache()
+    if cache and response and not isinstance(response, _CachedResponse):
+        cache.set(_response_cache_key(prompt), response)
+
+
+def _generate_response(prompt: str, use_cache: bool = True) -> str:
+    if use_cache:
+        response = _get_cached_response(prompt)
+        if response is not None:
+            return response
+    return _request_response(prompt)
+
+
+async def _agenerate_response(prompt: str, use_cache: bool = True) -> str:
+    if use_cache:
+        response = _get_cached_response(prompt)
+        if response is not None:
+            return response
+
+    llm_provider = config.app.get("llm_provider", "openai")
+    if llm_provider not in _GATEWAY_PROVIDERS:
+        # the sdk of these providers is blocking
+        return await asyncio.to_thread(_request_response, prompt)
+
+    logger.info(f"llm provider: {llm_provider}")
+    content = await llm_gateway.acomplete(_llm_settings(llm_provider), prompt)
+    return content.replace("\n", "")
+
 
+def _stream_response(prompt: str, use_cache: bool = True) -> Iterator[str]:
+    if use_cache:
+        response = _get_cached_response(prompt)
+        if response is not None:
+            yield response
+            return
+
+    llm_provider = config.app.get("llm_provider", "openai")
+    if llm_provider not in _GATEWAY_PROVIDERS:
+        # no streaming api, the answer comes in a single chunk
+        yield _request_response(prompt)
+        return
 
-def _generate_response(prompt: str) -> str:
+    logger.info(f"llm provider: {llm_provider}")
+    yield from llm_gateway.stream(_llm_settings(llm_provider), prompt)
+
+
+def _llm_settings(llm_provider: str) -> Dict:
+    api_version = ""  # for azure
+    secret_key = ""  # for ernie
+    account_id = ""  # for cloudflare
+    if llm_provider == "moonshot":
+        api_key = config.app.get("moonshot_api_key")
+        model_name = config.app.get("moonshot_model_name")
+        base_url = "https://api.moonshot.cn/v1"
+    elif llm_provider == "ollama":
+        # api_key = config.app.get("openai_api_key")
+        api_key = "ollama"  # any string works but you are required to have one
+        model_name = config.app.get("ollama_model_name")
+        base_url = config.app.get("ollama_base_url", "")
+        if not base_url:
+            base_url = "http://localhost:11434/v1"
+    elif llm_provider == "openai":
+        api_key = config.app.get("openai_api_key")
+        model_name = config.app.get("openai_model_name")
+        base_url = config.app.get("openai_base_url", "")
+        if not base_url:
+            base_url = "https://api.openai.com/v1"
+    elif llm_provider == "oneapi":
+        api_key = config.app.get("oneapi_api_key")
+        model_name = config.app.get("oneapi_model_name")
+        base_url = config.app.get("oneapi_base_url", "")
+    elif llm_provider == "azure":
+        api_key = config.app.get("azure_api_key")
+        model_name = config.app.get("azure_model_name")
+        base_url = config.app.get("azure_base_url", "")
+        api_version = config.app.get("azure_api_version", "2024-02-15-preview")
+    elif llm_provider == "gemini":
+        api_key = config.app.get("gemini_api_key")
+        model_name = config.app.get("gemini_model_name")
+        base_url = "***"
+    elif llm_provider == "qwen":
+        api_key = config.app.get("qwen_api_key")
+        model_name = config.app.get("qwen_model_name")
+        base_url = "***"
+    elif llm_provider == "cloudflare":
+        api_key = config.app.get("cloudflare_api_key")
+        model_name = config.app.get("cloudflare_model_name")
+        account_id = config.app.get("cloudflare_account_id")
+        base_url = "***"
+    elif llm_provider == "deepseek":
+        api_key = config.app.get("deepseek_api_key")
+        model_name = config.app.get("deepseek_model_name")
+        base_url = config.app.get("deepseek_base_url")
+        if not base_url:
+            base_url = "https://api.deepseek.com"
+    elif llm_provider == "ernie":
+        api_key = config.app.get("ernie_api_key")
+        secret_key = config.app.get("ernie_secret_key")
+        base_url = config.app.get("ernie_base_url")
+        model_name = "***"
+        if not secret_key:
+            raise ValueError(
+                f"{llm_provider}: secret_key is not set, please set it in the config.toml file."
+            )
+    else:
+        raise ValueError(
+            "llm_provider is not set, please set it in the config.toml file."
+        )
+
+    if not api_key:
+        raise ValueError(
+            f"{llm_provider}: api_key is not set, please set it in the config.toml file."
+        )
+    if not model_name:
+        raise ValueError(
+            f"{llm_provider}: model_name is not set, please set it in the config.toml file."
+        )
+    if not base_url:
+        raise ValueError(
+            f"{llm_provider}: base_url is not set, please set it in the config.toml file."
+        )
+
+    return {
+        "provider": llm_provider,
+        "api_key": api_key,
+        "model_name": model_name,
+        "base_url": base_url,
+        "api_version": api_version,
+        "secret_key": secret_key,
+        "account_id": account_id,
+    }
+
+
+def _request_response(prompt: str) -> str:
     content = ""
     llm_provider = config.app.get("llm_provider", "openai")
     logger.info(f"llm provider: {llm_provider}")
@@ -27,78 +230,12 @@ def _generate_response(prompt: str) -> str:
             messages=[{"role": "user", "content": prompt}],
         )
     else:
-        api_version = ""  # for azure
-        if llm_provider == "moonshot":
-            api_key = config.app.get("moonshot_api_key")
-            model_name = config.app.get("moonshot_model_name")
-            base_url = "https://api.moonshot.cn/v1"
-        elif llm_provider == "ollama":
-            # api_key = config.app.get("openai_api_key")
-            api_key = "ollama"  # any string works but you are required to have one
-            model_name = config.app.get("ollama_model_name")
-            base_url = config.app.get("ollama_base_url", "")
-            if not base_url:
-                base_url = "http://localhost:11434/v1"
-        elif llm_provider == "openai":
-            api_key = config.app.get("openai_api_key")
-            model_name = config.app.get("openai_model_name")
-            base_url = config.app.get("openai_base_url", "")
-            if not base_url:
-                base_url = "https://api.openai.com/v1"
-        elif llm_provider == "oneapi":
-            api_key = config.app.get("oneapi_api_key")
-            model_name = config.app.get("oneapi_model_name")
-            base_url = config.app.get("oneapi_base_url", "")
-        elif llm_provider == "azure":
-            api_key = config.app.get("azure_api_key")
-            model_name = config.app.get("azure_model_name")
-            base_url = config.app.get("azure_base_url", "")
-            api_version = config.app.get("azure_api_version", "2024-02-15-preview")
-        elif llm_provider == "gemini":
-            api_key = config.app.get("gemini_api_key")
-            model_name = config.app.get("gemini_model_name")
-            base_url = "***"
-        elif llm_provider == "qwen":
-            api_key = config.app.get("qwen_api_key")
-            model_name = config.app.get("qwen_model_name")
-            base_url = "***"
-        elif llm_provider == "cloudflare":
-            api_key = config.app.get("cloudflare_api_key")
-            model_name = config.app.get("cloudflare_model_name")
-            account_id = config.app.get("cloudflare_account_id")
-            base_url = "***"
-        elif llm_provider == "deepseek":
-            api_key = config.app.get("deepseek_api_key")
-            model_name = config.app.get("deepseek_model_name")
-            base_url = config.app.get("deepseek_base_url")
-            if not base_url:
-                base_url = "https://api.deepseek.com"
-        elif llm_provider == "ernie":
-            api_key = config.app.get("ernie_api_key")
-            secret_key = config.app.get("ernie_secret_key")
-            base_url = config.app.get("ernie_base_url")
-            model_name = "***"
-            if not secret_key:
-                raise ValueError(
-                    f"{llm_provider}: secret_key is not set, please set it in the config.toml file."
-                )
-        else:
-            raise ValueError(
-                "llm_provider is not set, please set it in the config.toml file."
-            )
-
-        if not api_key:
-            raise ValueError(
-                f"{llm_provider}: api_key is not set, please set it in the config.toml file."
-            )
-        if not model_name:
-            raise ValueError(
-                f"{llm_provider}: model_name is not set, please set it in the config.toml file."
-            )
-        if not base_url:
-            raise ValueError(
-                f"{llm_provider}: base_url is not set, please set it in the config.toml file."
-            )
+        settings = _llm_settings(llm_provider)
+        api_key = settings["api_key"]
+        model_name = settings["model_name"]
+        base_url = settings["base_url"]
+        secret_key = settings["secret_key"]
+        account_id = settings["account_id"]
 
         if llm_provider == "qwen":
             import dashscope
@@ -221,40 +358,13 @@ def _generate_response(prompt: str) -> str:
             ).json()
             return response.get("result")
 
-        if llm_provider == "azure":
-            client = AzureOpenAI(
-                api_key=api_key,
-                api_version=api_version,
-                azure_endpoint=base_url,
-            )
-        else:
-            client = OpenAI(
-                api_key=api_key,
-                base_url=base_url,
-            )
-
-        response = client.chat.completions.create(
-            model=model_name, messages=[{"role": "user", "content": prompt}]
-        )
-        if response:
-            if isinstance(response, ChatCompletion):
-                content = response.choices[0].message.content
-            else:
-                raise Exception(
-                    f'[{llm_provider}] returned an invalid response: "{response}", please check your network '
-                    f"connection and try again."
-                )
-        else:
-            raise Exception(
-                f"[{llm_provider}] returned an empty response, please check your network connection and try again."
-            )
+        # openai compatible apis
+        content = llm_gateway.complete(settings, prompt)
 
     return content.replace("\n", "")
 
 
-def generate_script(
-    video_subject: str, language: str = "", paragraph_number: int = 1
-) -> str:
+def _script_prompt(video_subject: str, language: str, paragraph_number: int) -> str:
     prompt = f"""
 # Role: Video Script Generator
 
@@ -277,55 +387,42 @@ Generate a script for a video, depending on the subject of the video.
 """.strip()
     if language:
         prompt += f"\n- language: {language}"
+    return prompt
 
-    final_script = ""
-    logger.info(f"subject: {video_subject}")
-
-    def format_response(response):
-        # Clean the script
-        # Remove asterisks, hashes
-        response = response.replace("*", "")
-        response = response.replace("#", "")
 
-        # Remove markdown syntax
-        response = re.sub(r"\[.*\]", "", response)
-        response = re.sub(r"\(.*\)", "", response)
+def _clean_script(text: str) -> str:
+    # Remove asterisks, hashes
+    text = text.replace("*", "")
+    text = text.replace("#", "")
 
-        # Split the script into paragraphs
-        paragraphs = response.split("\n\n")
+    # Remove markdown syntax
+    text = re.sub(r"\[.*\]", "", text)
+    text = re.sub(r"\(.*\)", "", text)
+    return text
 
-        # Select the specified number of paragraphs
-        selected_paragraphs = paragraphs[:paragraph_number]
 
-        # Join the selected paragraphs into a single string
-        return "\n\n".join(paragraphs)
-
-    for i in range(_max_retries):
-        try:
-            response = _generate_response(prompt=prompt)
-            if response:
-                final_script = format_response(response)
-            else:
-                logging.error("gpt returned an empty response")
+def _parse_script(response: str) -> str:
+    if not response:
+        logging.error("gpt returned an empty response")
+        return ""
 
-            # g4f may return an error message
-            if final_script and "当日额度已消耗完" in final_script:
-                raise ValueError(final_script)
+    # Clean the script
+    response = _clean_script(response)
 
-            if final_script:
-                break
-        except Exception as e:
-            logger.error(f"failed to generate script: {e}")
+    # Split the script into paragraphs
+    paragraphs = response.split("\n\n")
 
-        if i < _max_retries:
-            logger.warning(f"failed to generate video script, trying again... {i + 1}")
+    # Join the selected paragraphs into a single string
+    final_script = "\n\n".join(paragraphs)
 
-    logger.success(f"completed: \n{final_script}")
+    # g4f may return an error message
+    if final_script and "当日额度已消耗完" in final_script:
+        raise ValueError(final_script)
     return final_script.strip()
 
 
-def generate_terms(video_subject: str, video_script: str, amount: int = 5) -> List[str]:
-    prompt = f"""
+def _terms_prompt(video_subject: str, video_script: str, amount: int) -> str:
+    return f"""
 # Role: Video Search Terms Generator
 
 ## Goals:
@@ -351,40 +448,326 @@ Generate {amount} search terms for stock videos, depending on the subject of a v
 Please note that you must use English for generating video search terms; Chinese is not accepted.
 """.strip()
 
-    logger.info(f"subject: {video_subject}")
 
-    search_terms = []
-    response = ""
-    for i in range(_max_retries):
-        try:
-            response = _generate_response(prompt)
-            search_terms = json.loads(response)
-            if not isinstance(search_terms, list) or not all(
-                isinstance(term, str) for term in search_terms
-            ):
-                logger.error("response is not a list of strings.")
-                continue
+def _is_terms(value) -> bool:
+    return isinstance(value, list) and all(isinstance(term, str) for term in value)
 
+
+def _parse_terms(response: str) -> List[str]:
+    try:
+        search_terms = json.loads(response)
+        if _is_terms(search_terms):
+            return search_terms
+        logger.error("response is not a list of strings.")
+    except Exception as e:
+        logger.warning(f"failed to generate video terms: {str(e)}")
+
+    # the array may be surrounded by some text
+    match = re.search(r"\[.*]", response or "")
+    if match:
+        try:
+            search_terms = json.loads(match.group())
+            if _is_terms(search_terms):
+                return search_terms
         except Exception as e:
             logger.warning(f"failed to generate video terms: {str(e)}")
-            if response:
-                match = re.search(r"\[.*]", response)
-                if match:
-                    try:
-                        search_terms = json.loads(match.group())
-                    except Exception as e:
-                        logger.warning(f"failed to generate video terms: {str(e)}")
-                        pass
-
-        if search_terms and len(search_terms) > 0:
-            break
-        if i < _max_retries:
-            logger.warning(f"failed to generate video terms, trying again... {i + 1}")
+    return []
+
+
+def _script_and_terms_prompt(
+    video_subject: str, language: str, paragraph_number: int, amount: int
+) -> str:
+    prompt = f"""
+# Role: Video Script and Search Terms Generator
+
+## Goals:
+Generate a script for a video, depending on the subject of the video, and {amount} search terms for stock videos matching the script.
+
+## Constrains:
+1. return a json object with two keys: "script", the script as a string with the specified number of paragraphs, and "terms", the search terms as a json-array of strings.
+2. you must only return the json object. you must not return anything else, no markdown, no code block.
+3. do not under any circumstance reference this prompt in your response.
+4. get straight to the point, don't start with unnecessary things like, "welcome to this video".
+5. you must not include any type of markdown or formatting in the script, never use a title.
+6. do not include "voiceover", "narrator" or similar indicators of what should be spoken at the beginning of each paragraph or line.
+7. you must not mention the prompt, or anything about the script itself. also, never talk about the amount of paragraphs or lines.
+8. write the script in the same language as the video subject.
+9. each search term should consist of 1-3 words, always add the main subject of the video.
+10. the search terms must be related to the subject of the video, and must be in english only.
+
+## Output Example:
+{{"script": "the script of the video", "terms": ["search term 1", "search term 2", "search term 3"]}}
+
+# Initialization:
+- video subject: {video_subject}
+- number of paragraphs: {paragraph_number}
+""".strip()
+    if language:
+        prompt += f"\n- language: {language}"
+    return prompt
+
+
+def _parse_script_and_terms(response: str) -> Optional[Tuple[str, List[str]]]:
+    """
+    returns (script, terms), or None if the response is not a json object
+    with a script and a list of terms
+    """
+    try:
+        result = json.loads(response)
+    except Exception:
+        # the object may be surrounded by some text or a code block
+        match = re.search(r"\{.*\}", response or "")
+        if not match:
+            logger.warning("response is not a json object.")
+            return None
+        try:
+            result = json.loads(match.group())
+        except Exception as e:
+            logger.warning(f"failed to parse video script and terms: {str(e)}")
+            return None
+
+    if not isinstance(result, dict):
+        logger.warning("response is not a json object.")
+        return None
+    script = result.get("script")
+    terms = result.get("terms")
+    if not isinstance(script, str) or not _is_terms(terms) or not terms:
+        logger.warning("response has no script or no terms.")
+        return None
+
+    script = _parse_script(script)
+    terms = [term.strip() for term in terms if term.strip()]
+    if not script or not terms:
+        return None
+    return script, terms
+
+
+def _retried_by_gateway() -> bool:
+    """
+    the requests to the gateway providers are already retried, with backoff
+    and hedging, the other providers are only asked again by _generate
+    """
+    return config.app.get("llm_provider", "openai") in _GATEWAY_PROVIDERS
+
+
+def _generate(
+    prompt: str,
+    parse: Callable[[str], Any],
+    use_cache: bool,
+    name: str,
+    max_retries: int = _max_retries,
+):
+    """
+    ask the llm until `parse` accepts the response, the accepted response is
+    cached. a failed request is not sent again here when the llm_gateway
+    already retried it
+    """
+    for i in range(max_retries):
+        try:
+            response = _generate_response(prompt, use_cache=use_cache)
+        except Exception as e:
+            logger.error(f"failed to generate {name}: {e}")
+            if _retried_by_gateway():
+                return None
+            response = ""
+        try:
+            result = parse(response) if response else None
+            if result:
+                if use_cache:
+                    _set_cached_response(prompt, response)
+                return result
+        except Exception as e:
+            logger.error(f"failed to parse {name}: {e}")
+        logger.warning(f"failed to generate {name}, trying again... {i + 1}")
+    return None
+
+
+async def _agenerate(
+    prompt: str,
+    parse: Callable[[str], Any],
+    use_cache: bool,
+    name: str,
+    max_retries: int = _max_retries,
+):
+    """
+    async version of _generate, the event loop is not blocked while the llm
+    answers
+    """
+    for i in range(max_retries):
+        try:
+            response = await _agenerate_response(prompt, use_cache=use_cache)
+        except Exception as e:
+            logger.error(f"failed to generate {name}: {e}")
+            if _retried_by_gateway():
+                return None
+            response = ""
+        try:
+            result = parse(response) if response else None
+            if result:
+                if use_cache:
+                    _set_cached_response(prompt, response)
+                return result
+        except Exception as e:
+            logger.error(f"failed to parse {name}: {e}")
+        logger.warning(f"failed to generate {name}, trying again... {i + 1}")
+    return None
+
 
+def generate_script(
+    video_subject: str,
+    language: str = "",
+    paragraph_number: int = 1,
+    use_cache: bool = True,
+) -> str:
+    logger.info(f"subject: {video_subject}")
+    prompt = _script_prompt(video_subject, language, paragraph_number)
+    final_script = _generate(prompt, _parse_script, use_cache, "video script") or ""
+    logger.success(f"completed: \n{final_script}")
+    return final_script
+
+
+async def agenerate_script(
+    video_subject: str,
+    language: str = "",
+    paragraph_number: int = 1,
+    use_cache: bool = True,
+) -> str:
+    logger.info(f"subject: {video_subject}")
+    prompt = _script_prompt(video_subject, language, paragraph_number)
+    final_script = (
+        await _agenerate(prompt, _parse_script, use_cache, "video script") or ""
+    )
+    logger.success(f"completed: \n{final_script}")
+    return final_script
+
+
+def stream_script(
+    video_subject: str,
+    language: str = "",
+    paragraph_number: int = 1,
+    use_cache: bool = True,
+) -> Iterator[str]:
+    """
+    yields the sentences of the script as soon as they are generated, with
+    the same cleaning as generate_script, the script is the concatenation
+    of the sentences. raises an error if the answer is not a valid script.
+    """
+    logger.info(f"subject: {video_subject}")
+    prompt = _script_prompt(video_subject, language, paragraph_number)
+    # the answers are cached without line breaks, like _generate_response
+    response = ""
+    emitted = ""
+    cached = False
+    for chunk in _stream_response(prompt, use_cache=use_cache):
+        cached = cached or isinstance(chunk, _CachedResponse)
+        response += chunk.replace("\n", "")
+        # the brackets are removed from the first opening one to the last
+        # closing one of the whole answer, so only the text before the first
+        # bracket is final, the rest is sent once the answer is complete
+        final = re.split(r"[\[(]", response, maxsplit=1)[0]
+        sentences, _ = utils.split_sentences(_clean_script(final)[len(emitted):])
+        for sentence in sentences:
+            emitted += sentence
+            if sentence.strip():
+                yield sentence
+
+    final_script = _parse_script(response)
+    if not final_script:
+        raise ValueError("failed to generate video script: empty response")
+    # the sentences joined are the same as the script cleaned at once
+    sentences, rest = utils.split_sentences(_clean_script(response)[len(emitted):])
+    for sentence in sentences + [rest]:
+        if sentence.strip():
+            yield sentence
+    logger.success(f"completed: \n{final_script}")
+    if use_cache and not cached:
+        _set_cached_response(prompt, response)
+
+
+def generate_terms(
+    video_subject: str, video_script: str, amount: int = 5, use_cache: bool = True
+) -> List[str]:
+    logger.info(f"subject: {video_subject}")
+    prompt = _terms_prompt(video_subject, video_script, amount)
+    search_terms = _generate(prompt, _parse_terms, use_cache, "video terms") or []
+    logger.success(f"completed: \n{search_terms}")
+    return search_terms
+
+
+async def agenerate_terms(
+    video_subject: str, video_script: str, amount: int = 5, use_cache: bool = True
+) -> List[str]:
+    logger.info(f"subject: {video_subject}")
+    prompt = _terms_prompt(video_subject, video_script, amount)
+    search_terms = (
+        await _agenerate(prompt, _parse_terms, use_cache, "video terms") or []
+    )
     logger.success(f"completed: \n{search_terms}")
     return search_terms
 
 
+def generate_script_and_terms(
+    video_subject: str,
+    language: str = "",
+    paragraph_number: int = 1,
+    amount: int = 5,
+    use_cache: bool = True,
+) -> Tuple[str, List[str]]:
+    """
+    the script and the terms from a single request, the script is not sent
+    back to the llm to get the terms. falls back to generate_script and
+    generate_terms if the llm does not return a valid json object.
+    """
+    logger.info(f"subject: {video_subject}")
+    prompt = _script_and_terms_prompt(video_subject, language, paragraph_number, amount)
+    result = _generate(
+        prompt,
+        _parse_script_and_terms,
+        use_cache,
+        "video script and terms",
+        max_retries=_combined_max_retries,
+    )
+    if result:
+        logger.success(f"completed: \n{result[0]}\n{result[1]}")
+        return result
+
+    logger.warning("falling back to separate script and terms requests")
+    video_script = generate_script(video_subject, language, paragraph_number, use_cache)
+    if not video_script:
+        return "", []
+    return video_script, generate_terms(video_subject, video_script, amount, use_cache)
+
+
+async def agenerate_script_and_terms(
+    video_subject: str,
+    language: str = "",
+    paragraph_number: int = 1,
+    amount: int = 5,
+    use_cache: bool = True,
+) -> Tuple[str, List[str]]:
+    logger.info(f"subject: {video_subject}")
+    prompt = _script_and_terms_prompt(video_subject, language, paragraph_number, amount)
+    result = await _agenerate(
+        prompt,
+        _parse_script_and_terms,
+        use_cache,
+        "video script and terms",
+        max_retries=_combined_max_retries,
+    )
+    if result:
+        logger.success(f"completed: \n{result[0]}\n{result[1]}")
+        return result
+
+    logger.warning("falling back to separate script and terms requests")
+    video_script = await agenerate_script(
+        video_subject, language, paragraph_number, use_cache
+    )
+    if not video_script:
+        return "", []
+    terms = await agenerate_terms(video_subject, video_script, amount, use_cache)
+    return video_script, terms
+
+
 if __name__ == "__main__":
     video_subject = "生命的意义是什么"
     script = generate_script(
@@ -0,0 +1,279 @@
+import asyncio
+import queue
+import random
+import threading
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional
+
+import httpx
+from loguru import logger
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    AsyncAzureOpenAI,
+    AsyncOpenAI,
+)
+
+from app.config import config
+
+# status codes worth another attempt, the other errors are returned at once
+_RETRY_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+# only used from the gateway loop
+_clients: Dict[tuple, AsyncOpenAI] = {}
+_semaphores: Dict[str, asyncio.Semaphore] = {}
+# marks the end of a streamed answer
+_END = object()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """
+    every llm call runs on a single event loop in a background thread, so
+    that the clients, their connection pools and the concurrency limits are
+    shared by the worker threads, the webui and the api
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever, name="llm-gateway", daemon=True
+            ).start()
+            _loop = loop
+        return _loop
+
+
+def _get_client(settings: Dict) -> AsyncOpenAI:
+    key = (
+        settings["provider"],
+        settings["base_url"],
+        settings["api_key"],
+        settings.get("api_version", ""),
+    )
+    client = _clients.get(key)
+    if client is None:
+        max_connections = config.app.get("llm_max_concurrency", 8)
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+        # the retries are done by the gateway, with jitter and hedging
+        if settings["provider"] == "azure":
+            client = AsyncAzureOpenAI(
+                api_key=settings["api_key"],
+                api_version=settings["api_version"],
+                azure_endpoint=settings["base_url"],
+                max_retries=0,
+                http_client=http_client,
+            )
+        else:
+            client = AsyncOpenAI(
+                api_key=settings["api_key"],
+                base_url=settings["base_url"],
+                max_retries=0,
+                http_client=http_client,
+            )
+        _clients[key] = client
+    return client
+
+
+def _get_semaphore(settings: Dict) -> asyncio.Semaphore:
+    # the rate limits of the providers are per api key
+    key = f"{settings['provider']}:{settings['api_key']}"
+    semaphore = _semaphores.get(key)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(config.app.get("llm_max_concurrency", 8))
+        _semaphores[key] = semaphore
+    return semaphore
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, (asyncio.TimeoutError, APIConnectionError)):
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code in _RETRY_STATUS_CODES
+    return False
+
+
+def _backoff(attempt: int, e: Exception) -> float:
+    """
+    exponential backoff with full jitter, or the delay asked by the provider
+    """
+    if isinstance(e, APIStatusError):
+        retry_after = e.response.headers.get("retry-after", "")
+        try:
+            return min(float(retry_after), 60.0)
+        except ValueError:
+            pass
+    base = config.app.get("llm_retry_base_delay", 1.0)
+    return random.uniform(0, min(30.0, base * 2**attempt))
+
+
+async def _hedged(call: Callable[[], Awaitable[str]], hedge_delay: float) -> str:
+    """
+    start a second identical request if the first one did not answer after
+    `hedge_delay` seconds, the first answer wins and the other is cancelled
+    """
+    first = asyncio.ensure_future(call())
+    if not hedge_delay:
+        return await first
+
+    done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+    if done:
+        return first.result()
+
+    logger.debug(f"llm request is slow, hedged after {hedge_delay}s")
+    pending = {first, asyncio.ensure_future(call())}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+    raise error
+
+
+async def _complete(settings: Dict, messages: List[Dict]) -> str:
+    timeout = config.app.get("llm_timeout", 120)
+    max_retries = config.app.get("llm_max_retries", 3)
+    hedge_delay = config.app.get("llm_hedge_delay", 0)
+    client = _get_client(settings)
+    semaphore = _get_semaphore(settings)
+
+    async def _attempt() -> str:
+        async with semaphore:
+            response = await asyncio.wait_for(
+                client.chat.completions.create(
+                    model=settings["model_name"], messages=messages
+                ),
+                timeout,
+            )
+        if not response or not response.choices:
+            raise ValueError(
+                f'[{settings["provider"]}] returned an empty response, please check your network connection and try again.'
+            )
+        return response.choices[0].message.content or ""
+
+    attempt = 0
+    while True:
+        try:
+            return await _hedged(_attempt, hedge_delay)
+        except Exception as e:
+            if attempt >= max_retries or not _is_retryable(e):
+                raise
+            delay = _backoff(attempt, e)
+            attempt += 1
+            logger.warning(
+                f"[{settings['provider']}] request failed: {str(e) or type(e).__name__}, "
+                f"retry {attempt}/{max_retries} in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+
+
+async def acomplete(settings: Dict, prompt: str) -> str:
+    """
+    ask the openai compatible api described by `settings` (provider,
+    api_key, model_name, base_url, api_version), from any event loop
+    """
+    messages = [{"role": "user", "content": prompt}]
+    loop = _get_loop()
+    if asyncio.get_running_loop() is loop:
+        return await _complete(settings, messages)
+    future = asyncio.run_coroutine_threadsafe(_complete(settings, messages), loop)
+    return await asyncio.wrap_future(future)
+
+
+def complete(settings: Dict, prompt: str) -> str:
+    """
+    blocking version of acomplete, for the worker threads and the webui
+    """
+    messages = [{"role": "user", "content": prompt}]
+    future = asyncio.run_coroutine_threadsafe(_complete(settings, messages), _get_loop())
+    return future.result()
+
+
+async def _stream(
+    settings: Dict, messages: List[Dict], put: Callable[[object], None]
+):
+    timeout = config.app.get("llm_timeout", 120)
+    max_retries = config.app.get("llm_max_retries", 3)
+    client = _get_client(settings)
+    semaphore = _get_semaphore(settings)
+
+    attempt = 0
+    while True:
+        received = False
+        try:
+            async with semaphore:
+                response = await asyncio.wait_for(
+                    client.chat.completions.create(
+                        model=settings["model_name"],
+                        messages=messages,
+                        stream=True,
+                    ),
+                    timeout,
+                )
+                try:
+                    chunks = response.__aiter__()
+                    while True:
+                        try:
+                            # the timeout applies to each chunk
+                            chunk = await asyncio.wait_for(
+                                chunks.__anext__(), timeout
+                            )
+                        except StopAsyncIteration:
+                            break
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            received = True
+                            put(chunk.choices[0].delta.content)
+                finally:
+                    await response.close()
+            put(_END)
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # once a chunk was handed over, the answer can not be restarted
+            if received or attempt >= max_retries or not _is_retryable(e):
+                put(e)
+                return
+            delay = _backoff(attempt, e)
+            attempt += 1
+            logger.warning(
+                f"[{settings['provider']}] stream failed: {str(e) or type(e).__name__}, "
+                f"retry {attempt}/{max_retries} in {delay:.1f}s"
+            )
+            await asyncio.sleep(delay)
+
+
+def stream(settings: Dict, prompt: str) -> Iterator[str]:
+    """
+    blocking iterator over the chunks of the answer as they are generated,
+    the request is retried like complete() until the first chunk arrives
+    """
+    messages = [{"role": "user", "content": prompt}]
+    chunks = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        _stream(settings, messages, chunks.put), _get_loop()
+    )
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _END:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # the consumer stopped early
+        future.cancel()
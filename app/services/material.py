@@ -1,18 +1,48 @@
 import os
 import random
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
 from typing import List
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
 from app.models.schema import VideoAspect, VideoConcatMode, MaterialInfo
-from app.utils import utils
+from app.services import material_store
+from app.utils import media, utils
+from app.utils.cache import SqliteCache
 
 requested_count = 0
 
+_max_download_workers = config.app.get("max_download_workers", 4)
+_max_search_workers = config.app.get("max_search_workers", 8)
+
+_session = None
+_session_lock = threading.Lock()
+
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    a shared session keeps the connections to the material providers alive
+    between searches and downloads
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = max(_max_download_workers, _max_search_workers)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
 
 def get_api_key(cfg_key: str):
     api_keys = config.app.get(cfg_key)
@@ -31,11 +61,59 @@ def get_api_key(cfg_key: str):
     return api_keys[requested_count % len(api_keys)]
 
 
+def get_search_cache():
+    """
+    search results are cached on disk and shared by the api and webui processes,
+    set search_cache_ttl = 0 to disable it
+    """
+    global _search_cache
+    ttl = config.app.get("search_cache_ttl", 86400)
+    if not ttl:
+        return None
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SqliteCache(
+                "search",
+                ttl=ttl,
+                max_entries=config.app.get("search_cache_max_entries", 5000),
+            )
+        return _search_cache
+
+
+def _search_cache_key(
+    provider: str, search_term: str, minimum_duration: int, video_aspect: VideoAspect
+) -> str:
+    aspect = VideoAspect(video_aspect)
+    return f"{provider}:{aspect.name}:{minimum_duration}:{search_term.strip().lower()}"
+
+
+def _get_cached_search(cache_key: str) -> [List[MaterialInfo], None]:
+    cache = get_search_cache()
+    if not cache:
+        return None
+    items = cache.get(cache_key)
+    if items is None:
+        return None
+    logger.debug(f"search cache hit: {cache_key}")
+    return [MaterialInfo(**item) for item in items]
+
+
+def _set_cached_search(cache_key: str, video_items: List[MaterialInfo]):
+    cache = get_search_cache()
+    if cache and video_items:
+        cache.set(cache_key, [item.__dict__ for item in video_items])
+
+
 def search_videos_pexels(
     search_term: str,
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
 ) -> List[MaterialInfo]:
+    cache_key = _search_cache_key("pexels", search_term, minimum_duration, video_aspect)
+    cached_items = _get_cached_search(cache_key)
+    if cached_items is not None:
+        return cached_items
+
     aspect = VideoAspect(video_aspect)
     video_orientation = aspect.name
     video_width, video_height = aspect.to_resolution()
@@ -47,7 +125,7 @@ def search_videos_pexels(
     logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
 
     try:
-        r = requests.get(
+        r = get_session().get(
             query_url,
             headers=headers,
             proxies=config.proxy,
@@ -78,6 +156,7 @@ def search_videos_pexels(
                     item.duration = duration
                     video_items.append(item)
                     break
+        _set_cached_search(cache_key, video_items)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -90,6 +169,11 @@ def search_videos_pixabay(
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
 ) -> List[MaterialInfo]:
+    cache_key = _search_cache_key("pixabay", search_term, minimum_duration, video_aspect)
+    cached_items = _get_cached_search(cache_key)
+    if cached_items is not None:
+        return cached_items
+
     aspect = VideoAspect(video_aspect)
 
     video_width, video_height = aspect.to_resolution()
@@ -106,7 +190,7 @@ def search_videos_pixabay(
     logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
 
     try:
-        r = requests.get(
+        r = get_session().get(
             query_url, proxies=config.proxy, verify=False, timeout=(30, 60)
         )
         response = r.json()
@@ -134,6 +218,7 @@ def search_videos_pixabay(
                     item.duration = duration
                     video_items.append(item)
                     break
+        _set_cached_search(cache_key, video_items)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -145,41 +230,50 @@ def save_video(video_url: str, save_dir: str = "") -> str:
     if not save_dir:
         save_dir = utils.storage_dir("cache_videos")
 
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-
     url_without_query = video_url.split("?")[0]
     url_hash = utils.md5(url_without_query)
     video_id = f"vid-{url_hash}"
-    video_path = f"{save_dir}/{video_id}.mp4"
+    video_name = f"{video_id}.mp4"
 
     # if video already exists, return the path
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
+    store = material_store.get_store(save_dir)
+    video_path = store.lookup(video_name)
+    if video_path:
         logger.info(f"video already exists: {video_path}")
         return video_path
 
-    # if video does not exist, download it
-    with open(video_path, "wb") as f:
-        f.write(
-            requests.get(
-                video_url, proxies=config.proxy, verify=False, timeout=(60, 240)
-            ).content
-        )
-
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
-        try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
-                return video_path
-        except Exception as e:
+    # if video does not exist, stream it to a temp file and move it into the store once it is valid
+    temp_path = store.temp_path(video_name)
+    try:
+        with get_session().get(
+            video_url,
+            proxies=config.proxy,
+            verify=False,
+            timeout=(60, 240),
+            stream=True,
+        ) as r:
+            r.raise_for_status()
+            store.ensure_free_space(int(r.headers.get("Content-Length") or 0))
+            with open(temp_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    if chunk:
+                        f.write(chunk)
+
+        if os.path.getsize(temp_path) > 0:
+            info = media.probe(temp_path)
+            if info["duration"] > 0 and info["fps"] > 0:
+                return store.commit(
+                    temp_path, video_name, source=url_without_query, info=info
+                )
+            logger.warning(f"invalid video file: {video_url} => {info}")
+    except Exception as e:
+        logger.warning(f"invalid video file: {video_url} => {str(e)}")
+    finally:
+        if os.path.exists(temp_path):
             try:
-                os.remove(video_path)
-            except Exception as e:
+                os.remove(temp_path)
+            except Exception:
                 pass
-            logger.warning(f"invalid video file: {video_path} => {str(e)}")
     return ""
 
 
@@ -199,14 +293,21 @@ def download_videos(
     if source == "pixabay":
         search_videos = search_videos_pixabay
 
-    for search_term in search_terms:
+    # query all search terms concurrently, the results are merged in the order of the terms
+    def _search(search_term):
         video_items = search_videos(
             search_term=search_term,
             minimum_duration=max_clip_duration,
             video_aspect=video_aspect,
         )
         logger.info(f"found {len(video_items)} videos for '{search_term}'")
+        return video_items
 
+    max_workers = max(1, min(_max_search_workers, len(search_terms)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        search_results = list(executor.map(_search, search_terms))
+
+    for video_items in search_results:
         for item in video_items:
             if item.url not in valid_video_urls:
                 valid_video_items.append(item)
@@ -216,8 +317,6 @@ def download_videos(
     logger.info(
         f"found total videos: {len(valid_video_items)}, required duration: {audio_duration} seconds, found duration: {found_duration} seconds"
     )
-    video_paths = []
-
     material_directory = config.app.get("material_directory", "").strip()
     if material_directory == "task":
         material_directory = utils.task_dir(task_id)
@@ -227,25 +326,59 @@ def download_videos(
     if video_contact_mode.value == VideoConcatMode.random.value:
         random.shuffle(valid_video_items)
 
+    # download with a bounded number of workers, and stop submitting new
+    # downloads as soon as the downloaded duration covers the audio
+    def _download(item):
+        logger.info(f"downloading video: {item.url}")
+        return save_video(video_url=item.url, save_dir=material_directory)
+
+    saved_videos = {}
     total_duration = 0.0
-    for item in valid_video_items:
-        try:
-            logger.info(f"downloading video: {item.url}")
-            saved_video_path = save_video(
-                video_url=item.url, save_dir=material_directory
-            )
-            if saved_video_path:
-                logger.info(f"video saved: {saved_video_path}")
-                video_paths.append(saved_video_path)
-                seconds = min(max_clip_duration, item.duration)
-                total_duration += seconds
-                if total_duration > audio_duration:
+    enough = False
+    pending_items = iter(enumerate(valid_video_items))
+    with ThreadPoolExecutor(max_workers=max(1, _max_download_workers)) as executor:
+        running = {}
+
+        def submit_next():
+            for idx, item in pending_items:
+                running[executor.submit(_download, item)] = (idx, item)
+                return
+
+        for _ in range(max(1, _max_download_workers)):
+            submit_next()
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx, item = running.pop(future)
+                try:
+                    saved_video_path = future.result()
+                except Exception as e:
+                    logger.error(
+                        f"failed to download video: {utils.to_json(item)} => {str(e)}"
+                    )
+                    saved_video_path = ""
+
+                if saved_video_path:
+                    logger.info(f"video saved: {saved_video_path}")
+                    saved_videos[idx] = saved_video_path
+                    total_duration += min(max_clip_duration, item.duration)
+
+            if total_duration > audio_duration:
+                if not enough:
+                    enough = True
                     logger.info(
                         f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
                     )
+                continue
+
+            while len(running) < max(1, _max_download_workers):
+                before = len(running)
+                submit_next()
+                if len(running) == before:
                     break
-        except Exception as e:
-            logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+
+    video_paths = [saved_videos[idx] for idx in sorted(saved_videos)]
     logger.success(f"downloaded {len(video_paths)} videos")
     return video_paths
 
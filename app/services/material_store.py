@@ -0,0 +1,306 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+from loguru import logger
+
+from app.config import config
+from app.utils import media, utils
+
+# files accessed recently may be used by a running render, never evict them
+_PROTECT_SECONDS = 3600
+_INDEX_FILE = ".index.db"
+
+_stores: Dict[str, "MaterialStore"] = {}
+_stores_lock = threading.Lock()
+
+
+class MaterialStore:
+    """
+    a size bounded directory of material files with a metadata index
+    (size, duration, fps, resolution, last access, hit count).
+
+    when the files take more than `max_bytes`, the least recently used (lru)
+    or least frequently used (lfu) files are evicted.
+
+    only indexed files are evicted. with index_existing=False (a directory
+    supplied by the user), only the files committed by the store are
+    indexed, the files that were already there are never touched.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 0,
+        policy: str = "lru",
+        index_existing: bool = True,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy if policy in ("lru", "lfu") else "lru"
+        self.index_existing = index_existing
+        self.index_file = os.path.join(directory, _INDEX_FILE)
+        self._local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+        self._init_db()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_file, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        self._conn().execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                source TEXT NOT NULL DEFAULT '',
+                size INTEGER NOT NULL DEFAULT 0,
+                duration REAL NOT NULL DEFAULT 0,
+                fps REAL NOT NULL DEFAULT 0,
+                width INTEGER NOT NULL DEFAULT 0,
+                height INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def temp_path(self, name: str) -> str:
+        return self.path(f"{name}.{utils.get_uuid(True)}.tmp")
+
+    def lookup(self, name: str) -> str:
+        """
+        return the path of the file if it is stored, and record the access
+        """
+        file_path = self.path(name)
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) == 0:
+            self._conn().execute("DELETE FROM files WHERE name = ?", (name,))
+            return ""
+
+        conn = self._conn()
+        cursor = conn.execute(
+            "UPDATE files SET accessed_at = ?, hits = hits + 1 WHERE name = ?",
+            (time.time(), name),
+        )
+        if cursor.rowcount == 0 and self.index_existing:
+            # stored before the index existed
+            self.add(name)
+        return file_path
+
+    def add(self, name: str, source: str = "", info: Dict = None) -> str:
+        file_path = self.path(name)
+        if info is None:
+            try:
+                info = media.probe(file_path)
+            except Exception as e:
+                logger.warning(f"failed to probe material: {file_path} => {str(e)}")
+                info = {}
+
+        now = time.time()
+        self._conn().execute(
+            """
+            INSERT OR REPLACE INTO files
+                (name, source, size, duration, fps, width, height, created_at, accessed_at, hits)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+            """,
+            (
+                name,
+                source,
+                os.path.getsize(file_path),
+                info.get("duration", 0),
+                info.get("fps", 0),
+                info.get("width", 0),
+                info.get("height", 0),
+                now,
+                now,
+            ),
+        )
+        self.evict()
+        return file_path
+
+    def commit(self, temp_path: str, name: str, source: str = "", info: Dict = None) -> str:
+        """
+        atomically move a fully written temp file into the store
+        """
+        os.replace(temp_path, self.path(name))
+        return self.add(name, source=source, info=info)
+
+    def total_size(self) -> int:
+        return self._conn().execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+
+    def ensure_free_space(self, required_bytes: int):
+        """
+        evict files until the disk has room for `required_bytes` more
+        """
+        reserve = config.app.get("material_cache_min_free_mb", 1024) * 1024 * 1024
+        free = shutil.disk_usage(self.directory).free
+        if free - required_bytes >= reserve:
+            return
+        self.evict(extra_bytes=required_bytes + reserve - free)
+
+    def evict(self, extra_bytes: int = 0) -> List[str]:
+        """
+        evict files until the store fits in max_bytes (minus extra_bytes)
+        """
+        if not self.max_bytes and not extra_bytes:
+            return []
+
+        total_size = self.total_size()
+        excess = extra_bytes
+        if self.max_bytes:
+            excess = max(excess, total_size + extra_bytes - self.max_bytes)
+        if excess <= 0:
+            return []
+
+        order = "accessed_at ASC" if self.policy == "lru" else "hits ASC, accessed_at ASC"
+        rows = self._conn().execute(
+            f"SELECT name, size FROM files WHERE accessed_at < ? ORDER BY {order}",
+            (time.time() - _PROTECT_SECONDS,),
+        ).fetchall()
+
+        evicted = []
+        for name, size in rows:
+            if excess <= 0:
+                break
+            self.remove(name)
+            evicted.append(name)
+            excess -= size
+
+        if evicted:
+            logger.info(
+                f"evicted {len(evicted)} materials from {self.directory}, policy: {self.policy}"
+            )
+        return evicted
+
+    def remove(self, name: str):
+        file_path = self.path(name)
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        except Exception as e:
+            logger.warning(f"failed to remove material: {file_path} => {str(e)}")
+        self._conn().execute("DELETE FROM files WHERE name = ?", (name,))
+
+    def report(self) -> Dict:
+        conn = self._conn()
+        count, size, hits = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM files"
+        ).fetchone()
+        top = conn.execute(
+            "SELECT name, size, duration, hits FROM files ORDER BY hits DESC LIMIT 10"
+        ).fetchall()
+        return {
+            "directory": self.directory,
+            "policy": self.policy,
+            "max_bytes": self.max_bytes,
+            "files": count,
+            "total_bytes": size,
+            "total_hits": hits,
+            "free_disk_bytes": shutil.disk_usage(self.directory).free,
+            "top_files": [
+                {"name": n, "size": s, "duration": d, "hits": h} for n, s, d, h in top
+            ],
+        }
+
+    def compact(self) -> Dict:
+        """
+        drop index rows of missing files, remove leftover temp files, index
+        unknown files (unless index_existing is false) and evict down to the
+        byte budget
+        """
+        conn = self._conn()
+        removed_rows = 0
+        for (name,) in conn.execute("SELECT name FROM files").fetchall():
+            if not os.path.isfile(self.path(name)):
+                conn.execute("DELETE FROM files WHERE name = ?", (name,))
+                removed_rows += 1
+
+        removed_temp_files = 0
+        indexed_files = 0
+        known = {name for (name,) in conn.execute("SELECT name FROM files").fetchall()}
+        for name in os.listdir(self.directory):
+            file_path = self.path(name)
+            if name.startswith(_INDEX_FILE) or not os.path.isfile(file_path):
+                continue
+            if name.endswith(".tmp") or ".tmp." in name:
+                # only remove stale temp files, a download may still be writing
+                if time.time() - os.path.getmtime(file_path) > _PROTECT_SECONDS:
+                    os.remove(file_path)
+                    removed_temp_files += 1
+                continue
+            if name not in known and self.index_existing:
+                self.add(name)
+                indexed_files += 1
+
+        evicted = self.evict()
+        conn.execute("VACUUM")
+        return {
+            "removed_rows": removed_rows,
+            "removed_temp_files": removed_temp_files,
+            "indexed_files": indexed_files,
+            "evicted_files": len(evicted),
+        }
+
+
+def get_store(directory: str = "", max_size_mb: int = None) -> MaterialStore:
+    if not directory:
+        directory = utils.storage_dir("cache_videos")
+    directory = os.path.abspath(directory)
+
+    with _stores_lock:
+        if directory not in _stores:
+            if max_size_mb is None:
+                max_size_mb = config.app.get("material_cache_max_size_mb", 0)
+            if directory.startswith(os.path.abspath(utils.task_dir())):
+                # materials downloaded into a task folder live and die with the task
+                max_size_mb = 0
+            max_bytes = max_size_mb * 1024 * 1024
+            policy = config.app.get("material_cache_policy", "lru")
+            # the files of a directory outside ./storage belong to the user
+            index_existing = directory.startswith(os.path.abspath(utils.storage_dir()))
+            _stores[directory] = MaterialStore(
+                directory,
+                max_bytes=max_bytes,
+                policy=policy,
+                index_existing=index_existing,
+            )
+        return _stores[directory]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="manage the material store")
+    parser.add_argument("command", choices=["report", "compact"])
+    parser.add_argument(
+        "--dir",
+        action="append",
+        help="material directory, default: ./storage/cache_videos and ./storage/normalized_videos",
+    )
+    args = parser.parse_args()
+
+    material_directory = config.app.get("material_directory", "").strip()
+    if material_directory in ("", "task"):
+        material_directory = utils.storage_dir("cache_videos")
+    normalized_directory = utils.storage_dir("normalized_videos")
+    directories = args.dir or [material_directory, normalized_directory]
+    for d in directories:
+        if not os.path.isdir(d):
+            continue
+        max_size_mb = None
+        if os.path.abspath(d) == os.path.abspath(normalized_directory):
+            max_size_mb = config.app.get("normalized_cache_max_size_mb", 0)
+        store = get_store(d, max_size_mb=max_size_mb)
+        if args.command == "compact":
+            print(utils.to_json({"directory": d, **store.compact()}))
+        print(utils.to_json(store.report()))
@@ -0,0 +1,342 @@
+import os
+import random
+import threading
+from typing import List, Tuple
+
+from loguru import logger
+from PIL import ImageColor, ImageFont
+
+from app.config import config
+from app.models.schema import VideoAspect, VideoConcatMode, VideoParams
+from app.services import clip_store, video
+from app.utils import ffmpeg, media, utils
+
+# libass renders srt subtitles on a 384x288 canvas and scales the result to the
+# video size, so font sizes, margins and outlines must be expressed in that space
+_ASS_PLAY_RES_Y = 288
+
+# (video path, start time, end time)
+ClipPlan = List[Tuple[str, float, float]]
+
+_render_slots = None
+_render_slots_lock = threading.Lock()
+
+
+def plan_clips(
+    video_paths: List[str],
+    audio_duration: float,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    max_clip_duration: int = 5,
+) -> ClipPlan:
+    """
+    split the materials into clips of at most max_clip_duration seconds and
+    repeat them until the duration of the audio is covered, the same way
+    video.combine_videos does, but without opening a single frame
+    """
+    video_concat_mode = VideoConcatMode(video_concat_mode)
+
+    raw_clips = []
+    for video_path in video_paths:
+        clip_duration = media.get_duration(video_path)
+        if clip_duration <= 0:
+            logger.warning(f"skip invalid video: {video_path}")
+            continue
+
+        start_time = 0.0
+        while start_time < clip_duration:
+            end_time = min(start_time + max_clip_duration, clip_duration)
+            raw_clips.append((video_path, start_time, end_time))
+            start_time = end_time
+            if video_concat_mode.value == VideoConcatMode.sequential.value:
+                break
+
+    if video_concat_mode.value == VideoConcatMode.random.value:
+        random.shuffle(raw_clips)
+
+    clips = []
+    if not raw_clips:
+        return clips
+
+    video_duration = 0.0
+    while video_duration < audio_duration:
+        for video_path, start_time, end_time in raw_clips:
+            remaining = audio_duration - video_duration
+            if remaining <= 0:
+                break
+            end_time = min(end_time, start_time + remaining)
+            clips.append((video_path, start_time, end_time))
+            video_duration += end_time - start_time
+
+    return clips
+
+
+def plan_variants(
+    video_paths: List[str],
+    audio_file: str,
+    params: VideoParams,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+) -> List[ClipPlan]:
+    """
+    plan the clip order of all params.video_count videos up front, the
+    materials are normalized only once and shared by every variant
+    """
+    if clip_store.is_enabled():
+        video_paths = clip_store.normalize_videos(video_paths, params.video_aspect)
+
+    audio_duration = media.get_duration(audio_file)
+    return [
+        plan_clips(
+            video_paths=video_paths,
+            audio_duration=audio_duration,
+            video_concat_mode=video_concat_mode,
+            max_clip_duration=params.video_clip_duration,
+        )
+        for _ in range(params.video_count)
+    ]
+
+
+def max_parallel_renders(threads: int, video_count: int) -> int:
+    """
+    number of videos rendered at the same time, each job uses `threads` cores
+    """
+    max_renders = config.app.get("max_parallel_renders", 0)
+    if not max_renders:
+        max_renders = (os.cpu_count() or 1) // max(threads or 2, 1)
+    return max(1, min(max_renders, video_count))
+
+
+def render_slots() -> threading.BoundedSemaphore:
+    """
+    limits the renders running at the same time in the process, whatever
+    the task they belong to, max_parallel_renders or cpu cores / 2
+    """
+    global _render_slots
+    with _render_slots_lock:
+        if _render_slots is None:
+            max_renders = config.app.get("max_parallel_renders", 0)
+            if not max_renders:
+                max_renders = (os.cpu_count() or 1) // 2
+            _render_slots = threading.BoundedSemaphore(max(1, max_renders))
+        return _render_slots
+
+
+def _to_ass_color(color: str, default: str = "&H00FFFFFF") -> str:
+    if not color:
+        return default
+    if color.strip().lower() == "transparent":
+        return "&HFF000000"
+    try:
+        r, g, b = ImageColor.getrgb(color)[:3]
+    except ValueError:
+        logger.warning(f"invalid color: {color}, use default: {default}")
+        return default
+    return f"&H00{b:02X}{g:02X}{r:02X}"
+
+
+def _subtitle_style(params: VideoParams, video_height: int, font_path: str) -> str:
+    scale = _ASS_PLAY_RES_Y / video_height
+    font_name = ImageFont.truetype(font_path, params.font_size).getname()[0]
+
+    styles = {
+        "FontName": font_name,
+        "FontSize": round(params.font_size * scale, 2),
+        "PrimaryColour": _to_ass_color(params.text_fore_color),
+        "OutlineColour": _to_ass_color(params.stroke_color, "&H00000000"),
+        "Outline": round(params.stroke_width * scale, 2),
+        "BorderStyle": 1,
+        "Shadow": 0,
+        "MarginL": 0,
+        "MarginR": 0,
+    }
+
+    bg_color = (params.text_background_color or "").strip().lower()
+    if bg_color and bg_color != "transparent":
+        # opaque box, libass paints it with the outline colour
+        styles["BorderStyle"] = 3
+        styles["OutlineColour"] = _to_ass_color(bg_color, "&H00000000")
+
+    if params.subtitle_position == "bottom":
+        styles["Alignment"] = 2
+        styles["MarginV"] = round(video_height * 0.05 * scale)
+    elif params.subtitle_position == "top":
+        styles["Alignment"] = 8
+        styles["MarginV"] = round(video_height * 0.05 * scale)
+    elif params.subtitle_position == "custom":
+        styles["Alignment"] = 8
+        custom_y = video_height * (params.custom_position / 100)
+        custom_y = max(10, min(custom_y, video_height - params.font_size - 10))
+        styles["MarginV"] = round(custom_y * scale)
+    else:  # center
+        styles["Alignment"] = 5
+        styles["MarginV"] = 0
+
+    return ",".join(f"{k}={v}" for k, v in styles.items())
+
+
+def render_video(
+    output_file: str,
+    video_paths: List[str],
+    audio_file: str,
+    subtitle_path: str,
+    params: VideoParams,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    combined_video_path: str = "",
+    threads: int = 2,
+    clips: ClipPlan = None,
+) -> str:
+    """
+    render the final video with a single ffmpeg filter graph:
+    trim -> scale/pad -> concat -> subtitle overlay, mixed with voice + bgm,
+    and encoded only once.
+
+    the video without subtitles and audio (combined video) is only written
+    when combined_video_path is set. clips planned by plan_variants can be
+    passed in to skip the normalization and planning steps.
+    """
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+
+    audio_duration = media.get_duration(audio_file)
+    if audio_duration <= 0:
+        raise ValueError(f"invalid audio file: {audio_file}")
+
+    if not clips:
+        if clip_store.is_enabled():
+            video_paths = clip_store.normalize_videos(video_paths, aspect)
+
+        clips = plan_clips(
+            video_paths=video_paths,
+            audio_duration=audio_duration,
+            video_concat_mode=video_concat_mode,
+            max_clip_duration=params.video_clip_duration,
+        )
+    if not clips:
+        raise ValueError("no valid video clips to render")
+
+    logger.info(f"start, video size: {video_width} x {video_height}")
+    logger.info(f"  ① clips: {len(clips)}, audio duration: {audio_duration:.2f}s")
+    logger.info(f"  ② audio: {audio_file}")
+    logger.info(f"  ③ subtitle: {subtitle_path}")
+    logger.info(f"  ④ output: {output_file}")
+
+    args = []
+    filters = []
+    concat_list_file = ""
+    if all(clip_store.is_normalized(video_path) for video_path, _, _ in clips):
+        # normalized clips already have the target size/fps/codec: decode them
+        # through the concat demuxer and copy the streams for the combined video
+        concat_list_file = f"{output_file}.txt"
+        clip_store.write_concat_list(clips, concat_list_file)
+        args += ["-f", "concat", "-safe", "0", "-i", concat_list_file]
+        filters.append("[0:v]fps=30,format=yuv420p[vcat]")
+        audio_idx = 1
+        video_label = "vcat"
+        if combined_video_path:
+            clip_store.concat_clips(clips, combined_video_path)
+            combined_video_path = ""
+    else:
+        for idx, (video_path, start_time, end_time) in enumerate(clips):
+            args += [
+                "-ss",
+                f"{start_time:.3f}",
+                "-t",
+                f"{end_time - start_time:.3f}",
+                "-i",
+                video_path,
+            ]
+            filters.append(
+                f"[{idx}:v]scale={video_width}:{video_height}:force_original_aspect_ratio=decrease,"
+                f"pad={video_width}:{video_height}:(ow-iw)/2:(oh-ih)/2:color=black,"
+                f"setsar=1,fps=30,format=yuv420p[v{idx}]"
+            )
+
+        concat_inputs = "".join(f"[v{idx}]" for idx in range(len(clips)))
+        filters.append(f"{concat_inputs}concat=n={len(clips)}:v=1:a=0[vcat]")
+        audio_idx = len(clips)
+
+        video_label = "vcat"
+        if combined_video_path:
+            filters.append("[vcat]split=2[vmain][vcombined]")
+            video_label = "vmain"
+
+    if params.subtitle_enabled and subtitle_path and os.path.exists(subtitle_path):
+        if not params.font_name:
+            params.font_name = "STHeitiMedium.ttc"
+        font_path = os.path.join(utils.font_dir(), params.font_name)
+        style = _subtitle_style(params, video_height, font_path)
+        filters.append(
+            f"[{video_label}]subtitles=filename={ffmpeg.escape_filter_value(subtitle_path)}"
+            f":fontsdir={ffmpeg.escape_filter_value(utils.font_dir())}"
+            f":original_size={video_width}x{video_height}"
+            f":force_style={ffmpeg.escape_filter_value(style)}[vout]"
+        )
+        video_label = "vout"
+
+    args += ["-i", audio_file]
+    filters.append(f"[{audio_idx}:a]volume={params.voice_volume}[avoice]")
+    audio_label = "avoice"
+
+    bgm_file = video.get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
+    if bgm_file:
+        bgm_idx = audio_idx + 1
+        fade_start = max(audio_duration - 3, 0)
+        args += ["-stream_loop", "-1", "-i", bgm_file]
+        filters.append(
+            f"[{bgm_idx}:a]volume={params.bgm_volume},atrim=0:{audio_duration:.3f},"
+            f"afade=t=out:st={fade_start:.3f}:d=3[abgm]"
+        )
+        # amix divides every input by the number of inputs, restore the level
+        filters.append(
+            "[avoice][abgm]amix=inputs=2:duration=first:dropout_transition=0,"
+            "volume=2[aout]"
+        )
+        audio_label = "aout"
+
+    args += ["-filter_complex", ";".join(filters)]
+
+    encode_args = [
+        "-c:v",
+        "libx264",
+        "-preset",
+        "medium",
+        "-pix_fmt",
+        "yuv420p",
+        "-r",
+        "30",
+        "-threads",
+        str(threads or 2),
+    ]
+    args += [
+        "-map",
+        f"[{video_label}]",
+        "-map",
+        f"[{audio_label}]",
+        *encode_args,
+        "-c:a",
+        "aac",
+        "-b:a",
+        "192k",
+        "-t",
+        f"{audio_duration:.3f}",
+        "-movflags",
+        "+faststart",
+        output_file,
+    ]
+    if combined_video_path:
+        args += [
+            "-map",
+            "[vcombined]",
+            *encode_args,
+            "-an",
+            "-t",
+            f"{audio_duration:.3f}",
+            combined_video_path,
+        ]
+
+    try:
+        ffmpeg.run(args)
+    finally:
+        if concat_list_file and os.path.exists(concat_list_file):
+            os.remove(concat_list_file)
+    logger.success(f"completed: {output_file}")
+    return output_file
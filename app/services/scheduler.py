@@ -0,0 +1,173 @@
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Executor, ThreadPoolExecutor, wait
+from timeit import default_timer as timer
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from loguru import logger
+
+from app.config import config
+from app.services.checkpoint import Checkpoints, hash_value
+
+# network bound stages (llm, tts, material search and download)
+POOL_IO = "io"
+# cpu bound stages (render), the heavy work runs in ffmpeg / moviepy child
+# processes, the pool only bounds how many renders run at the same time
+POOL_CPU = "cpu"
+
+_pools: Dict[str, Executor] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_size(pool: str) -> int:
+    if pool == POOL_CPU:
+        render_workers = config.app.get("render_workers", 0)
+        if not render_workers:
+            render_workers = (os.cpu_count() or 2) // 2
+        return max(1, render_workers)
+    return max(1, config.app.get("io_workers", 32))
+
+
+def get_pool(pool: str) -> Executor:
+    with _pools_lock:
+        if pool not in _pools:
+            size = _pool_size(pool)
+            logger.info(f"create {pool} pool, workers: {size}")
+            _pools[pool] = ThreadPoolExecutor(
+                max_workers=size, thread_name_prefix=f"stage-{pool}"
+            )
+        return _pools[pool]
+
+
+class Stage:
+    """
+    a step of a task, `func` receives the results of its dependencies as
+    keyword arguments and returns None when the stage failed.
+
+    a stage with `inputs` (the params it reads) is checkpointed: `dump`
+    turns its result into json, `load` turns it back and returns None when
+    the stored result is no longer valid (eg: a file was deleted)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[..., Any],
+        deps: Sequence[str] = (),
+        pool: str = POOL_IO,
+        inputs: Any = None,
+        dump: Callable[[Any], Any] = None,
+        load: Callable[[Any], Any] = None,
+    ):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.pool = pool
+        self.inputs = inputs
+        self.dump = dump or (lambda result: result)
+        self.load = load or (lambda output: output)
+
+
+def _restore(stage: Stage, checkpoints: Checkpoints, input_hash: str):
+    output = checkpoints.get(stage.name, input_hash)
+    if output is None:
+        return None
+    try:
+        return stage.load(output)
+    except Exception as e:
+        logger.warning(f"invalid checkpoint of stage {stage.name}: {str(e)}")
+    return None
+
+
+def run(
+    stages: List[Stage],
+    on_stage_done: Optional[Callable[[str, Any], None]] = None,
+    checkpoints: Checkpoints = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    run the stages as a dag, a stage is submitted to its pool as soon as all
+    of its dependencies are done, independent stages run at the same time.
+
+    with `checkpoints`, a stage whose inputs did not change since its last
+    successful run is restored instead of being run again.
+
+    returns the results by stage name, or None if a stage failed, in which
+    case the stages that did not start yet are dropped.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in by_name]
+        if missing:
+            raise ValueError(f"stage {stage.name} depends on unknown stages: {missing}")
+
+    results: Dict[str, Any] = {}
+    input_hashes: Dict[str, str] = {}
+    pending = list(stages)
+    running = {}
+
+    def _completed(stage: Stage, result: Any):
+        results[stage.name] = result
+        if on_stage_done:
+            on_stage_done(stage.name, result)
+
+    def _run_stage(stage: Stage, kwargs: Dict[str, Any]):
+        start = timer()
+        logger.debug(f"stage started: {stage.name}")
+        result = stage.func(**kwargs)
+        logger.info(f"stage finished: {stage.name}, elapsed: {timer() - start:.2f} s")
+        return result
+
+    while pending or running:
+        ready = [s for s in pending if all(d in results for d in s.deps)]
+        while ready:
+            stage = ready.pop(0)
+            pending.remove(stage)
+
+            if checkpoints and stage.inputs is not None:
+                input_hashes[stage.name] = hash_value(
+                    {
+                        "stage": stage.name,
+                        "inputs": stage.inputs,
+                        "deps": {
+                            d: hash_value(by_name[d].dump(results[d])) for d in stage.deps
+                        },
+                    }
+                )
+                result = _restore(stage, checkpoints, input_hashes[stage.name])
+                if result is not None:
+                    logger.info(f"stage restored from checkpoint: {stage.name}")
+                    _completed(stage, result)
+                    ready += [
+                        s
+                        for s in pending
+                        if s not in ready and all(d in results for d in s.deps)
+                    ]
+                    continue
+
+            kwargs = {dep: results[dep] for dep in stage.deps}
+            future = get_pool(stage.pool).submit(_run_stage, stage, kwargs)
+            running[future] = stage
+
+        if not running:
+            if not pending:
+                break
+            raise ValueError(f"stages can not be scheduled: {[s.name for s in pending]}")
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.exception(f"stage failed: {stage.name}, error: {str(e)}")
+                return None
+
+            if result is None:
+                logger.error(f"stage failed: {stage.name}")
+                return None
+
+            if stage.name in input_hashes:
+                checkpoints.save(stage.name, input_hashes[stage.name], stage.dump(result))
+            _completed(stage, result)
+
+    return results
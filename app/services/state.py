@@ -1,9 +1,20 @@
 import ast
+import asyncio
+import json
+import threading
 from abc import ABC, abstractmethod
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from loguru import logger
+
 from app.config import config
 from app.models import const
 
 
+def event_channel(task_id: str) -> str:
+    return f"task_events:{task_id}"
+
+
 # Base class for state management
 class BaseState(ABC):
     @abstractmethod
@@ -11,7 +22,27 @@ class BaseState(ABC):
         pass
 
     @abstractmethod
+    def get_versioned_task(self, task_id: str) -> Tuple[Optional[dict], int]:
+        """
+        the task and its version, the version changes on every update and is
+        only used as the etag of the task
+        """
+        pass
+
     def get_task(self, task_id: str):
+        return self.get_versioned_task(task_id)[0]
+
+    def get_tasks(self, task_ids: List[str]) -> Dict[str, Optional[dict]]:
+        return {task_id: self.get_task(task_id) for task_id in task_ids}
+
+    @abstractmethod
+    def listen(self, task_id: str, timeout: float) -> AsyncIterator[Optional[dict]]:
+        """
+        async iterator of the updates of a task (the fields passed to
+        update_task), it yields None once subscribed and then every `timeout`
+        seconds without update, so that the caller can read a snapshot
+        without missing an update and keep its connection alive
+        """
         pass
 
 
@@ -19,6 +50,10 @@ class BaseState(ABC):
 class MemoryState(BaseState):
     def __init__(self):
         self._tasks = {}
+        self._versions = {}
+        # task_id => set of (loop, queue) of the listeners
+        self._listeners = {}
+        self._listeners_lock = threading.Lock()
 
     def update_task(
         self,
@@ -36,21 +71,67 @@ class MemoryState(BaseState):
             "progress": progress,
             **kwargs,
         }
+        # the version changes on every update, it is the etag of the task
+        self._versions[task_id] = self._versions.get(task_id, 0) + 1
+        self._publish(task_id, self._tasks[task_id])
 
-    def get_task(self, task_id: str):
-        return self._tasks.get(task_id, None)
+    def _publish(self, task_id: str, event: dict):
+        with self._listeners_lock:
+            listeners = list(self._listeners.get(task_id, ()))
+        # update_task is called from the worker threads, the event is handed
+        # over to the event loop of each listener
+        for loop, queue in listeners:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, dict(event))
+            except RuntimeError:
+                # the loop of the listener is closed
+                pass
+
+    async def listen(self, task_id: str, timeout: float):
+        listener = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._listeners_lock:
+            self._listeners.setdefault(task_id, set()).add(listener)
+        try:
+            yield None
+            while True:
+                try:
+                    yield await asyncio.wait_for(listener[1].get(), timeout)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            with self._listeners_lock:
+                listeners = self._listeners.get(task_id, set())
+                listeners.discard(listener)
+                if not listeners:
+                    self._listeners.pop(task_id, None)
+
+    def get_versioned_task(self, task_id: str) -> Tuple[Optional[dict], int]:
+        return self._tasks.get(task_id, None), self._versions.get(task_id, 0)
 
     def delete_task(self, task_id: str):
         if task_id in self._tasks:
             del self._tasks[task_id]
+        self._versions.pop(task_id, None)
 
 
 # Redis state management
 class RedisState(BaseState):
-    def __init__(self, host="localhost", port=6379, db=0, password=None):
+    """
+    a task is a redis hash, every update is written with a single pipelined
+    HSET and the values are stored as json. finished tasks expire after
+    `ttl` seconds when it is set.
+
+    every update is also published on the task_events:{task_id} channel, so
+    the listeners of any node receive the updates of the tasks run by the
+    other nodes.
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, ttl=0):
         import redis
 
         self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        self._connection = {"host": host, "port": port, "db": db, "password": password}
+        self._ttl = ttl
 
     def update_task(
         self,
@@ -69,17 +150,71 @@ class RedisState(BaseState):
             **kwargs,
         }
 
-        for field, value in fields.items():
-            self._redis.hset(task_id, field, str(value))
+        mapping = {
+            field: json.dumps(value, ensure_ascii=False, default=str)
+            for field, value in fields.items()
+        }
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.hset(task_id, mapping=mapping)
+        # the version changes on every update, it is the etag of the task
+        pipe.hincrby(task_id, "version", 1)
+        if self._ttl and state in (const.TASK_STATE_COMPLETE, const.TASK_STATE_FAILED):
+            pipe.expire(task_id, self._ttl)
+        else:
+            # a retried task must not expire while it runs
+            pipe.persist(task_id)
+        pipe.publish(
+            event_channel(task_id), json.dumps(fields, ensure_ascii=False, default=str)
+        )
+        pipe.execute()
 
-    def get_task(self, task_id: str):
+    async def listen(self, task_id: str, timeout: float):
+        import redis.asyncio as aioredis
+
+        # a connection per listener, pub/sub holds its connection anyway
+        client = aioredis.StrictRedis(**self._connection)
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(event_channel(task_id))
+            yield None
+            while True:
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=timeout
+                )
+                if message is None:
+                    yield None
+                    continue
+                try:
+                    yield json.loads(message["data"])
+                except ValueError as e:
+                    logger.warning(f"invalid task event: {task_id} => {str(e)}")
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+    def get_versioned_task(self, task_id: str) -> Tuple[Optional[dict], int]:
         task_data = self._redis.hgetall(task_id)
+        version = int(task_data.get(b"version", 0))
+        return self._decode_task(task_data), version
+
+    def get_tasks(self, task_ids: List[str]) -> Dict[str, Optional[dict]]:
+        # a single round trip for all the tasks
+        pipe = self._redis.pipeline(transaction=False)
+        for task_id in task_ids:
+            pipe.hgetall(task_id)
+        return {
+            task_id: self._decode_task(task_data)
+            for task_id, task_data in zip(task_ids, pipe.execute())
+        }
+
+    def _decode_task(self, task_data):
         if not task_data:
             return None
 
         task = {
             key.decode("utf-8"): self._convert_to_original_type(value)
             for key, value in task_data.items()
+            if key != b"version"
         }
         return task
 
@@ -95,7 +230,12 @@ class RedisState(BaseState):
         value_str = value.decode("utf-8")
 
         try:
-            # try to convert byte string array to list
+            return json.loads(value_str)
+        except ValueError:
+            pass
+
+        try:
+            # values written with str() by older versions
             return ast.literal_eval(value_str)
         except (ValueError, SyntaxError):
             pass
@@ -112,10 +252,16 @@ _redis_host = config.app.get("redis_host", "localhost")
 _redis_port = config.app.get("redis_port", 6379)
 _redis_db = config.app.get("redis_db", 0)
 _redis_password = config.app.get("redis_password", None)
+# seconds before a finished task is removed from redis, 0 means never
+_task_state_ttl = config.app.get("task_state_ttl", 0)
 
 state = (
     RedisState(
-        host=_redis_host, port=_redis_port, db=_redis_db, password=_redis_password
+        host=_redis_host,
+        port=_redis_port,
+        db=_redis_db,
+        password=_redis_password,
+        ttl=_task_state_ttl,
     )
     if _enable_redis
     else MemoryState()
@@ -1,63 +1,276 @@
 import json
 import os.path
+import queue
 import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from typing import List, Tuple
 
+import numpy as np
 from faster_whisper import WhisperModel
+from faster_whisper.audio import decode_audio
 from timeit import default_timer as timer
 from loguru import logger
 
 from app.config import config
+from app.models import const
 from app.utils import utils
 
 model_size = config.whisper.get("model_size", "large-v3")
 device = config.whisper.get("device", "cpu")
 compute_type = config.whisper.get("compute_type", "int8")
-model = None
+# number of model instances, each one is owned by a worker thread
+instances = config.whisper.get("instances", 1)
+# cpu threads used by each instance, 0 lets ctranslate2 decide
+cpu_threads = config.whisper.get("cpu_threads", 0)
+# number of queued audio files transcribed in a single pass
+batch_size = config.whisper.get("batch_size", 1)
+batch_max_duration = config.whisper.get("batch_max_duration", 60)
 
+_SAMPLING_RATE = 16000
+# silence inserted between the audio files of a batch
+_BATCH_GAP = 1.0
 
-def create(audio_file, subtitle_file: str = ""):
-    global model
-    if not model:
-        model_path = f"{utils.root_dir()}/models/whisper-{model_size}"
-        model_bin_file = f"{model_path}/model.bin"
-        if not os.path.isdir(model_path) or not os.path.isfile(model_bin_file):
-            model_path = model_size
-
-        logger.info(
-            f"loading model: {model_path}, device: {device}, compute_type: {compute_type}"
-        )
-        try:
-            model = WhisperModel(
-                model_size_or_path=model_path, device=device, compute_type=compute_type
-            )
-        except Exception as e:
-            logger.error(
-                f"failed to load model: {e} \n\n"
-                f"********************************************\n"
-                f"this may be caused by network issue. \n"
-                f"please download the model manually and put it in the 'models' folder. \n"
-                f"see [README.md FAQ](https://github.com/harry0703/MoneyPrinterTurbo) for more details.\n"
-                f"********************************************\n\n"
-            )
-            return None
+Word = namedtuple("Word", ["start", "end", "word"])
+Segment = namedtuple("Segment", ["start", "end", "words"])
 
-    logger.info(f"start, output file: {subtitle_file}")
-    if not subtitle_file:
-        subtitle_file = f"{audio_file}.srt"
 
+def load_model() -> WhisperModel:
+    model_path = f"{utils.root_dir()}/models/whisper-{model_size}"
+    model_bin_file = f"{model_path}/model.bin"
+    if not os.path.isdir(model_path) or not os.path.isfile(model_bin_file):
+        model_path = model_size
+
+    logger.info(
+        f"loading model: {model_path}, device: {device}, compute_type: {compute_type}, "
+        f"cpu_threads: {cpu_threads}"
+    )
+    return WhisperModel(
+        model_size_or_path=model_path,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+    )
+
+
+def _transcribe(model: WhisperModel, audio) -> List[Segment]:
     segments, info = model.transcribe(
-        audio_file,
+        audio,
         beam_size=5,
         word_timestamps=True,
         vad_filter=True,
         vad_parameters=dict(min_silence_duration_ms=500),
     )
-
     logger.info(
         f"detected language: '{info.language}', probability: {info.language_probability:.2f}"
     )
+    return [
+        Segment(
+            start=segment.start,
+            end=segment.end,
+            words=[Word(w.start, w.end, w.word) for w in (segment.words or [])],
+        )
+        for segment in segments
+    ]
+
+
+class WhisperPool:
+    """
+    a fixed number of whisper models, each one owned by a worker thread that
+    takes transcription requests from a shared queue, so the models are loaded
+    once and a model is never used by two tasks at the same time.
+
+    when batch_size > 1, the short audio files waiting in the queue are joined
+    with silence and transcribed in one pass, the words are then split back
+    per file. the files of a batch are expected to share the same language.
+    """
+
+    def __init__(self, size: int = 1):
+        self.size = max(1, size)
+        self.error = None
+        self._queue = queue.Queue()
+        self._workers = []
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        # a failed load is retried by the next start(), after a backoff
+        self._failures = 0
+        self._retry_at = 0.0
+
+    def start(self, wait: bool = True) -> "WhisperPool":
+        with self._lock:
+            if not self._workers and time.time() >= self._retry_at:
+                self._ready.clear()
+                for i in range(self.size):
+                    worker = threading.Thread(
+                        target=self._run, name=f"whisper-{i}", daemon=True
+                    )
+                    worker.start()
+                    self._workers.append(worker)
+        if wait and self._workers:
+            self._ready.wait()
+        return self
+
+    def submit(self, audio_file: str) -> Future:
+        future = Future()
+        with self._lock:
+            if self._workers:
+                self._queue.put((audio_file, future))
+            else:
+                future.set_exception(self.error or RuntimeError("whisper is not started"))
+        return future
+
+    def _load_failed(self, e: Exception):
+        with self._lock:
+            self._workers.remove(threading.current_thread())
+            if self._workers:
+                logger.error(f"failed to load whisper model, {len(self._workers)} left")
+                return
+
+            self.error = e
+            self._failures += 1
+            delay = min(300, 5 * 2 ** (self._failures - 1))
+            self._retry_at = time.time() + delay
+            logger.error(f"failed to load whisper model: {str(e)}, retry in {delay}s")
+            # only the requests already queued fail, the next ones retry the load
+            while True:
+                try:
+                    _, future = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            self._ready.set()
+
+    def _run(self):
+        try:
+            model = load_model()
+        except Exception as e:
+            self._load_failed(e)
+            return
+
+        with self._lock:
+            self.error = None
+            self._failures = 0
+        self._ready.set()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [(a, f) for a, f in batch if f.set_running_or_notify_cancel()]
+            if len(batch) == 1:
+                self._transcribe_one(model, *batch[0])
+            elif batch:
+                self._transcribe_batch(model, batch)
+
+    @staticmethod
+    def _transcribe_one(model, audio, future: Future):
+        try:
+            future.set_result(_transcribe(model, audio))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _transcribe_batch(self, model, batch):
+        joined = []
+        joined_duration = 0.0
+        for audio_file, future in batch:
+            try:
+                audio = decode_audio(audio_file, sampling_rate=_SAMPLING_RATE)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            duration = len(audio) / _SAMPLING_RATE
+            if joined and joined_duration + duration > batch_max_duration:
+                self._transcribe_one(model, audio, future)
+                continue
+            joined.append((joined_duration, duration, audio, future))
+            joined_duration += duration + _BATCH_GAP
+
+        if len(joined) == 1:
+            _, _, audio, future = joined[0]
+            self._transcribe_one(model, audio, future)
+            return
+        if not joined:
+            return
+
+        gap = np.zeros(int(_BATCH_GAP * _SAMPLING_RATE), dtype=np.float32)
+        parts = []
+        for _, _, audio, _ in joined:
+            parts += [audio, gap]
+        try:
+            segments = _transcribe(model, np.concatenate(parts))
+        except Exception as e:
+            for _, _, _, future in joined:
+                future.set_exception(e)
+            return
+        logger.info(f"transcribed {len(joined)} audio files in one pass")
+
+        # a segment may span two files, so regroup its words per file
+        offsets = [offset for offset, _, _, _ in joined]
+        results = [[] for _ in joined]
+        for segment in segments:
+            words_per_file = {}
+            for word in segment.words:
+                idx = 0
+                while idx + 1 < len(offsets) and word.start >= offsets[idx + 1] - _BATCH_GAP / 2:
+                    idx += 1
+                offset = offsets[idx]
+                words_per_file.setdefault(idx, []).append(
+                    Word(word.start - offset, word.end - offset, word.word)
+                )
+            for idx, words in words_per_file.items():
+                results[idx].append(Segment(words[0].start, words[-1].end, words))
+
+        for (_, _, _, future), segments in zip(joined, results):
+            future.set_result(segments)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> WhisperPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WhisperPool(size=instances)
+        return _pool
+
+
+def preload():
+    """
+    load the models in the background, so the first task does not pay for it
+    """
+    get_pool().start(wait=False)
+
+
+def transcribe(audio_file: str) -> List[Segment]:
+    return get_pool().start().submit(audio_file).result()
+
+
+def create(audio_file, subtitle_file: str = ""):
+    logger.info(f"start, output file: {subtitle_file}")
+    if not subtitle_file:
+        subtitle_file = f"{audio_file}.srt"
 
     start = timer()
+    try:
+        segments = transcribe(audio_file)
+    except Exception as e:
+        logger.error(
+            f"failed to transcribe audio: {e} \n\n"
+            f"********************************************\n"
+            f"this may be caused by network issue. \n"
+            f"please download the model manually and put it in the 'models' folder. \n"
+            f"see [README.md FAQ](https://github.com/harry0703/MoneyPrinterTurbo) for more details.\n"
+            f"********************************************\n\n"
+        )
+        return None
+
     subtitles = []
 
     def recognized(seg_text, seg_start, seg_end):
@@ -158,6 +371,25 @@ def file_to_subtitles(filename):
     return times_texts
 
 
+_INF = 1 << 30
+# extra diagonals kept around the main diagonal by the banded alignment
+_ALIGN_BAND = 64
+# traceback moves of the alignment
+_MATCH, _SKIP_SCRIPT, _SKIP_SUBTITLE = 0, 1, 2
+
+
+def _edit_row(prev_row, c1, s2_codes, row_start):
+    """
+    next row of the levenshtein matrix, the insertions are chained along the
+    row with a running minimum instead of a python loop:
+    row[j] = min_k(t[k] + j - k) = min.accumulate(t - j) + j
+    """
+    t = np.minimum(prev_row[1:] + 1, prev_row[:-1] + (s2_codes != c1))
+    t = np.concatenate(([row_start], t))
+    offsets = np.arange(len(t), dtype=np.int64)
+    return np.minimum.accumulate(t - offsets) + offsets
+
+
 def levenshtein_distance(s1, s2):
     if len(s1) < len(s2):
         return levenshtein_distance(s2, s1)
@@ -165,117 +397,174 @@ def levenshtein_distance(s1, s2):
     if len(s2) == 0:
         return len(s1)
 
-    previous_row = range(len(s2) + 1)
+    s2_codes = np.array([ord(c) for c in s2], dtype=np.int64)
+    previous_row = np.arange(len(s2) + 1, dtype=np.int64)
     for i, c1 in enumerate(s1):
-        current_row = [i + 1]
-        for j, c2 in enumerate(s2):
-            insertions = previous_row[j + 1] + 1
-            deletions = current_row[j] + 1
-            substitutions = previous_row[j] + (c1 != c2)
-            current_row.append(min(insertions, deletions, substitutions))
-        previous_row = current_row
+        previous_row = _edit_row(previous_row, ord(c1), s2_codes, i + 1)
 
-    return previous_row[-1]
+    return int(previous_row[-1])
 
 
 def similarity(a, b):
     distance = levenshtein_distance(a.lower(), b.lower())
     max_length = max(len(a), len(b))
+    if max_length == 0:
+        return 1.0
     return 1 - (distance / max_length)
 
 
-def correct(subtitle_file, video_script):
-    subtitle_items = file_to_subtitles(subtitle_file)
-    script_lines = utils.split_string_by_punctuations(video_script)
+def _align_chars(a: str, b: str) -> List[Tuple[int, int]]:
+    """
+    globally align two strings with a banded edit distance and return, for
+    each char of `a`, the span [start, end) of `b` it is aligned to (empty
+    when the char is missing from `b`).
+
+    the costs are kept in two rows and only the moves inside the band are
+    stored, so memory grows with len(a) * band instead of len(a) * len(b).
+    """
+    n, m = len(a), len(b)
+    band = abs(n - m) + _ALIGN_BAND
+    b_codes = np.array([ord(c) for c in b], dtype=np.int64)
+
+    bounds = []
+    moves = []
+    prev_row = np.full(m + 1, _INF, dtype=np.int64)
+    hi = min(m, band)
+    prev_row[: hi + 1] = np.arange(hi + 1)
+    bounds.append((0, hi))
+    moves.append(np.full(hi + 1, _SKIP_SUBTITLE, dtype=np.uint8))
+
+    for i in range(1, n + 1):
+        center = i * m // max(n, 1)
+        lo, hi = max(0, center - band), min(m, center + band)
+        row = np.full(m + 1, _INF, dtype=np.int64)
+        start = max(lo, 1)
+        sub = prev_row[start - 1 : hi] + (b_codes[start - 1 : hi] != ord(a[i - 1]))
+        skip = prev_row[start : hi + 1] + 1
+        t = np.minimum(sub, skip)
+        row_moves = np.where(sub <= skip, _MATCH, _SKIP_SCRIPT).astype(np.uint8)
+
+        left = i if lo == 0 else _INF
+        t = np.concatenate(([left], t))
+        offsets = np.arange(len(t), dtype=np.int64)
+        chained = np.minimum.accumulate(t - offsets) + offsets
+        row_moves[chained[1:] < t[1:]] = _SKIP_SUBTITLE
+        row[start - 1 : hi + 1] = np.minimum(chained, _INF)
+        if lo == 0:
+            row_moves = np.concatenate(([_SKIP_SCRIPT], row_moves))
+
+        bounds.append((lo, hi))
+        moves.append(row_moves)
+        prev_row = row
+
+    spans = [(0, 0)] * n
+    i, j = n, m
+    while i > 0:
+        lo, _ = bounds[i]
+        move = moves[i][j - lo]
+        if move == _MATCH:
+            spans[i - 1] = (j - 1, j)
+            i, j = i - 1, j - 1
+        elif move == _SKIP_SCRIPT:
+            spans[i - 1] = (j, j)
+            i -= 1
+        else:
+            j -= 1
+    return spans
 
-    corrected = False
-    new_subtitle_items = []
-    script_index = 0
-    subtitle_index = 0
 
-    while script_index < len(script_lines) and subtitle_index < len(subtitle_items):
-        script_line = script_lines[script_index].strip()
-        subtitle_line = subtitle_items[subtitle_index][2].strip()
+def _srt_time_to_seconds(value: str) -> float:
+    hours, minutes, seconds = value.strip().replace(",", ".").split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def _normalize_text(text: str) -> str:
+    return "".join(
+        c for c in text.lower() if not c.isspace() and c not in const.PUNCTUATIONS
+    )
+
 
-        if script_line == subtitle_line:
-            new_subtitle_items.append(subtitle_items[subtitle_index])
-            script_index += 1
-            subtitle_index += 1
+def align(subtitle_items, script_lines) -> List[Tuple[str, float, float]]:
+    """
+    align the whole script to the whole transcript in one pass and return the
+    (script line, start time, end time) of every script line.
+
+    the transcript chars get a time interpolated inside their subtitle item,
+    a script line starts at its first aligned char and ends at its last one,
+    so a line can merge several subtitle items or take part of one.
+    """
+    transcript = ""
+    char_times = []
+    for _, times, text in subtitle_items:
+        start_time, end_time = [_srt_time_to_seconds(t) for t in times.split(" --> ")]
+        chars = _normalize_text(text)
+        step = (end_time - start_time) / max(len(chars), 1)
+        for k in range(len(chars)):
+            char_times.append((start_time + k * step, start_time + (k + 1) * step))
+        transcript += chars
+
+    script = ""
+    line_bounds = []
+    for line in script_lines:
+        chars = _normalize_text(line)
+        line_bounds.append((len(script), len(script) + len(chars)))
+        script += chars
+
+    spans = _align_chars(script, transcript)
+
+    def start_at(pos):
+        if pos < len(char_times):
+            return char_times[pos][0]
+        return char_times[-1][1] if char_times else 0.0
+
+    def end_at(pos):
+        if pos > 0:
+            return char_times[pos - 1][1]
+        return char_times[0][0] if char_times else 0.0
+
+    aligned = []
+    for line, (p, q) in zip(script_lines, line_bounds):
+        if q > p:
+            begin, end = spans[p][0], spans[q - 1][1]
         else:
-            combined_subtitle = subtitle_line
-            start_time = subtitle_items[subtitle_index][1].split(" --> ")[0]
-            end_time = subtitle_items[subtitle_index][1].split(" --> ")[1]
-            next_subtitle_index = subtitle_index + 1
-
-            while next_subtitle_index < len(subtitle_items):
-                next_subtitle = subtitle_items[next_subtitle_index][2].strip()
-                if similarity(
-                    script_line, combined_subtitle + " " + next_subtitle
-                ) > similarity(script_line, combined_subtitle):
-                    combined_subtitle += " " + next_subtitle
-                    end_time = subtitle_items[next_subtitle_index][1].split(" --> ")[1]
-                    next_subtitle_index += 1
-                else:
-                    break
+            begin = end = spans[p][0] if p < len(spans) else len(transcript)
+        start_time = start_at(begin)
+        end_time = end_at(end) if end > begin else start_time
+        aligned.append((line, start_time, end_time, transcript[begin:end]))
+    return aligned
 
-            if similarity(script_line, combined_subtitle) > 0.8:
-                logger.warning(
-                    f"Merged/Corrected - Script: {script_line}, Subtitle: {combined_subtitle}"
-                )
-                new_subtitle_items.append(
-                    (
-                        len(new_subtitle_items) + 1,
-                        f"{start_time} --> {end_time}",
-                        script_line,
-                    )
-                )
-                corrected = True
-            else:
-                logger.warning(
-                    f"Mismatch - Script: {script_line}, Subtitle: {combined_subtitle}"
-                )
-                new_subtitle_items.append(
-                    (
-                        len(new_subtitle_items) + 1,
-                        f"{start_time} --> {end_time}",
-                        script_line,
-                    )
-                )
-                corrected = True
-
-            script_index += 1
-            subtitle_index = next_subtitle_index
-
-    # 处理剩余的脚本行
-    while script_index < len(script_lines):
-        logger.warning(f"Extra script line: {script_lines[script_index]}")
-        if subtitle_index < len(subtitle_items):
-            new_subtitle_items.append(
-                (
-                    len(new_subtitle_items) + 1,
-                    subtitle_items[subtitle_index][1],
-                    script_lines[script_index],
-                )
-            )
-            subtitle_index += 1
+
+def correct(subtitle_file, video_script):
+    subtitle_items = file_to_subtitles(subtitle_file)
+    script_lines = [line.strip() for line in utils.split_string_by_punctuations(video_script)]
+
+    subtitle_lines = [item[2].strip() for item in subtitle_items]
+    if subtitle_lines == script_lines:
+        logger.success("Subtitle is correct")
+        return
+
+    start = timer()
+    new_subtitle_items = []
+    for script_line, start_time, end_time, matched in align(subtitle_items, script_lines):
+        if not matched:
+            logger.warning(f"Extra script line: {script_line}")
+        elif similarity(_normalize_text(script_line), matched) > 0.8:
+            logger.debug(f"Merged/Corrected - Script: {script_line}, Subtitle: {matched}")
         else:
-            new_subtitle_items.append(
-                (
-                    len(new_subtitle_items) + 1,
-                    "00:00:00,000 --> 00:00:00,000",
-                    script_lines[script_index],
-                )
+            logger.warning(f"Mismatch - Script: {script_line}, Subtitle: {matched}")
+        new_subtitle_items.append(
+            (
+                len(new_subtitle_items) + 1,
+                f"{utils.time_convert_seconds_to_hmsm(start_time)} --> "
+                f"{utils.time_convert_seconds_to_hmsm(end_time)}",
+                script_line,
             )
-        script_index += 1
-        corrected = True
-
-    if corrected:
-        with open(subtitle_file, "w", encoding="utf-8") as fd:
-            for i, item in enumerate(new_subtitle_items):
-                fd.write(f"{i + 1}\n{item[1]}\n{item[2]}\n\n")
-        logger.info("Subtitle corrected")
-    else:
-        logger.success("Subtitle is correct")
+        )
+
+    with open(subtitle_file, "w", encoding="utf-8") as fd:
+        for i, item in enumerate(new_subtitle_items):
+            fd.write(f"{i + 1}\n{item[1]}\n{item[2]}\n\n")
+    logger.info(f"Subtitle corrected, elapsed: {timer() - start:.2f} s")
 
 
 if __name__ == "__main__":
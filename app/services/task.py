@@ -1,7 +1,9 @@
-import math
+import multiprocessing
 import os.path
 import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from os import path
+from typing import Dict
 
 from edge_tts import SubMaker
 from loguru import logger
@@ -9,8 +11,9 @@ from loguru import logger
 from app.config import config
 from app.models import const
 from app.models.schema import VideoConcatMode, VideoParams
-from app.services import llm, material, subtitle, video, voice
+from app.services import llm, material, render, scheduler, subtitle, video, voice
 from app.services import state as sm
+from app.services.checkpoint import Checkpoints
 from app.utils import utils
 
 
@@ -22,6 +25,7 @@ def generate_script(task_id, params):
             video_subject=params.video_subject,
             language=params.video_language,
             paragraph_number=params.paragraph_number,
+            use_cache=getattr(params, "use_llm_cache", True),
         )
     else:
         logger.debug(f"video script: \n{video_script}")
@@ -34,12 +38,61 @@ def generate_script(task_id, params):
     return video_script
 
 
+def generate_script_and_terms(task_id, params):
+    logger.info("\n\n## generating video script and terms")
+    video_script, video_terms = llm.generate_script_and_terms(
+        video_subject=params.video_subject,
+        language=params.video_language,
+        paragraph_number=params.paragraph_number,
+        amount=5,
+        use_cache=getattr(params, "use_llm_cache", True),
+    )
+    if not video_script or not video_terms:
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        logger.error("failed to generate video script and terms.")
+        return None, None
+
+    return video_script, video_terms
+
+
+def generate_streamed_script(task_id, params, synthesizer):
+    """
+    every sentence of the script is sent to the synthesizer as soon as it is
+    generated, and its lines to the subtitle builder of the synthesizer, falls
+    back to generate_script if the stream fails
+    """
+    logger.info("\n\n## generating video script, streamed to the tts")
+    sentences = []
+    try:
+        for sentence in llm.stream_script(
+            video_subject=params.video_subject,
+            language=params.video_language,
+            paragraph_number=params.paragraph_number,
+            use_cache=getattr(params, "use_llm_cache", True),
+        ):
+            if synthesizer.subtitle_builder:
+                synthesizer.subtitle_builder.add_text(sentence)
+            synthesizer.add(sentence)
+            sentences.append(sentence)
+    except Exception as e:
+        logger.warning(f"failed to stream the video script: {str(e)}, retry")
+        synthesizer.cancel()
+        return generate_script(task_id, params), None
+
+    video_script = "".join(sentences).strip()
+    logger.debug(f"video script: \n{video_script}")
+    return video_script, synthesizer
+
+
 def generate_terms(task_id, params, video_script):
     logger.info("\n\n## generating video terms")
     video_terms = params.video_terms
     if not video_terms:
         video_terms = llm.generate_terms(
-            video_subject=params.video_subject, video_script=video_script, amount=5
+            video_subject=params.video_subject,
+            video_script=video_script,
+            amount=5,
+            use_cache=getattr(params, "use_llm_cache", True),
         )
     else:
         if isinstance(video_terms, str):
@@ -71,14 +124,18 @@ def save_script_data(task_id, video_script, video_terms, params):
         f.write(utils.to_json(script_data))
 
 
-def generate_audio(task_id, params, video_script):
+def generate_audio(task_id, params, video_script, subtitle_builder=None):
     logger.info("\n\n## generating audio")
     audio_file = path.join(utils.task_dir(task_id), "audio.mp3")
-    sub_maker = voice.tts(
+    tts = voice.tts
+    if config.app.get("tts_split_sentences", True):
+        tts = voice.tts_sentences
+    sub_maker = tts(
         text=video_script,
         voice_name=voice.parse_voice_name(params.voice_name),
         voice_rate=params.voice_rate,
         voice_file=audio_file,
+        subtitle_builder=subtitle_builder,
     )
     if sub_maker is None:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -90,11 +147,13 @@ def generate_audio(task_id, params, video_script):
         )
         return None, None, None
 
-    audio_duration = math.ceil(voice.get_audio_duration(sub_maker))
+    audio_duration = voice.get_audio_duration(sub_maker, audio_file)
     return audio_file, audio_duration, sub_maker
 
 
-def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
+def generate_subtitle(
+    task_id, params, video_script, sub_maker, audio_file, subtitle_builder=None
+):
     if not params.subtitle_enabled:
         return ""
 
@@ -104,9 +163,13 @@ def generate_subtitle(task_id, params, video_script, sub_maker, audio_file):
 
     subtitle_fallback = False
     if subtitle_provider == "edge":
-        voice.create_subtitle(
-            text=video_script, sub_maker=sub_maker, subtitle_file=subtitle_path
-        )
+        if subtitle_builder:
+            # the lines were built while the audio was streamed
+            subtitle_builder.write(subtitle_path)
+        else:
+            voice.create_subtitle(
+                text=video_script, sub_maker=sub_maker, subtitle_file=subtitle_path
+            )
         if not os.path.exists(subtitle_path):
             subtitle_fallback = True
             logger.warning("subtitle file not found, fallback to whisper")
@@ -157,53 +220,428 @@ def get_video_materials(task_id, params, video_terms, audio_duration):
         return downloaded_videos
 
 
+def _generate_final_video_moviepy(
+    downloaded_videos,
+    audio_file,
+    subtitle_path,
+    params,
+    video_concat_mode,
+    combined_video_path,
+    final_video_path,
+):
+    logger.info(f"\n\n## combining video: {combined_video_path}")
+    video.combine_videos(
+        combined_video_path=combined_video_path,
+        video_paths=downloaded_videos,
+        audio_file=audio_file,
+        video_aspect=params.video_aspect,
+        video_concat_mode=video_concat_mode,
+        max_clip_duration=params.video_clip_duration,
+        threads=params.n_threads,
+    )
+
+    logger.info(f"\n\n## generating video: {final_video_path}")
+    video.generate_video(
+        video_path=combined_video_path,
+        audio_path=audio_file,
+        subtitle_path=subtitle_path,
+        output_file=final_video_path,
+        params=params,
+    )
+    return final_video_path
+
+
+def _with_render_slot(func, *args, **kwargs):
+    with render.render_slots():
+        return func(*args, **kwargs)
+
+
 def generate_final_videos(
         task_id, params, downloaded_videos, audio_file, subtitle_path
 ):
-    final_video_paths = []
-    combined_video_paths = []
     video_concat_mode = (
         params.video_concat_mode if params.video_count == 1 else VideoConcatMode.random
     )
+    render_engine = config.app.get("render_engine", "ffmpeg").strip().lower()
+    max_workers = render.max_parallel_renders(params.n_threads, params.video_count)
 
-    _progress = 50
+    final_video_paths = {}
+    combined_video_paths = {}
+    variants = {}
     for i in range(params.video_count):
         index = i + 1
-        combined_video_path = path.join(
-            utils.task_dir(task_id), f"combined-{index}.mp4"
-        )
-        logger.info(f"\n\n## combining video: {index} => {combined_video_path}")
-        video.combine_videos(
-            combined_video_path=combined_video_path,
-            video_paths=downloaded_videos,
-            audio_file=audio_file,
-            video_aspect=params.video_aspect,
-            video_concat_mode=video_concat_mode,
-            max_clip_duration=params.video_clip_duration,
-            threads=params.n_threads,
+        variants[index] = (
+            path.join(utils.task_dir(task_id), f"combined-{index}.mp4"),
+            path.join(utils.task_dir(task_id), f"final-{index}.mp4"),
         )
 
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
+    _progress = 50
 
-        final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
+    def on_completed(index, keep_combined_video):
+        nonlocal _progress
+        combined_video_path, final_video_path = variants[index]
+        final_video_paths[index] = final_video_path
+        if keep_combined_video:
+            combined_video_paths[index] = combined_video_path
+        _progress += 50 / params.video_count
+        sm.state.update_task(task_id, progress=_progress)
 
-        logger.info(f"\n\n## generating video: {index} => {final_video_path}")
-        video.generate_video(
-            video_path=combined_video_path,
-            audio_path=audio_file,
-            subtitle_path=subtitle_path,
-            output_file=final_video_path,
-            params=params,
+    pending = list(variants.keys())
+    if render_engine == "ffmpeg":
+        try:
+            plans = render.plan_variants(
+                video_paths=downloaded_videos,
+                audio_file=audio_file,
+                params=params,
+                video_concat_mode=video_concat_mode,
+            )
+        except Exception as e:
+            logger.error(f"failed to plan videos: {str(e)}")
+            plans = []
+
+        # every render is an ffmpeg process using n_threads cores, threads are
+        # enough to fan them out
+        failed = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for index, plan in zip(variants.keys(), plans):
+                combined_video_path, final_video_path = variants[index]
+                logger.info(f"\n\n## rendering video: {index} => {final_video_path}")
+                future = executor.submit(
+                    _with_render_slot,
+                    render.render_video,
+                    output_file=final_video_path,
+                    video_paths=downloaded_videos,
+                    audio_file=audio_file,
+                    subtitle_path=subtitle_path,
+                    params=params,
+                    video_concat_mode=video_concat_mode,
+                    combined_video_path=(
+                        combined_video_path if params.combined_video_enabled else ""
+                    ),
+                    threads=params.n_threads,
+                    clips=plan,
+                )
+                futures[future] = index
+
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    future.result()
+                    on_completed(index, params.combined_video_enabled)
+                except Exception as e:
+                    logger.error(
+                        f"failed to render video {index} with ffmpeg, fallback to moviepy: {str(e)}"
+                    )
+                    failed.append(index)
+
+        pending = sorted(failed) + [i for i in variants if i > len(plans)]
+
+    if len(pending) == 1:
+        index = pending[0]
+        combined_video_path, final_video_path = variants[index]
+        _with_render_slot(
+            _generate_final_video_moviepy,
+            downloaded_videos,
+            audio_file,
+            subtitle_path,
+            params,
+            video_concat_mode,
+            combined_video_path,
+            final_video_path,
         )
+        on_completed(index, True)
+    elif pending:
+        # moviepy renders in python, so the variants are spread over processes
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(pending)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            # the slots are taken before a job is submitted, so the renders of
+            # all the tasks of the process share the limit
+            slots = render.render_slots()
+            futures = {}
+            for index in pending:
+                combined_video_path, final_video_path = variants[index]
+                slots.acquire()
+                try:
+                    future = executor.submit(
+                        _generate_final_video_moviepy,
+                        downloaded_videos,
+                        audio_file,
+                        subtitle_path,
+                        params,
+                        video_concat_mode,
+                        combined_video_path,
+                        final_video_path,
+                    )
+                except Exception:
+                    slots.release()
+                    raise
+                future.add_done_callback(lambda _: slots.release())
+                futures[future] = index
+
+            failed = []
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    future.result()
+                    on_completed(index, True)
+                except Exception as e:
+                    logger.error(f"failed to generate video {index}: {str(e)}")
+                    failed.append(index)
+
+        # a task never completes with fewer videos than video_count
+        if failed:
+            raise RuntimeError(f"failed to generate videos: {sorted(failed)}")
+
+    return (
+        [final_video_paths[i] for i in sorted(final_video_paths)],
+        [combined_video_paths[i] for i in sorted(combined_video_paths)],
+    )
 
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
 
-        final_video_paths.append(final_video_path)
-        combined_video_paths.append(combined_video_path)
+# stages in the order of the stop_at values, a task runs every stage up to
+# stop_at, independent stages run at the same time
+_STAGES = ["script", "terms", "audio", "subtitle", "materials", "video"]
+# progress added when a stage completes, the render goes from 50 to 100
+_STAGE_PROGRESS = {"script": 5, "terms": 10, "audio": 10, "subtitle": 10, "materials": 10}
+
+
+def _params_inputs(params, *fields):
+    return {field: getattr(params, field, None) for field in fields}
+
 
-    return final_video_paths, combined_video_paths
+def _files_exist(files) -> bool:
+    return all(f and os.path.isfile(f) and os.path.getsize(f) > 0 for f in files)
+
+
+def build_stages(
+    task_id, params: VideoParams, stop_at: str = "video", streamed_audio: Dict = None
+):
+    """
+    script ─┬─ terms ──────────── materials ─┐
+            └─ audio ─ subtitle ─────────────┴─ video
+
+    the materials only need the terms and the audio duration, so they are
+    searched and downloaded with a duration estimated from the script while
+    the audio and the subtitle are generated, unless overlap_stages is false.
+
+    the output of every stage is checkpointed with the hash of its inputs,
+    see scheduler.Stage
+
+    the synthesizers of the streamed scripts are kept in `streamed_audio`
+    until the audio stage takes them, the caller cancels the ones left
+    """
+    overlap_stages = config.app.get("overlap_stages", True)
+    stop_index = _STAGES.index(stop_at) if stop_at in _STAGES else len(_STAGES) - 1
+    # the script and the terms are generated by a single llm request when
+    # both are needed, the terms are kept for the terms stage
+    script_with_terms = (
+        config.app.get("llm_script_with_terms", True)
+        and not params.video_script.strip()
+        and not getattr(params, "video_terms", None)
+        and params.video_source != "local"
+        and _STAGES.index("terms") <= stop_index
+    )
+    # the sentences of the script are synthesized while it is generated, the
+    # synthesizer is kept for the audio stage
+    stream_tts = (
+        config.app.get("llm_stream_tts", False)
+        and not params.video_script.strip()
+        and _STAGES.index("audio") <= stop_index
+    )
+    script_with_terms = script_with_terms and not stream_tts
+    generated_terms = {}
+    if streamed_audio is None:
+        streamed_audio = {}
+
+    def _subtitle_builder(script):
+        subtitle_provider = config.app.get("subtitle_provider", "").strip().lower()
+        if params.subtitle_enabled and subtitle_provider == "edge":
+            return voice.SubtitleBuilder(script)
+        return None
+
+    def _script():
+        if stream_tts:
+            synthesizer = voice.SentenceSynthesizer(
+                voice_name=voice.parse_voice_name(params.voice_name),
+                voice_rate=params.voice_rate,
+                voice_file=path.join(utils.task_dir(task_id), "audio.mp3"),
+                # the lines are added as the script is streamed
+                subtitle_builder=_subtitle_builder(""),
+            )
+            video_script, synthesizer = generate_streamed_script(
+                task_id, params, synthesizer
+            )
+            if video_script and synthesizer:
+                streamed_audio[video_script] = synthesizer
+            return video_script
+        if not script_with_terms:
+            return generate_script(task_id, params)
+        video_script, video_terms = generate_script_and_terms(task_id, params)
+        if video_script:
+            generated_terms[video_script] = video_terms
+        return video_script
+
+    def _terms(script):
+        video_terms = ""
+        if params.video_source != "local":
+            video_terms = generated_terms.get(script) or generate_terms(
+                task_id, params, script
+            )
+            if not video_terms:
+                return None
+        save_script_data(task_id, script, video_terms, params)
+        return video_terms
+
+    def _audio(script):
+        synthesizer = streamed_audio.pop(script, None)
+        if synthesizer:
+            logger.info("\n\n## generating audio, joining the streamed sentences")
+            try:
+                sub_maker = synthesizer.finish()
+                if sub_maker:
+                    audio_duration = voice.get_audio_duration(
+                        sub_maker, synthesizer.voice_file
+                    )
+                    return (
+                        synthesizer.voice_file,
+                        audio_duration,
+                        sub_maker,
+                        synthesizer.subtitle_builder,
+                    )
+            except Exception as e:
+                logger.warning(f"failed to join the streamed audio: {str(e)}")
+
+        subtitle_builder = _subtitle_builder(script)
+        audio_file, audio_duration, sub_maker = generate_audio(
+            task_id, params, script, subtitle_builder
+        )
+        if not audio_file:
+            return None
+        return audio_file, audio_duration, sub_maker, subtitle_builder
+
+    def _subtitle(script, audio):
+        audio_file, _, sub_maker, subtitle_builder = audio
+        return generate_subtitle(
+            task_id, params, script, sub_maker, audio_file, subtitle_builder
+        )
+
+    def _materials(script, terms, audio=None):
+        if audio:
+            audio_duration = audio[1]
+        else:
+            audio_duration = voice.estimate_duration(
+                script, params.voice_rate
+            ) * config.app.get("estimated_duration_margin", 1.2)
+            logger.info(f"estimated audio duration: {audio_duration:.2f}s")
+        return get_video_materials(task_id, params, terms, audio_duration)
+
+    def _video(audio, subtitle, materials):
+        final_video_paths, combined_video_paths = generate_final_videos(
+            task_id, params, materials, audio[0], subtitle
+        )
+        if not final_video_paths:
+            return None
+        return final_video_paths, combined_video_paths
+
+    materials_deps = ["script", "terms"]
+    if not overlap_stages:
+        materials_deps.append("audio")
+
+    def _dump_audio(audio):
+        audio_file, audio_duration, sub_maker, _ = audio
+        return {
+            "audio_file": audio_file,
+            "audio_duration": audio_duration,
+            "offset": sub_maker.offset,
+            "subs": sub_maker.subs,
+        }
+
+    def _load_audio(output):
+        audio_file = output["audio_file"]
+        if not _files_exist([audio_file]):
+            return None
+        sub_maker = SubMaker()
+        sub_maker.offset = [tuple(offset) for offset in output["offset"]]
+        sub_maker.subs = list(output["subs"])
+        # without a builder, the subtitle is created from the sub maker
+        return audio_file, output["audio_duration"], sub_maker, None
+
+    def _load_files(output):
+        return output if _files_exist(output) else None
+
+    def _load_subtitle(output):
+        return output if not output or _files_exist([output]) else None
+
+    def _load_video(output):
+        videos, combined_videos = output
+        return output if _files_exist(videos + combined_videos) else None
+
+    stages = [
+        scheduler.Stage(
+            "script",
+            _script,
+            inputs={
+                **_params_inputs(
+                    params, "video_subject", "video_script", "video_language", "paragraph_number"
+                ),
+                "llm_provider": config.app.get("llm_provider", ""),
+            },
+        ),
+        scheduler.Stage(
+            "terms",
+            _terms,
+            deps=["script"],
+            inputs=_params_inputs(params, "video_subject", "video_terms", "video_source"),
+        ),
+        scheduler.Stage(
+            "audio",
+            _audio,
+            deps=["script"],
+            inputs=_params_inputs(params, "voice_name", "voice_rate"),
+            dump=_dump_audio,
+            load=_load_audio,
+        ),
+        scheduler.Stage(
+            "subtitle",
+            _subtitle,
+            deps=["script", "audio"],
+            inputs={
+                **_params_inputs(params, "subtitle_enabled"),
+                "subtitle_provider": config.app.get("subtitle_provider", ""),
+            },
+            load=_load_subtitle,
+        ),
+        scheduler.Stage(
+            "materials",
+            _materials,
+            deps=materials_deps,
+            inputs=_params_inputs(
+                params,
+                "video_source",
+                "video_materials",
+                "video_aspect",
+                "video_concat_mode",
+                "video_clip_duration",
+                "video_count",
+            ),
+            load=_load_files,
+        ),
+        scheduler.Stage(
+            "video",
+            _video,
+            deps=["audio", "subtitle", "materials"],
+            pool=scheduler.POOL_CPU,
+            inputs={
+                "params": params.model_dump(),
+                "render_engine": config.app.get("render_engine", "ffmpeg"),
+            },
+            load=_load_video,
+        ),
+    ]
+    return [stage for stage in stages if _STAGES.index(stage.name) <= stop_index]
 
 
 def start(task_id, params: VideoParams, stop_at: str = "video"):
@@ -212,47 +650,59 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
 
     if type(params.video_concat_mode) is str:
         params.video_concat_mode = VideoConcatMode(params.video_concat_mode)
-        
-    # 1. Generate script
-    video_script = generate_script(task_id, params)
-    if not video_script:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=10)
+    _progress = 5
+
+    def on_stage_done(name, result):
+        nonlocal _progress
+        if name in _STAGE_PROGRESS:
+            _progress += _STAGE_PROGRESS[name]
+            sm.state.update_task(
+                task_id,
+                state=const.TASK_STATE_PROCESSING,
+                progress=_progress,
+                stage=name,
+            )
 
+    checkpoints = None
+    if config.app.get("resume_tasks", True):
+        checkpoints = Checkpoints(task_id)
+        checkpoints.save_task(
+            params.model_dump(mode="json"), stop_at, type(params).__name__
+        )
+
+    streamed_audio = {}
+    try:
+        results = scheduler.run(
+            build_stages(task_id, params, stop_at, streamed_audio),
+            on_stage_done,
+            checkpoints,
+        )
+    finally:
+        # the audio stage failed, did not run or was restored from a checkpoint
+        for synthesizer in list(streamed_audio.values()):
+            synthesizer.cancel()
+        streamed_audio.clear()
+    if results is None:
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        # raised for the task manager, that counts the failed tasks
+        raise RuntimeError(f"task failed: {task_id}")
+
+    video_script = results["script"]
     if stop_at == "script":
         sm.state.update_task(
             task_id, state=const.TASK_STATE_COMPLETE, progress=100, script=video_script
         )
         return {"script": video_script}
 
-    # 2. Generate terms
-    video_terms = ""
-    if params.video_source != "local":
-        video_terms = generate_terms(task_id, params, video_script)
-        if not video_terms:
-            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-            return
-
-    save_script_data(task_id, video_script, video_terms, params)
-
+    video_terms = results["terms"]
     if stop_at == "terms":
         sm.state.update_task(
             task_id, state=const.TASK_STATE_COMPLETE, progress=100, terms=video_terms
         )
         return {"script": video_script, "terms": video_terms}
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=20)
-
-    # 3. Generate audio
-    audio_file, audio_duration, sub_maker = generate_audio(task_id, params, video_script)
-    if not audio_file:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
-
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=30)
-
+    audio_file, audio_duration, _, _ = results["audio"]
     if stop_at == "audio":
         sm.state.update_task(
             task_id,
@@ -262,9 +712,7 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         )
         return {"audio_file": audio_file, "audio_duration": audio_duration}
 
-    # 4. Generate subtitle
-    subtitle_path = generate_subtitle(task_id, params, video_script, sub_maker, audio_file)
-
+    subtitle_path = results["subtitle"]
     if stop_at == "subtitle":
         sm.state.update_task(
             task_id,
@@ -274,16 +722,7 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         )
         return {"subtitle_path": subtitle_path}
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=40)
-
-    # 5. Get video materials
-    downloaded_videos = get_video_materials(
-        task_id, params, video_terms, audio_duration
-    )
-    if not downloaded_videos:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
-
+    downloaded_videos = results["materials"]
     if stop_at == "materials":
         sm.state.update_task(
             task_id,
@@ -293,16 +732,7 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         )
         return {"materials": downloaded_videos}
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
-
-    # 6. Generate final videos
-    final_video_paths, combined_video_paths = generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path
-    )
-
-    if not final_video_paths:
-        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-        return
+    final_video_paths, combined_video_paths = results["video"]
 
     logger.success(
         f"task {task_id} finished, generated {len(final_video_paths)} videos."
@@ -318,8 +748,17 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
         "subtitle_path": subtitle_path,
         "materials": downloaded_videos,
     }
+    # the videos are stored once as uris relative to the endpoint, instead
+    # of being mapped on every status query
     sm.state.update_task(
-        task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs
+        task_id,
+        state=const.TASK_STATE_COMPLETE,
+        progress=100,
+        **{
+            **kwargs,
+            "videos": [utils.task_file_uri(f) for f in final_video_paths],
+            "combined_videos": [utils.task_file_uri(f) for f in combined_video_paths],
+        },
     )
     return kwargs
 
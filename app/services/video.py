@@ -1,15 +1,20 @@
+import bisect
 import glob
+import math
 import random
+from functools import lru_cache
 from typing import List
 
+import numpy as np
 from loguru import logger
 from moviepy.editor import *
-from moviepy.video.tools.subtitles import SubtitlesClip
-from PIL import ImageFont
+from moviepy.video.tools.subtitles import file_to_subtitles
+from PIL import Image, ImageColor, ImageDraw, ImageFont
 
 from app.models import const
 from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode, VideoParams
-from app.utils import utils
+from app.services import clip_store
+from app.utils import media, utils
 
 
 def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
@@ -37,8 +42,9 @@ def combine_videos(
     max_clip_duration: int = 5,
     threads: int = 2,
 ) -> str:
-    audio_clip = AudioFileClip(audio_file)
-    audio_duration = audio_clip.duration
+    audio_duration = media.get_duration(audio_file)
+    if audio_duration <= 0:
+        raise ValueError(f"invalid audio file: {audio_file}")
     logger.info(f"max duration of audio: {audio_duration} seconds")
     # Required duration of each clip
     req_dur = audio_duration / len(video_paths)
@@ -49,6 +55,10 @@ def combine_videos(
     aspect = VideoAspect(video_aspect)
     video_width, video_height = aspect.to_resolution()
 
+    # normalized clips already match the target size, so no resize/letterbox is needed below
+    if clip_store.is_enabled():
+        video_paths = clip_store.normalize_videos(video_paths, aspect)
+
     clips = []
     video_duration = 0
 
@@ -141,9 +151,14 @@ def combine_videos(
     return combined_video_path
 
 
+@lru_cache(maxsize=16)
+def load_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(font_path, font_size)
+
+
 def wrap_text(text, max_width, font="Arial", fontsize=60):
     # 创建字体对象
-    font = ImageFont.truetype(font, fontsize)
+    font = load_font(font, fontsize)
 
     def get_text_size(inner_text):
         inner_text = inner_text.strip()
@@ -199,6 +214,65 @@ def wrap_text(text, max_width, font="Arial", fontsize=60):
     return result, height
 
 
+def _parse_color(color: str):
+    if not color or color.strip().lower() == "transparent":
+        return None
+    try:
+        return ImageColor.getrgb(color)
+    except ValueError:
+        logger.warning(f"invalid color: {color}")
+        return None
+
+
+def render_subtitle_sprite(
+    text: str,
+    font_path: str,
+    font_size: int,
+    fore_color: str,
+    bg_color: str,
+    stroke_color: str,
+    stroke_width: float,
+    max_width: int,
+) -> np.ndarray:
+    """
+    rasterize a subtitle line with Pillow, returned as an uint8 rgba array,
+    converted when it is blended
+    """
+    font = load_font(font_path, font_size)
+    wrapped_txt, _ = wrap_text(
+        text, max_width=max_width, font=font_path, fontsize=font_size
+    )
+
+    stroke_fill = _parse_color(stroke_color)
+    stroke = int(math.ceil(stroke_width)) if stroke_fill and stroke_width else 0
+
+    measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    left, top, right, bottom = measure.multiline_textbbox(
+        (0, 0), wrapped_txt, font=font, stroke_width=stroke, align="center"
+    )
+    width = max(math.ceil(right - left), 1)
+    height = max(math.ceil(bottom - top), 1)
+
+    background = _parse_color(bg_color)
+    image = Image.new(
+        "RGBA", (width, height), background if background else (0, 0, 0, 0)
+    )
+    draw = ImageDraw.Draw(image)
+    draw.multiline_text(
+        (-left, -top),
+        wrapped_txt,
+        font=font,
+        fill=_parse_color(fore_color) or (255, 255, 255),
+        stroke_width=stroke,
+        stroke_fill=stroke_fill,
+        align="center",
+    )
+
+    pixels = np.asarray(image, dtype=np.uint8)
+    pixels.setflags(write=False)
+    return pixels
+
+
 def generate_video(
     video_path: str,
     audio_path: str,
@@ -230,52 +304,85 @@ def generate_video(
 
         logger.info(f"using font: {font_path}")
 
-    def create_text_clip(subtitle_item):
-        phrase = subtitle_item[1]
-        max_width = video_width * 0.9
-        wrapped_txt, txt_height = wrap_text(
-            phrase, max_width=max_width, font=font_path, fontsize=params.font_size
-        )
-        _clip = TextClip(
-            wrapped_txt,
-            font=font_path,
-            fontsize=params.font_size,
-            color=params.text_fore_color,
-            bg_color=params.text_background_color,
-            stroke_color=params.stroke_color,
-            stroke_width=params.stroke_width,
-            print_cmd=False,
-        )
-        duration = subtitle_item[0][1] - subtitle_item[0][0]
-        _clip = _clip.set_start(subtitle_item[0][0])
-        _clip = _clip.set_end(subtitle_item[0][1])
-        _clip = _clip.set_duration(duration)
+    def subtitle_position(sprite_w, sprite_h):
+        x = (video_width - sprite_w) // 2
         if params.subtitle_position == "bottom":
-            _clip = _clip.set_position(("center", video_height * 0.95 - _clip.h))
+            y = video_height * 0.95 - sprite_h
         elif params.subtitle_position == "top":
-            _clip = _clip.set_position(("center", video_height * 0.05))
+            y = video_height * 0.05
         elif params.subtitle_position == "custom":
             # 确保字幕完全在屏幕内
             margin = 10  # 额外的边距，单位为像素
-            max_y = video_height - _clip.h - margin
+            max_y = video_height - sprite_h - margin
             min_y = margin
-            custom_y = (video_height - _clip.h) * (params.custom_position / 100)
-            custom_y = max(min_y, min(custom_y, max_y))  # 限制 y 值在有效范围内
-            _clip = _clip.set_position(("center", custom_y))
+            custom_y = (video_height - sprite_h) * (params.custom_position / 100)
+            y = max(min_y, min(custom_y, max_y))  # 限制 y 值在有效范围内
         else:  # center
-            _clip = _clip.set_position(("center", "center"))
-        return _clip
+            y = (video_height - sprite_h) / 2
+        return int(x), int(y)
+
+    def create_subtitle_overlay(subtitle_items):
+        # subtitle items are sorted by start time, so the active one can be
+        # found with a binary search instead of compositing every line per frame
+        subtitle_items = sorted(subtitle_items, key=lambda item: item[0][0])
+        starts = [item[0][0] for item in subtitle_items]
+        max_width = int(video_width * 0.9)
+        # the lines are shown in order, only the sprite of the current one is
+        # kept, for the frames of this render
+        sprites = {}
+
+        def blit(get_frame, t):
+            frame = get_frame(t)
+            idx = bisect.bisect_right(starts, t) - 1
+            if idx < 0:
+                return frame
+            (start_time, end_time), phrase = subtitle_items[idx]
+            if t >= end_time:
+                return frame
+
+            sprite = sprites.get(idx)
+            if sprite is None:
+                sprite = render_subtitle_sprite(
+                    phrase,
+                    font_path,
+                    params.font_size,
+                    params.text_fore_color,
+                    params.text_background_color,
+                    params.stroke_color,
+                    params.stroke_width,
+                    max_width,
+                )
+                sprites.clear()
+                sprites[idx] = sprite
+            frame_h, frame_w = frame.shape[:2]
+            sprite_h, sprite_w = sprite.shape[:2]
+            x, y = subtitle_position(sprite_w, sprite_h)
+
+            # clip the sprite to the frame
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + sprite_w, frame_w), min(y + sprite_h, frame_h)
+            if x0 >= x1 or y0 >= y1:
+                return frame
+
+            sx0, sy0 = x0 - x, y0 - y
+            sx1, sy1 = sx0 + (x1 - x0), sy0 + (y1 - y0)
+            pixels = sprite[sy0:sy1, sx0:sx1].astype(np.float32)
+            a = pixels[:, :, 3:] / 255.0
+
+            frame = frame.copy()
+            region = frame[y0:y1, x0:x1].astype(np.float32)
+            region = pixels[:, :, :3] * a + region * (1.0 - a)
+            frame[y0:y1, x0:x1] = region.astype(frame.dtype)
+            return frame
+
+        return blit
 
     video_clip = VideoFileClip(video_path)
     audio_clip = AudioFileClip(audio_path).volumex(params.voice_volume)
 
     if subtitle_path and os.path.exists(subtitle_path):
-        sub = SubtitlesClip(subtitles=subtitle_path, encoding="utf-8")
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
+        subtitle_items = file_to_subtitles(subtitle_path, encoding="utf-8")
+        video_clip = video_clip.fl(create_subtitle_overlay(subtitle_items))
 
     bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
     if bgm_file:
@@ -309,12 +416,13 @@ def preprocess_video(materials: List[MaterialInfo], clip_duration=4):
 
         ext = utils.parse_extension(material.url)
         try:
-            clip = VideoFileClip(material.url)
-        except Exception:
-            clip = ImageClip(material.url)
+            info = media.probe(material.url)
+        except Exception as e:
+            logger.warning(f"invalid material: {material.url} => {str(e)}")
+            continue
 
-        width = clip.size[0]
-        height = clip.size[1]
+        width = info["width"]
+        height = info["height"]
         if width < 480 or height < 480:
             logger.warning(f"video is too small, width: {width}, height: {height}")
             continue
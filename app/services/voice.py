@@ -1,7 +1,11 @@
 import asyncio
+import hashlib
 import os
 import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from typing import Dict, List, Optional, Tuple
 from xml.sax.saxutils import unescape
 from edge_tts.submaker import mktimestamp
 from loguru import logger
@@ -10,7 +14,12 @@ import edge_tts
 from moviepy.video.tools import subtitles
 
 from app.config import config
-from app.utils import utils
+from app.services import material_store
+from app.utils import cache, ffmpeg, media, utils
+
+_segment_store: Optional[material_store.MaterialStore] = None
+_segment_meta: Optional[cache.SqliteCache] = None
+_segment_lock = threading.Lock()
 
 
 def get_all_azure_voices(filter_locals=None) -> list[str]:
@@ -1029,11 +1038,19 @@ def is_azure_v2_voice(voice_name: str):
 
 
 def tts(
-    text: str, voice_name: str, voice_rate: float, voice_file: str
+    text: str,
+    voice_name: str,
+    voice_rate: float,
+    voice_file: str,
+    subtitle_builder: "SubtitleBuilder" = None,
 ) -> [SubMaker, None]:
+    """
+    when subtitle_builder is set, the word boundaries are pushed to it while
+    the audio is streamed to voice_file
+    """
     if is_azure_v2_voice(voice_name):
-        return azure_tts_v2(text, voice_name, voice_file)
-    return azure_tts_v1(text, voice_name, voice_rate, voice_file)
+        return azure_tts_v2(text, voice_name, voice_file, subtitle_builder)
+    return azure_tts_v1(text, voice_name, voice_rate, voice_file, subtitle_builder)
 
 
 def convert_rate_to_percent(rate: float) -> str:
@@ -1047,7 +1064,11 @@ def convert_rate_to_percent(rate: float) -> str:
 
 
 def azure_tts_v1(
-    text: str, voice_name: str, voice_rate: float, voice_file: str
+    text: str,
+    voice_name: str,
+    voice_rate: float,
+    voice_file: str,
+    subtitle_builder: "SubtitleBuilder" = None,
 ) -> [SubMaker, None]:
     voice_name = parse_voice_name(voice_name)
     text = text.strip()
@@ -1056,6 +1077,9 @@ def azure_tts_v1(
         try:
             logger.info(f"start, voice name: {voice_name}, try: {i + 1}")
 
+            if subtitle_builder:
+                subtitle_builder.reset()
+
             async def _do() -> SubMaker:
                 communicate = edge_tts.Communicate(text, voice_name, rate=rate_str)
                 sub_maker = edge_tts.SubMaker()
@@ -1067,6 +1091,10 @@ def azure_tts_v1(
                             sub_maker.create_sub(
                                 (chunk["offset"], chunk["duration"]), chunk["text"]
                             )
+                            if subtitle_builder:
+                                subtitle_builder.add(
+                                    sub_maker.offset[-1], sub_maker.subs[-1]
+                                )
                 return sub_maker
 
             sub_maker = asyncio.run(_do())
@@ -1081,7 +1109,12 @@ def azure_tts_v1(
     return None
 
 
-def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> [SubMaker, None]:
+def azure_tts_v2(
+    text: str,
+    voice_name: str,
+    voice_file: str,
+    subtitle_builder: "SubtitleBuilder" = None,
+) -> [SubMaker, None]:
     voice_name = is_azure_v2_voice(voice_name)
     if not voice_name:
         logger.error(f"invalid voice name: {voice_name}")
@@ -1111,6 +1144,8 @@ def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> [SubMaker, None
             import azure.cognitiveservices.speech as speechsdk
 
             sub_maker = SubMaker()
+            if subtitle_builder:
+                subtitle_builder.reset()
 
             def speech_synthesizer_word_boundary_cb(evt: speechsdk.SessionEventArgs):
                 # print('WordBoundary event:')
@@ -1125,6 +1160,8 @@ def azure_tts_v2(text: str, voice_name: str, voice_file: str) -> [SubMaker, None
                 offset = _format_duration_to_offset(evt.audio_offset)
                 sub_maker.subs.append(evt.text)
                 sub_maker.offset.append((offset, offset + duration))
+                if subtitle_builder:
+                    subtitle_builder.add((offset, offset + duration), evt.text)
 
             # Creates an instance of a speech config with specified subscription key and service region.
             speech_key = config.azure.get("speech_key", "")
@@ -1184,100 +1221,369 @@ def _format_text(text: str) -> str:
     return text
 
 
-def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str):
+def _format_subtitle(idx: int, start_time: float, end_time: float, sub_text: str) -> str:
     """
-    优化字幕文件
-    1. 将字幕文件按照标点符号分割成多行
-    2. 逐行匹配字幕文件中的文本
-    3. 生成新的字幕文件
+    1
+    00:00:00,000 --> 00:00:02,360
+    跑步是一项简单易行的运动
+    """
+    start_t = mktimestamp(start_time).replace(".", ",")
+    end_t = mktimestamp(end_time).replace(".", ",")
+    return f"{idx}\n" f"{start_t} --> {end_t}\n" f"{sub_text}\n"
+
+
+def _match_line(script_lines, _sub_line: str, _sub_index: int):
+    if len(script_lines) <= _sub_index:
+        return ""
+
+    _line = script_lines[_sub_index]
+    if _sub_line == _line:
+        return script_lines[_sub_index].strip()
+
+    _sub_line_ = re.sub(r"[^\w\s]", "", _sub_line)
+    _line_ = re.sub(r"[^\w\s]", "", _line)
+    if _sub_line_ == _line_:
+        return _line_.strip()
+
+    _sub_line_ = re.sub(r"\W+", "", _sub_line)
+    _line_ = re.sub(r"\W+", "", _line)
+    if _sub_line_ == _line_:
+        return _line.strip()
+
+    return ""
+
+
+class SubtitleBuilder:
+    """
+    builds the subtitle lines from the word boundaries as they are received,
+    a line is completed as soon as its words match the next script line, so
+    the subtitle is ready when the tts stream ends
     """
 
-    text = _format_text(text)
+    def __init__(self, text: str):
+        self.script_lines = utils.split_string_by_punctuations(_format_text(text))
+        self.reset()
 
-    def formatter(idx: int, start_time: float, end_time: float, sub_text: str) -> str:
+    def add_text(self, text: str):
         """
-        1
-        00:00:00,000 --> 00:00:02,360
-        跑步是一项简单易行的运动
+        appends the lines of a sentence of a script still being generated,
+        before its word boundaries are added
         """
-        start_t = mktimestamp(start_time).replace(".", ",")
-        end_t = mktimestamp(end_time).replace(".", ",")
-        return f"{idx}\n" f"{start_t} --> {end_t}\n" f"{sub_text}\n"
+        self.script_lines.extend(utils.split_string_by_punctuations(_format_text(text)))
+
+    def reset(self):
+        self.sub_items = []
+        self._start_time = -1.0
+        self._sub_line = ""
+
+    def add(self, offset, sub: str):
+        _start_time, end_time = offset
+        if self._start_time < 0:
+            self._start_time = _start_time
+
+        self._sub_line += unescape(sub)
+        sub_text = _match_line(self.script_lines, self._sub_line, len(self.sub_items))
+        if sub_text:
+            self.sub_items.append(
+                _format_subtitle(
+                    idx=len(self.sub_items) + 1,
+                    start_time=self._start_time,
+                    end_time=end_time,
+                    sub_text=sub_text,
+                )
+            )
+            self._start_time = -1.0
+            self._sub_line = ""
 
-    start_time = -1.0
-    sub_items = []
-    sub_index = 0
+    def is_complete(self) -> bool:
+        return len(self.sub_items) == len(self.script_lines)
 
-    script_lines = utils.split_string_by_punctuations(text)
+    def write(self, subtitle_file: str):
+        if not self.is_complete():
+            logger.warning(
+                f"failed, sub_items len: {len(self.sub_items)}, script_lines len: {len(self.script_lines)}"
+            )
+            return
 
-    def match_line(_sub_line: str, _sub_index: int):
-        if len(script_lines) <= _sub_index:
-            return ""
+        with open(subtitle_file, "w", encoding="utf-8") as file:
+            file.write("\n".join(self.sub_items) + "\n")
+        try:
+            sbs = subtitles.file_to_subtitles(subtitle_file, encoding="utf-8")
+            duration = max([tb for ((ta, tb), txt) in sbs])
+            logger.info(
+                f"completed, subtitle file created: {subtitle_file}, duration: {duration}"
+            )
+        except Exception as e:
+            logger.error(f"failed, error: {str(e)}")
+            os.remove(subtitle_file)
 
-        _line = script_lines[_sub_index]
-        if _sub_line == _line:
-            return script_lines[_sub_index].strip()
 
-        _sub_line_ = re.sub(r"[^\w\s]", "", _sub_line)
-        _line_ = re.sub(r"[^\w\s]", "", _line)
-        if _sub_line_ == _line_:
-            return _line_.strip()
+def _segment_cache() -> Tuple[
+    Optional[material_store.MaterialStore], Optional[cache.SqliteCache]
+]:
+    """
+    the audio of the sentences is stored in ./storage/cache_tts and their
+    word boundaries in ./storage/cache/tts.db, (None, None) when disabled
+    """
+    global _segment_store, _segment_meta
+    ttl = config.app.get("tts_cache_ttl", 2592000)
+    if not ttl:
+        return None, None
+    with _segment_lock:
+        if _segment_store is None:
+            _segment_meta = cache.SqliteCache(
+                "tts",
+                ttl=ttl,
+                max_entries=config.app.get("tts_cache_max_entries", 20000),
+            )
+            _segment_store = material_store.get_store(
+                utils.storage_dir("cache_tts"),
+                max_size_mb=config.app.get("tts_cache_max_size_mb", 1024),
+            )
+    return _segment_store, _segment_meta
 
-        _sub_line_ = re.sub(r"\W+", "", _sub_line)
-        _line_ = re.sub(r"\W+", "", _line)
-        if _sub_line_ == _line_:
-            return _line.strip()
 
-        return ""
+def _segment_key(text: str, voice_name: str, voice_rate: float) -> str:
+    key = f"{voice_name}:{float(voice_rate)}:{text.strip()}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
-    sub_line = ""
+
+def synthesize_segment(
+    text: str, voice_name: str, voice_rate: float, part_file: str
+) -> Tuple[str, SubMaker, float]:
+    """
+    synthesize a sentence into part_file, or reuse the cached audio of the
+    same text, voice and rate. returns the audio file (part_file or the
+    cached file), the word boundaries and the duration of the audio.
+    """
+    store, meta = _segment_cache()
+    key = _segment_key(text, voice_name, voice_rate)
+    name = f"{key}.mp3"
+    if store:
+        cached = meta.get(key)
+        file_path = store.lookup(name) if cached else ""
+        if file_path:
+            sub_maker = SubMaker()
+            sub_maker.offset = [tuple(offset) for offset in cached["offset"]]
+            sub_maker.subs = list(cached["subs"])
+            return file_path, sub_maker, cached["duration"]
+
+    sub_maker = tts(text, voice_name, voice_rate, part_file)
+    if not sub_maker or not sub_maker.subs:
+        raise RuntimeError(f"failed to synthesize sentence: {text}")
+    duration = media.probe(part_file)["duration"]
+    if not store:
+        return part_file, sub_maker, duration
 
     try:
-        for _, (offset, sub) in enumerate(zip(sub_maker.offset, sub_maker.subs)):
-            _start_time, end_time = offset
-            if start_time < 0:
-                start_time = _start_time
-
-            sub = unescape(sub)
-            sub_line += sub
-            sub_text = match_line(sub_line, sub_index)
-            if sub_text:
-                sub_index += 1
-                line = formatter(
-                    idx=sub_index,
-                    start_time=start_time,
-                    end_time=end_time,
-                    sub_text=sub_text,
-                )
-                sub_items.append(line)
-                start_time = -1.0
-                sub_line = ""
+        file_path = store.commit(
+            part_file, name, source=voice_name, info={"duration": duration}
+        )
+        meta.set(
+            key,
+            {"offset": sub_maker.offset, "subs": sub_maker.subs, "duration": duration},
+        )
+    except Exception as e:
+        logger.warning(f"failed to cache sentence audio: {str(e)}")
+        file_path = part_file if os.path.exists(part_file) else store.path(name)
+    return file_path, sub_maker, duration
 
-        if len(sub_items) == len(script_lines):
-            with open(subtitle_file, "w", encoding="utf-8") as file:
-                file.write("\n".join(sub_items) + "\n")
+
+class SentenceSynthesizer:
+    """
+    synthesizes the sentences of a script in a bounded thread pool, as soon
+    as they are added (the script may still be generated). the word
+    boundaries of every sentence are shifted by the duration of the previous
+    ones and added to the subtitle builder as soon as the sentences before it
+    are synthesized. finish() concatenates the sentences into voice_file and
+    returns a single SubMaker.
+    """
+
+    def __init__(
+        self,
+        voice_name: str,
+        voice_rate: float,
+        voice_file: str,
+        max_workers: int = 0,
+        subtitle_builder: Optional["SubtitleBuilder"] = None,
+    ):
+        self.voice_name = voice_name
+        self.voice_rate = voice_rate
+        self.voice_file = voice_file
+        self.subtitle_builder = subtitle_builder
+        max_workers = max_workers or config.app.get("tts_max_workers", 4)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="tts"
+        )
+        self._parts: List[Future] = []
+        # a sentence repeated in the script is synthesized once
+        self._segments: Dict[str, Future] = {}
+        # the parts are joined in order, from the worker that completes the
+        # next one
+        self._lock = threading.Lock()
+        self._sub_maker = SubMaker()
+        self._part_files: List[str] = []
+        self._shift = 0
+
+    def _part_file(self, index: int) -> str:
+        return f"{self.voice_file}.part{index}.mp3"
+
+    def add(self, sentence: str):
+        if not re.search(r"\w", sentence):
+            # nothing to speak, eg: the punctuation left by removed markdown
+            return
+        segment = self._segments.get(sentence.strip())
+        if segment is None:
+            part_file = self._part_file(len(self._parts))
+            segment = self._executor.submit(
+                synthesize_segment, sentence, self.voice_name, self.voice_rate, part_file
+            )
+            self._segments[sentence.strip()] = segment
+        with self._lock:
+            self._parts.append(segment)
+        segment.add_done_callback(self._join_completed)
+
+    def _join_completed(self, _: Future = None):
+        with self._lock:
+            while len(self._part_files) < len(self._parts):
+                part = self._parts[len(self._part_files)]
+                if not part.done() or part.cancelled() or part.exception():
+                    return
+                part_file, part_sub_maker, duration = part.result()
+                for (start, end), sub in zip(part_sub_maker.offset, part_sub_maker.subs):
+                    offset = (start + self._shift, end + self._shift)
+                    self._sub_maker.offset.append(offset)
+                    self._sub_maker.subs.append(sub)
+                    if self.subtitle_builder:
+                        self.subtitle_builder.add(offset, sub)
+                # the offsets are in 100ns units, like edge_tts
+                self._shift += round(duration * 10000000)
+                self._part_files.append(part_file)
+
+    def finish(self) -> Optional[SubMaker]:
+        """
+        wait for the pending sentences, returns None if nothing was added
+        """
+        try:
+            if not self._parts:
+                return None
+
+            for part in self._parts:
+                part.result()
+            # the callback of the last part may still be running
+            self._join_completed()
+            part_files = self._part_files
+
+            # the parts have the same format, the frames are joined as they
+            # are, without re-encoding or silence in between
+            list_file = f"{self.voice_file}.txt"
+            with open(list_file, "w", encoding="utf-8") as f:
+                for part_file in part_files:
+                    escaped = os.path.abspath(part_file).replace("'", "'\\''")
+                    f.write(f"file '{escaped}'\n")
             try:
-                sbs = subtitles.file_to_subtitles(subtitle_file, encoding="utf-8")
-                duration = max([tb for ((ta, tb), txt) in sbs])
-                logger.info(
-                    f"completed, subtitle file created: {subtitle_file}, duration: {duration}"
+                ffmpeg.run(
+                    [
+                        "-f",
+                        "concat",
+                        "-safe",
+                        "0",
+                        "-i",
+                        list_file,
+                        "-c",
+                        "copy",
+                        self.voice_file,
+                    ]
                 )
-            except Exception as e:
-                logger.error(f"failed, error: {str(e)}")
-                os.remove(subtitle_file)
-        else:
-            logger.warning(
-                f"failed, sub_items len: {len(sub_items)}, script_lines len: {len(script_lines)}"
+            finally:
+                if os.path.exists(list_file):
+                    os.remove(list_file)
+            logger.info(
+                f"completed, {len(part_files)} sentences, output file: {self.voice_file}"
             )
+            return self._sub_maker
+        finally:
+            self._cleanup()
+
+    def cancel(self):
+        for part in self._parts:
+            part.cancel()
+        self._cleanup()
+
+    def _cleanup(self):
+        self._executor.shutdown(wait=True)
+        for index in range(len(self._parts)):
+            part_file = self._part_file(index)
+            if os.path.exists(part_file):
+                os.remove(part_file)
+
+
+def tts_sentences(
+    text: str,
+    voice_name: str,
+    voice_rate: float,
+    voice_file: str,
+    subtitle_builder: "SubtitleBuilder" = None,
+) -> [SubMaker, None]:
+    """
+    same as tts(), but the sentences are synthesized in parallel and the
+    sentences already synthesized with the same voice and rate are reused
+    """
+    sentences, rest = utils.split_sentences(text)
+    if subtitle_builder:
+        subtitle_builder.reset()
+    synthesizer = SentenceSynthesizer(
+        voice_name, voice_rate, voice_file, subtitle_builder=subtitle_builder
+    )
+    try:
+        for sentence in sentences + [rest]:
+            if sentence.strip():
+                synthesizer.add(sentence)
+        return synthesizer.finish()
+    except Exception as e:
+        logger.error(f"failed, error: {str(e)}")
+        synthesizer.cancel()
+        return None
+
 
+def create_subtitle(sub_maker: submaker.SubMaker, text: str, subtitle_file: str):
+    """
+    优化字幕文件
+    1. 将字幕文件按照标点符号分割成多行
+    2. 逐行匹配字幕文件中的文本
+    3. 生成新的字幕文件
+    """
+    try:
+        builder = SubtitleBuilder(text)
+        for offset, sub in zip(sub_maker.offset, sub_maker.subs):
+            builder.add(offset, sub)
+        builder.write(subtitle_file)
     except Exception as e:
         logger.error(f"failed, error: {str(e)}")
 
 
-def get_audio_duration(sub_maker: submaker.SubMaker):
+def estimate_duration(text: str, voice_rate: float = 1.0) -> float:
+    """
+    rough duration of the speech before it is synthesized, used to start the
+    material downloads while the tts is still running
+    """
+    cjk_chars = re.findall(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]", text)
+    words = re.findall(r"[^\W\d_\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]+|\d+", text)
+    pauses = re.findall(r"[.,!?;:，。！？；：、]", text)
+    seconds = len(cjk_chars) / 4.5 + len(words) / 2.6 + len(pauses) * 0.3
+    return seconds / max(voice_rate or 1.0, 0.1)
+
+
+def get_audio_duration(sub_maker: submaker.SubMaker, audio_file: str = ""):
     """
     获取音频时长
+    the duration of audio_file is read from its header, the end of the last
+    word boundary (without the trailing silence) is used if it can not be read
     """
+    if audio_file:
+        duration = media.get_duration(audio_file)
+        if duration > 0:
+            return duration
     if not sub_maker.offset:
         return 0.0
     return sub_maker.offset[-1][1] / 10000000
@@ -0,0 +1,191 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+from app.utils import utils
+
+
+class SqliteCache:
+    """
+    a small key/value cache stored in sqlite, so that it is shared by every
+    process on the host (api, webui, workers).
+
+    values are stored as json, entries expire after `ttl` seconds and the
+    least recently used entries are evicted when there are more than
+    `max_entries`. hit/miss counters are stored in the database as well.
+    """
+
+    def __init__(self, name: str, ttl: int = 86400, max_entries: int = 5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.db_file = os.path.join(utils.storage_dir("cache", create=True), f"{name}.db")
+        self._local = threading.local()
+        self._init_db()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._conn()
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_entries_accessed_at ON entries (accessed_at)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO stats (name, value) VALUES ('hits', 0), ('misses', 0)"
+        )
+
+    def _count(self, name: str):
+        self._conn().execute(
+            "UPDATE stats SET value = value + 1 WHERE name = ?", (name,)
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                "SELECT value, created_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                if row is not None:
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._count("misses")
+                return None
+
+            conn.execute(
+                "UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._count("hits")
+            return json.loads(row[0])
+        except Exception as e:
+            logger.warning(f"failed to read cache: {self.db_file} => {str(e)}")
+        return None
+
+    def set(self, key: str, value: Any):
+        try:
+            now = time.time()
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            if self.max_entries:
+                conn.execute(
+                    """
+                    DELETE FROM entries WHERE key IN (
+                        SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,),
+                )
+        except Exception as e:
+            logger.warning(f"failed to write cache: {self.db_file} => {str(e)}")
+
+    def delete(self, key: str):
+        self._conn().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM entries")
+        conn.execute("UPDATE stats SET value = 0")
+
+    def stats(self) -> Dict[str, int]:
+        conn = self._conn()
+        stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        stats["entries"] = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return stats
+
+
+class LruCache:
+    """
+    an in process lru cache in front of an optional SqliteCache, the hot
+    entries are served without touching the database and the entries read
+    from the database are kept in memory.
+
+    entries expire after `ttl` seconds (0 means never) in both levels.
+    """
+
+    def __init__(
+        self, max_entries: int = 256, ttl: int = 0, backend: SqliteCache = None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if not self.ttl or time.time() - created_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return value
+                del self._entries[key]
+            self._misses += 1
+
+        value = self.backend.get(key) if self.backend else None
+        if value is None:
+            return None
+        # the entry may be older than its copy in memory, it expires at most
+        # `ttl` seconds later than in the database
+        self._remember(key, value)
+        return value
+
+    def set(self, key: str, value: Any):
+        self._remember(key, value)
+        if self.backend:
+            self.backend.set(key, value)
+
+    def _remember(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.backend:
+            self.backend.delete(key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = {
+                "memory_entries": len(self._entries),
+                "memory_hits": self._hits,
+                "memory_misses": self._misses,
+            }
+        if self.backend:
+            stats.update(self.backend.stats())
+        return stats
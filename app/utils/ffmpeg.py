@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+import subprocess
+from typing import Dict, List
+
+from loguru import logger
+
+
+def get_ffmpeg_exe() -> str:
+    # config.ffmpeg_path is exported as IMAGEIO_FFMPEG_EXE by app.config
+    ffmpeg_path = os.environ.get("IMAGEIO_FFMPEG_EXE", "")
+    if ffmpeg_path and os.path.isfile(ffmpeg_path):
+        return ffmpeg_path
+
+    try:
+        import imageio_ffmpeg
+
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        pass
+
+    return shutil.which("ffmpeg") or "ffmpeg"
+
+
+def get_ffprobe_exe() -> str:
+    """
+    ffprobe is looked up next to ffmpeg first, then in PATH, the binary bundled
+    with imageio-ffmpeg does not ship ffprobe, so it can be empty
+    """
+    ffmpeg_exe = get_ffmpeg_exe()
+    ffmpeg_dir = os.path.dirname(ffmpeg_exe)
+    ffprobe_name = "ffprobe.exe" if os.name == "nt" else "ffprobe"
+    if ffmpeg_dir and os.path.basename(ffmpeg_exe).startswith("ffmpeg"):
+        ffprobe_exe = os.path.join(ffmpeg_dir, ffprobe_name)
+        if os.path.isfile(ffprobe_exe):
+            return ffprobe_exe
+    return shutil.which("ffprobe") or ""
+
+
+def probe(file_path: str) -> Dict:
+    """
+    read duration, fps and size from the container header without decoding,
+    returns {"duration": float, "fps": float, "width": int, "height": int}
+    """
+    ffprobe_exe = get_ffprobe_exe()
+    if not ffprobe_exe:
+        from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+        infos = ffmpeg_parse_infos(file_path)
+        width, height = infos.get("video_size") or (0, 0)
+        return {
+            "duration": float(infos.get("duration") or 0.0),
+            "fps": float(infos.get("video_fps") or 0.0),
+            "width": int(width),
+            "height": int(height),
+        }
+
+    result = subprocess.run(
+        [
+            ffprobe_exe,
+            "-v",
+            "error",
+            "-print_format",
+            "json",
+            "-show_entries",
+            "format=duration:stream=codec_type,width,height,avg_frame_rate,duration",
+            file_path,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        stderr = result.stderr.decode("utf-8", errors="ignore").strip()
+        raise RuntimeError(f"ffprobe failed: {file_path} => {stderr}")
+
+    info = json.loads(result.stdout or b"{}")
+    duration = float(info.get("format", {}).get("duration") or 0.0)
+    fps, width, height = 0.0, 0, 0
+    for stream in info.get("streams", []):
+        if stream.get("codec_type") != "video":
+            continue
+        width = int(stream.get("width") or 0)
+        height = int(stream.get("height") or 0)
+        num, _, den = (stream.get("avg_frame_rate") or "0/1").partition("/")
+        if float(den or 1) > 0:
+            fps = float(num) / float(den or 1)
+        if not duration:
+            duration = float(stream.get("duration") or 0.0)
+        break
+    return {"duration": duration, "fps": fps, "width": width, "height": height}
+
+
+def run(args: List[str], timeout: float = None) -> subprocess.CompletedProcess:
+    cmd = [get_ffmpeg_exe(), "-hide_banner", "-nostdin", "-loglevel", "error", "-y", *args]
+    logger.debug(f"ffmpeg command: {subprocess.list2cmdline(cmd)}")
+    result = subprocess.run(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=timeout,
+    )
+    if result.returncode != 0:
+        stderr = result.stderr.decode("utf-8", errors="ignore").strip()
+        raise RuntimeError(f"ffmpeg exited with code {result.returncode}: {stderr[-2000:]}")
+    return result
+
+
+def escape_filter_value(value: str) -> str:
+    """
+    escape a value (usually a file path) so that it can be used unquoted as an
+    option inside a -filter_complex graph, eg: subtitles=filename=...
+
+    ffmpeg unescapes the graph (\\ ' [ ] , ;) then the filter options
+    (\\ ' :), a backslash escape is not honoured inside quotes, so the value
+    is escaped for both levels instead of being quoted
+    """
+    value = value.replace("\\", "/")
+    # filter option level
+    for char in ("\\", "'", ":"):
+        value = value.replace(char, "\\" + char)
+    # filtergraph level
+    for char in ("\\", "'", "[", "]", ",", ";"):
+        value = value.replace(char, "\\" + char)
+    return value
@@ -0,0 +1,263 @@
+import mimetypes
+import os
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from typing import List, Mapping, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from app.utils import utils
+
+# large chunks aligned on the chunk size, a chunk is a single read in a
+# worker thread, so the per chunk overhead stays small for multi GB files
+CHUNK_SIZE = 1024 * 1024
+# a request with more ranges is served as a whole file, it would cost more
+# than the file itself
+MAX_RANGES = 16
+
+
+def confine_path(root_dir: str, file_path: str) -> Optional[str]:
+    """
+    resolve `file_path` relative to `root_dir`, returns None if the resolved
+    path (symlinks included) is outside of `root_dir` or is not a file
+    """
+    root_dir = os.path.realpath(root_dir)
+    real_path = os.path.realpath(os.path.join(root_dir, file_path.lstrip("/\\")))
+    if os.path.commonpath([root_dir, real_path]) != root_dir:
+        return None
+    if not os.path.isfile(real_path):
+        return None
+    return real_path
+
+
+def parse_range(range_header: str, file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    parse a `Range: bytes=...` header into sorted and merged (start, end)
+    ranges, end included.
+
+    returns None when the header is invalid or not about bytes (the whole
+    file is sent), and an empty list when no range can be satisfied.
+    """
+    unit, _, ranges_spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not ranges_spec.strip():
+        return None
+
+    ranges = []
+    for spec in ranges_spec.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        start, sep, end = spec.partition("-")
+        start, end = start.strip(), end.strip()
+        if not sep or not (start or end):
+            return None
+        if start and not start.isdigit() or end and not end.isdigit():
+            return None
+
+        if not start:
+            # suffix range: the last `end` bytes
+            length = int(end)
+            if length == 0:
+                continue
+            ranges.append((max(0, file_size - length), file_size - 1))
+            continue
+
+        start = int(start)
+        end = int(end) if end else file_size - 1
+        if end < start and start < file_size:
+            return None
+        if start >= file_size:
+            continue
+        ranges.append((start, min(end, file_size - 1)))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _read(f, offset: int, size: int) -> bytes:
+    f.seek(offset)
+    return f.read(size)
+
+
+class RangeFileResponse(Response):
+    """
+    serve a file with support for Range (single and multipart/byteranges),
+    ETag / Last-Modified and the conditional headers (If-None-Match,
+    If-Modified-Since, If-Range).
+
+    the file is sent with the asgi zero copy extension (sendfile) when the
+    server provides it, otherwise it is read in large aligned chunks.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        request_headers: Mapping[str, str],
+        media_type: str = None,
+        filename: str = None,
+        attachment: bool = False,
+        chunk_size: int = CHUNK_SIZE,
+    ):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.body = b""
+        self.background = None
+
+        stat_result = os.stat(path)
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise ValueError(f"not a file: {path}")
+        self.file_size = stat_result.st_size
+        self.etag = f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+        last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+
+        if media_type is None:
+            media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": self.etag,
+            "last-modified": last_modified,
+        }
+        if filename:
+            disposition = "attachment" if attachment else "inline"
+            headers["content-disposition"] = (
+                f"{disposition}; filename*=utf-8''{quote(filename)}"
+            )
+
+        self.ranges: List[Tuple[int, int]] = [(0, self.file_size - 1)]
+        self.boundary = ""
+        self.status_code = 200
+        if self._not_modified(request_headers, stat_result.st_mtime):
+            self.status_code = 304
+            self.ranges = []
+        elif "range" in request_headers and self._if_range(
+            request_headers, last_modified
+        ):
+            ranges = parse_range(request_headers["range"], self.file_size)
+            if ranges == []:
+                self.status_code = 416
+                self.ranges = []
+                headers["content-range"] = f"bytes */{self.file_size}"
+            elif ranges:
+                self.status_code = 206
+                self.ranges = ranges
+
+        if self.file_size == 0:
+            self.ranges = []
+
+        content_type = media_type
+        if self.status_code == 206 and len(self.ranges) > 1:
+            self.boundary = utils.get_uuid(True)
+            content_type = f"multipart/byteranges; boundary={self.boundary}"
+            self._parts = [
+                (
+                    (
+                        f"--{self.boundary}\r\n"
+                        f"content-type: {media_type}\r\n"
+                        f"content-range: bytes {start}-{end}/{self.file_size}\r\n\r\n"
+                    ).encode("latin-1"),
+                    start,
+                    end,
+                )
+                for start, end in self.ranges
+            ]
+            self._closing = f"--{self.boundary}--\r\n".encode("latin-1")
+            # every part is followed by a crlf
+            content_length = sum(
+                len(header) + end - start + 1 + 2 for header, start, end in self._parts
+            ) + len(self._closing)
+        else:
+            if self.status_code == 206:
+                start, end = self.ranges[0]
+                headers["content-range"] = f"bytes {start}-{end}/{self.file_size}"
+            content_length = sum(end - start + 1 for start, end in self.ranges)
+
+        if self.status_code != 304:
+            headers["content-length"] = str(content_length)
+            headers["content-type"] = content_type
+        self.init_headers(headers)
+
+    def _not_modified(self, request_headers: Mapping[str, str], mtime: float) -> bool:
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or self.etag in tags
+
+        if_modified_since = request_headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+                return int(mtime) <= since
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _if_range(self, request_headers: Mapping[str, str], last_modified: str) -> bool:
+        # the range only applies if the file did not change
+        if_range = request_headers.get("if-range")
+        return not if_range or if_range.strip() in (self.etag, last_modified)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if scope.get("method") == "HEAD" or not self.ranges:
+            await self._send_body(send, b"", more_body=False)
+            return
+
+        zero_copy = "http.response.zerocopysend" in scope.get("extensions", {})
+        with open(self.path, "rb") as f:
+            if not self.boundary:
+                start, end = self.ranges[0]
+                await self._send_range(send, f, start, end, zero_copy, more_body=False)
+                return
+
+            for header, start, end in self._parts:
+                await self._send_body(send, header, more_body=True)
+                await self._send_range(send, f, start, end, zero_copy, more_body=True)
+                await self._send_body(send, b"\r\n", more_body=True)
+            await self._send_body(send, self._closing, more_body=False)
+
+    @staticmethod
+    async def _send_body(send: Send, body: bytes, more_body: bool):
+        await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    async def _send_range(
+        self, send: Send, f, start: int, end: int, zero_copy: bool, more_body: bool
+    ):
+        if zero_copy:
+            await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": f.fileno(),
+                    "offset": start,
+                    "count": end - start + 1,
+                    "more_body": more_body,
+                }
+            )
+            return
+
+        offset = start
+        while offset <= end:
+            # the first chunk ends on a chunk boundary, the next ones are aligned
+            size = min(self.chunk_size - offset % self.chunk_size, end - offset + 1)
+            data = await anyio.to_thread.run_sync(_read, f, offset, size)
+            if not data:
+                raise RuntimeError(f"file truncated while sent: {self.path}")
+            offset += len(data)
+            await self._send_body(send, data, more_body=more_body or offset <= end)
@@ -0,0 +1,82 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from loguru import logger
+
+from app.models import const
+from app.utils import ffmpeg, utils
+
+# audio containers mutagen reads from the header, without spawning ffmpeg
+_AUDIO_EXTENSIONS = ["mp3", "m4a", "aac", "wav", "ogg", "flac"]
+_MAX_ENTRIES = 4096
+
+_cache: "OrderedDict[Tuple[str, int, int], Dict]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _probe_audio(file_path: str) -> Dict:
+    try:
+        import mutagen
+    except ImportError:
+        return {}
+
+    audio = mutagen.File(file_path)
+    if audio is None or not getattr(audio.info, "length", 0):
+        return {}
+    return {"duration": float(audio.info.length), "fps": 0.0, "width": 0, "height": 0}
+
+
+def _probe_image(file_path: str) -> Dict:
+    from PIL import Image
+
+    with Image.open(file_path) as image:
+        width, height = image.size
+    return {"duration": 0.0, "fps": 0.0, "width": int(width), "height": int(height)}
+
+
+def _probe(file_path: str) -> Dict:
+    ext = utils.parse_extension(file_path)
+    if ext in const.FILE_TYPE_IMAGES:
+        return _probe_image(file_path)
+    if ext in _AUDIO_EXTENSIONS:
+        info = _probe_audio(file_path)
+        if info:
+            return info
+    return ffmpeg.probe(file_path)
+
+
+def probe(file_path: str) -> Dict:
+    """
+    duration, fps and size of an audio, video or image file, read from the
+    file header: {"duration": float, "fps": float, "width": int, "height": int}
+
+    the result is cached in the process by path, mtime and size, so a file
+    probed by a stage is not probed again by the next ones
+    """
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+    with _cache_lock:
+        info = _cache.get(key)
+        if info is not None:
+            _cache.move_to_end(key)
+            return dict(info)
+
+    info = _probe(file_path)
+    with _cache_lock:
+        _cache[key] = info
+        if len(_cache) > _MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return dict(info)
+
+
+def get_duration(file_path: str) -> float:
+    """
+    duration in seconds, 0.0 if the file can not be read
+    """
+    try:
+        return probe(file_path)["duration"]
+    except Exception as e:
+        logger.warning(f"failed to read media duration: {file_path} => {str(e)}")
+    return 0.0
@@ -2,7 +2,7 @@ import locale
 import os
 import platform
 import threading
-from typing import Any
+from typing import Any, List, Tuple
 from loguru import logger
 import json
 from uuid import uuid4
@@ -72,7 +72,7 @@ def storage_dir(sub_dir: str = "", create: bool = False):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if create and not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
 
     return d
 
@@ -89,16 +89,25 @@ def task_dir(sub_dir: str = ""):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
     return d
 
 
+def task_file_uri(file: str) -> str:
+    """
+    the uri of a file of the tasks directory relative to the endpoint,
+    eg: tasks/6c85c8cc-a77a-42b9-bc30-947815aa0558/final-1.mp4
+    """
+    relative_path = os.path.relpath(file, task_dir())
+    return "tasks/" + relative_path.replace("\\", "/")
+
+
 def font_dir(sub_dir: str = ""):
     d = resource_dir(f"fonts")
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
     return d
 
 
@@ -107,7 +116,7 @@ def song_dir(sub_dir: str = ""):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
     return d
 
 
@@ -116,7 +125,7 @@ def public_dir(sub_dir: str = ""):
     if sub_dir:
         d = os.path.join(d, sub_dir)
     if not os.path.exists(d):
-        os.makedirs(d)
+        os.makedirs(d, exist_ok=True)
     return d
 
 
@@ -197,6 +206,39 @@ def split_string_by_punctuations(s):
     return result
 
 
+def split_sentences(s: str) -> Tuple[List[str], str]:
+    """
+    split a text being generated into its complete sentences and the rest,
+    the punctuations are kept. like split_string_by_punctuations, a "."
+    between two digits is not a boundary, and a punctuation at the end of
+    the text is not one yet, the next chunk may be "5%" after "2."
+    """
+    sentences = []
+    start = 0
+    i = 0
+    while i < len(s):
+        char = s[i]
+        if char != "\n" and char not in const.SENTENCE_PUNCTUATIONS:
+            i += 1
+            continue
+        previous_char = s[i - 1] if i > 0 else ""
+        next_char = s[i + 1] if i < len(s) - 1 else ""
+        if char == "." and previous_char.isdigit() and next_char.isdigit():
+            i += 1
+            continue
+
+        # "..." or "?!" end a single sentence
+        end = i
+        while end + 1 < len(s) and s[end + 1] in const.SENTENCE_PUNCTUATIONS:
+            end += 1
+        if end + 1 >= len(s):
+            break
+        if s[start : end + 1].strip():
+            sentences.append(s[start : end + 1])
+        start = i = end + 1
+    return sentences, s[start:]
+
+
 def md5(text):
     import hashlib
 
@@ -8,6 +8,13 @@ import datetime
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+API_URL = 'http://api:8080/api/v1'
+# same values as app.models.const
+TASK_STATE_FAILED = -1
+TASK_STATE_COMPLETE = 1
+# seconds between two status requests when the event stream is not available
+POLL_INTERVAL = 30
+
 def read_json_file(file_path):
     logging.info(f"Reading input data from {file_path}")
     with open(file_path, 'r') as file:
@@ -22,6 +29,54 @@ def get_video_data(input_json):
     logging.info(f"Selected video subject: {video_subject}, Video language: {video_language}")
     return video_subject, video_language
 
+def check_task_state(task):
+    if task.get('state') == TASK_STATE_FAILED:
+        raise RuntimeError("Video generation failed")
+    return task.get('state') == TASK_STATE_COMPLETE
+
+def stream_task_events(task_id, deadline):
+    """Follow the task with Server-Sent Events, returns True once the task is complete"""
+    with requests.get(f'{API_URL}/tasks/{task_id}/events', stream=True, timeout=(10, 60)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if datetime.datetime.now() > deadline:
+                raise TimeoutError("Timeout reached while waiting for video generation")
+            if not line or not line.startswith('data:'):
+                continue
+            task = json.loads(line[len('data:'):])
+            if 'progress' in task:
+                logging.info(f"Video generation in progress: {task['progress']}% {task.get('stage', '')}")
+            if check_task_state(task):
+                return True
+    return False
+
+def poll_task(task_id, deadline):
+    etag = None
+    while True:
+        # the api answers 304 while the task did not change
+        headers = {'If-None-Match': etag} if etag else {}
+        response = requests.get(f'{API_URL}/tasks/{task_id}', headers=headers)
+        if response.status_code != 304:
+            etag = response.headers.get('ETag')
+            if check_task_state(response.json()['data']):
+                return
+        if datetime.datetime.now() > deadline:
+            raise TimeoutError("Timeout reached while waiting for video generation")
+        logging.info(f"Video generation in progress, waiting for {POLL_INTERVAL} seconds before next check")
+        time.sleep(POLL_INTERVAL)
+
+def wait_for_task(task_id, timeout):
+    deadline = datetime.datetime.now() + timeout
+    try:
+        if stream_task_events(task_id, deadline):
+            logging.info("Video generation complete")
+            return
+        logging.warning("Task event stream closed, falling back to polling")
+    except requests.RequestException as e:
+        logging.warning(f"Task event stream unavailable ({e}), falling back to polling")
+    poll_task(task_id, deadline)
+    logging.info("Video generation complete")
+
 def generate_video_for_user(username):
     input_file_path = f'/mnt/accounts/{username}.json'
     input_data = read_json_file(input_file_path)
@@ -82,19 +137,9 @@ def generate_video_for_user(username):
     video_path = f'/mnt/storage/tasks/{task_id}/final-1.mp4'
     logging.info(f"Generated video task ID: {task_id}, video URL: {video_path}")
 
-    # Polling for video completion with timeout
-    logging.info("Polling for video completion")
-    start_time = datetime.datetime.now()
-    timeout = datetime.timedelta(minutes=30)
-    while True:
-        task_response = requests.get(f'http://api:8080/api/v1/tasks/{task_id}').json()
-        if task_response['data']['state'] == 1:
-            logging.info("Video generation complete")
-            break
-        if datetime.datetime.now() - start_time > timeout:
-            raise TimeoutError("Timeout reached while waiting for video generation")
-        logging.info("Video generation in progress, waiting for 30 seconds before next check")
-        time.sleep(30)
+    # Wait for video completion with timeout
+    logging.info("Waiting for video completion")
+    wait_for_task(task_id, timeout=datetime.timedelta(minutes=30))
     
     # Prepare the description for the video
     description = f"{video_subject} - A short video created using AI tools."
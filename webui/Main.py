@@ -784,7 +784,11 @@ if start_button:
     logger.info(utils.to_json(params))
     scroll_to_bottom()
 
-    result = tm.start(task_id=task_id, params=params)
+    try:
+        result = tm.start(task_id=task_id, params=params)
+    except Exception as e:
+        logger.error(str(e))
+        result = None
     if not result or "videos" not in result:
         st.error(tr("Video Generation Failed"))
         logger.error(tr("Video Generation Failed"))
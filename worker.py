@@ -0,0 +1,23 @@
+import signal
+import threading
+
+from loguru import logger
+
+from app.config import config
+
+if __name__ == "__main__":
+    if not config.app.get("enable_redis", False):
+        raise SystemExit("worker.py needs enable_redis = true, the tasks are read from redis")
+
+    from app.controllers.v1.video import task_manager
+
+    # the worker always processes tasks, even if the api nodes do not
+    task_manager.start_workers = True
+    stopped = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+
+    logger.info(f"start worker: {task_manager.node_id}")
+    task_manager.start()
+    stopped.wait()
+    task_manager.shutdown(wait=True, timeout=config.app.get("shutdown_timeout", 30))